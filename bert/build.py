@@ -3,29 +3,85 @@ from collections import OrderedDict
 import copy
 import docker
 import dockerpty
-import io
-import posixpath
+import itertools
 import jinja2
 import json
 import os
 
-from .display import Display
+from .display import Display, CAPTURE_MAX_SIZE
 from .filters import setup_filters
+from .lock import Lockfile, lockfile_path, resolve_locked_image
 from .tasks import get_task
-from .utils import json_hash, decode_bin
+from .utils import (
+    json_hash, decode_bin, TarSource,
+    is_compressed, iter_compressed, iter_file_chunks
+)
 from .yaml import from_yaml, preserve_yaml_mark, get_yaml_type_name
 from .exc import BuildFailed, ConfigFailed, TemplateFailed
 
 LABEL_BUILD_ID = "bert.build_id"
 
+PULL_ALWAYS = "always"
+PULL_IF_NOT_PRESENT = "if-not-present"
+PULL_NEVER = "never"
+PULL_POLICIES = (PULL_ALWAYS, PULL_IF_NOT_PRESENT, PULL_NEVER)
+
 class BuildResult(object):
     def __init__(self, vars=None):
         self.vars = vars or {}
 
+class BuildSettings(object):
+    """
+    Settings shared by every stage and job of a build.
+    """
+
+    REMOTE_DOCKER_SCHEMES = ("tcp://", "ssh://", "http://", "https://")
+
+    def __init__(self, upload_compress="auto", upload_compress_level=None, cache_dir=None,
+                 pull=PULL_ALWAYS, export_cache=False, patch_cache=False, log_tail=None,
+                 capture_max_size=CAPTURE_MAX_SIZE):
+        if pull not in PULL_POLICIES:
+            raise ValueError("Unknown pull policy {}".format(pull))
+        self.pull = pull
+        self.export_cache = export_cache
+        self.patch_cache = patch_cache
+        # Show only the last lines of command output, and only on failure
+        self.log_tail = log_tail
+        # Largest command output captured into a variable
+        self.capture_max_size = capture_max_size
+
+        if cache_dir is None:
+            cache_dir = os.environ.get("BERT_CACHE_DIR", "cache")
+        self.cache_dir = cache_dir
+
+        if upload_compress == "auto":
+            docker_host = os.environ.get("DOCKER_HOST", "")
+            if docker_host.startswith(self.REMOTE_DOCKER_SCHEMES):
+                upload_compress = "gzip"
+            else:
+                upload_compress = None
+        elif upload_compress == "none":
+            upload_compress = None
+
+        self.upload_compress = upload_compress
+        self.upload_compress_level = upload_compress_level
+
 class BuildImageExists(Exception):
     def __init__(self, image):
         self.image = image
 
+class BaseImageChanged(Exception):
+    """The pulled base image differs from the local one a stage started with"""
+    def __init__(self, image):
+        self.image = image
+
+def get_local_image(docker_client, image):
+    """Return the local image for `image`, or None if it isn't present"""
+    try:
+        return docker_client.images.get(image)
+    except docker.errors.ImageNotFound:
+        return None
+
 #
 #
 #
@@ -170,6 +226,11 @@ class BertTask(object):
         # Don't peak into child task, it is expected to provide details to .create()
         return {}
 
+    def iter_prefetch(self):
+        # a conditional task may never run, so don't go to the network for it
+        if self.when is None:
+            yield from self._task.iter_prefetch()
+
     @property
     def display_name(self):
         if self.name:
@@ -249,13 +310,18 @@ class BuildJob(object):
         self.configs = configs
         self.changes = []
         self.work_dir = work_dir
-        self.cache_dir = "cache"
+        self.settings = stage.settings
+        self.cache_dir = self.settings.cache_dir
         self.current_image = None
         self.current_task = None
         self.previous_task = CurrentTask(None)
         self._all_containers = []
         self._extra_images = []
         self.from_image_cache = stage.from_image_cache
+        self.git_ref_cache = stage.git_ref_cache
+        self.lock = stage.lock
+        self._pending_pull = None
+        self._setup_state = None
         if vars is not None:
             self.saved_vars = vars
         else:
@@ -263,10 +329,10 @@ class BuildJob(object):
         self.vars = BuildVars(self)
 
     def setup(self, image):
-        self.display.echo(">>> Pulling: {}".format(image))
-        img = self.from_image_cache.get(image)
-        if img is None:
-            img = self.from_image_cache[image] = self.docker_client.images.pull(image)
+        self._setup_state = (self.previous_task, len(self.changes), self.work_dir,
+                             dict(self.vars), dict(self.saved_vars))
+        self._pending_pull = None
+        img = self._resolve_image(image)
 
         self.current_image = BuildImage(name=image, image=img, info={
             'src_id': img.id
@@ -281,6 +347,79 @@ class BuildJob(object):
         else:
             self.run_task(BertTask('set-image-attr', {'work-dir': self.work_dir}))
 
+    def reset(self):
+        """Forget everything done since the last setup, to start the stage over"""
+        self.previous_task, changes_len, self.work_dir, vars, saved_vars = self._setup_state
+        del self.changes[changes_len:]
+        # variables set from the old image mustn't leak into the restart
+        self.vars.clear()
+        self.vars.update(vars)
+        self.saved_vars.clear()
+        self.saved_vars.update(saved_vars)
+        self.current_task = None
+        self.cleanup()
+
+    def _resolve_image(self, image):
+        img = self.from_image_cache.get(image)
+        if img is not None:
+            return img
+
+        policy = self.settings.pull
+        locked = self.lock.image(image) if self.lock is not None else None
+        if locked is not None:
+            img = self.from_image_cache[image] = resolve_locked_image(
+                self.docker_client, image, locked, pull=policy != PULL_NEVER
+            )
+            self.display.echo(">>> Locked Image: {} ({})".format(image, img.id))
+            return img
+
+        img = get_local_image(self.docker_client, image)
+        if img is None:
+            if policy == PULL_NEVER:
+                raise BuildFailed("Image {} is not present locally and pulling is disabled".format(image))
+            return self._pull(image)
+
+        if policy == PULL_ALWAYS:
+            # Only pull once a task actually misses the cache, so fully
+            # cached stages don't go to the registry at all.
+            self._pending_pull = (image, img.id)
+        else:
+            self.from_image_cache[image] = img
+
+        self.display.echo(">>> Local Image: {} ({})".format(image, img.id))
+        return img
+
+    def _pull(self, image):
+        self.display.echo(">>> Pulling: {}".format(image))
+        img = self.from_image_cache[image] = self.docker_client.images.pull(image)
+        return img
+
+    def _run_pending_pull(self):
+        image, local_id = self._pending_pull
+        self._pending_pull = None
+        img = self._pull(image)
+        if img.id != local_id:
+            raise BaseImageChanged(image)
+
+    def pull_pending(self):
+        """
+        Run a deferred pull of the base image now, for tasks whose cache
+        hits must not outlive an upstream change.  Raises BaseImageChanged,
+        restarting the stage, if the pull changed the image.
+        """
+        if self._pending_pull is not None:
+            self._run_pending_pull()
+
+    def current_image_id(self):
+        """
+        The id of the image the current task runs on, for keying local
+        caches.  A deferred pull of the base image isn't run, so cache
+        hits don't go to the registry; create() runs it before anything
+        is read from the image, restarting the stage if it changed.  Use
+        pull_pending() first to key on the pulled image instead.
+        """
+        return self.current_image.image.id
+
     def run_task(self, task):
         self.current_task = CurrentTask(task)
         task.run(self)
@@ -290,38 +429,42 @@ class BuildJob(object):
             return path
         return os.path.join(self.vars['bert_root_dir'], path)
 
-    def tarfile_add(self, tf, srcname, arcname=None, recursive=True, template=False, template_encoding='utf-8', mode=None):
-        if arcname is None:
-            arcname = srcname
-        paths = [(arcname, srcname)]
-
-        while True:
-            try:
-                arcname, srcname = paths.pop()
-            except IndexError:
-                break
-
-            ti = tf.gettarinfo(srcname, arcname)
+    def tar_source(self, srcname, arcname=None, recursive=True, template=False, template_encoding='utf-8', mode=None):
+        def template_filter(path):
+            with open(path, "r", encoding=template_encoding) as fi:
+                return self.template(fi.read()).encode(template_encoding)
+
+        source = TarSource()
+        source.add_path(srcname, arcname, recursive=recursive, mode=mode,
+                        content_filter=template_filter if template else None)
+        return source
+
+    def tarfile_add(self, tf, srcname, arcname=None, **kwargs):
+        self.tar_source(srcname, arcname, **kwargs).write_to(tf)
+
+    def put_archive(self, path, data, container=None, compressed=None):
+        """
+        Upload a tar archive into the current container.  `data` may be a
+        file object or an iterable of chunks.  The archive is compressed
+        on the way according to the upload settings, unless it already
+        is (pass `compressed` to skip sniffing the first chunk).
+        """
+        if container is None:
+            container = self.current_task.container
 
-            if mode is not None:
-                ti.mode = (ti.mode & ~0o777) | mode
+        compress_type = self.settings.upload_compress
+        if compress_type is not None:
+            if hasattr(data, "read"):
+                data = iter_file_chunks(data)
+            data = iter(data)
+            head = next(data, b"")
+            if compressed is None:
+                compressed = is_compressed(head)
+            data = itertools.chain((head, ), data)
+            if not compressed:
+                data = iter_compressed(data, compress_type, self.settings.upload_compress_level)
 
-            if ti.isreg():
-                if template:
-                    with open(srcname, "r", encoding=template_encoding) as fi:
-                        content = self.template(fi.read()).encode(template_encoding)
-                        ti.size = len(content)
-                        tf.addfile(ti, io.BytesIO(content))
-                else:
-                    with open(srcname, "rb") as fi:
-                        tf.addfile(ti, fi)
-            elif ti.isdir():
-                tf.addfile(ti)
-                if recursive:
-                    for fn in sorted(os.listdir(srcname)):
-                        paths.append((posixpath.join(arcname, fn), os.path.join(srcname, fn)))
-            else:
-                tf.addfile(ti)
+        return container.put_archive(path=path, data=data)
 
     def create(self, job_key, command=None):
         if self.current_task is None:
@@ -359,6 +502,9 @@ class BuildJob(object):
             if images:
                 raise BuildImageExists(images[0])
 
+        if self._pending_pull is not None:
+            self._run_pending_pull()
+
         self.current_task.image = self.current_image.image
         self.current_task.command = command
         self.current_task.env = env
@@ -412,11 +558,16 @@ class BuildJob(object):
             # Determined if we were successful.
             result = container.wait()
             if result['StatusCode'] != 0:
+                self.display.show_tail(watch_result)
                 raise BuildFailed(rc=result['StatusCode'], job=self)
 
             if canceled:
                 raise BuildFailed(rc=-1, job=self)
 
+            if watch_result.stdout_truncated:
+                raise BuildFailed("Captured output is larger than {} bytes".format(len(watch_result.stdout)),
+                                  job=self)
+
         conf = copy.deepcopy(container.image.attrs.get('Config', {}))
 
         changes = [
@@ -693,6 +844,9 @@ class BertStage(BertChildScope):
 
         self.tasks = list(self._iter_parse_tasks(task_list))
         self.from_image_cache = parent.from_image_cache
+        self.git_ref_cache = parent.git_ref_cache
+        self.lock = parent.lock
+        self.settings = parent.settings
 
         self.load_global_vars(data)
 
@@ -701,18 +855,19 @@ class BertStage(BertChildScope):
         for task in tasks:
             yield BertTask.create_from_dict(task)
 
+    def source_images(self, configs):
+        if self.from_:
+            return self.from_
+
+        for config in reversed(configs):
+            if config.images:
+                return config.images
+        return ()
+
     def build(self, configs, display=None, vars=None):
         vars = dict(vars) if vars else {}
 
-        if self.from_:
-            images = self.from_
-        else:
-            images = ()
-            for config in reversed(configs):
-                if config.images:
-                    images = config.images
-                    break
-
+        images = self.source_images(configs)
         if not images:
             raise ConfigFailed("Stage lacks images")
 
@@ -725,9 +880,16 @@ class BertStage(BertChildScope):
 
     def _build_from(self, job, configs, img):
         try:
-            job.setup(img)
-            for task in self.tasks:
-                job.run_task(task)
+            while True:
+                try:
+                    job.setup(img)
+                    for task in self.tasks:
+                        job.run_task(task)
+                except BaseImageChanged as bic:
+                    job.display.echo("--- Image {} changed upstream, restarting stage".format(bic.image))
+                    job.reset()
+                else:
+                    break
 
             if self.build_tag:
                 img = job.current_image.image
@@ -747,13 +909,20 @@ class BertStage(BertChildScope):
         }
 
 class BertBuild(BertScope):
-    def __init__(self, filename, shell_fail=False, config=None, display=None, root_dir=None):
+    def __init__(self, filename, shell_fail=False, config=None, display=None, root_dir=None, settings=None,
+                 use_lock=True):
         super().__init__(None)
 
+        if settings is not None:
+            self.settings = settings
+        else:
+            self.settings = BuildSettings()
+
         if display is not None:
             self.display = display
         else:
-            self.display = Display()
+            self.display = Display(interactive=not self.settings.log_tail, tail_lines=self.settings.log_tail,
+                                   capture_max_size=self.settings.capture_max_size)
 
         if root_dir is None:
             if filename is not None:
@@ -767,6 +936,12 @@ class BertBuild(BertScope):
         self.configs = []
         self.stages = []
         self.from_image_cache = {}
+        self.git_ref_cache = {}
+        self.lock = None
+        if use_lock and filename is not None:
+            self.lock = Lockfile.load(lockfile_path(filename))
+            if self.lock is not None:
+                self.git_ref_cache.update(self.lock.git)
         if config is not None:
             self.load_config(config)
         if self.filename is not None:
@@ -829,6 +1004,27 @@ class BertBuild(BertScope):
         data['bert_root_dir'] = self.root_dir
         super().put_global_vars(data)
 
+    def prefetch(self, workers=None):
+        """
+        Pull every source image and fetch static git and url sources
+        concurrently, ahead of building.
+        """
+        from .prefetch import Prefetcher
+
+        Prefetcher(self, workers=workers).run()
+
+    def write_lock(self, workers=None):
+        """
+        Resolve every base image, static git ref and static url, and
+        record them in the lockfile next to the build file.
+        """
+        from .prefetch import Prefetcher
+
+        lock = Lockfile(lockfile_path(self.filename))
+        Prefetcher(self, workers=workers).lock(lock)
+        lock.save()
+        return lock
+
     def build(self, vars={}):
         output_global_vars = {}
         for configs in chain_configs(self):
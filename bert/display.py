@@ -1,31 +1,125 @@
 
 import click
+import collections
 import io
 import struct
 import sys
+import tempfile
 
 import dockerpty
 
-def _pump_streams(docker_out, stdout, stderr):
+# Bytes read from the attach socket at once
+PUMP_READ_SIZE = 2**16
+# Captured output above this size is spooled to a temporary file
+CAPTURE_SPOOL_SIZE = 2**20
+# Captured output beyond this size is dropped
+CAPTURE_MAX_SIZE = 2**24
+
+_FRAME_HEADER = struct.Struct('>BxxxL')
+
+def _pump_streams(docker_out, stdout, stderr, read_size=PUMP_READ_SIZE):
+    """
+    Demultiplex a docker attach stream into the binary `stdout` and
+    `stderr`.  The socket is read in large chunks, and frames are split
+    out of them, so chatty commands don't cost a read and a write per
+    frame.  Both outputs are flushed after each chunk, which keeps them
+    interleaved close to how the command wrote them.
+    """
+    outputs = {1: stdout, 2: stderr}
+    pending = bytearray()
+    stype = None
+    remaining = 0
+
     while True:
-        header = docker_out.read(8)
-        if not header:
+        chunk = docker_out.read(read_size)
+        if not chunk:
             break
-        stype, length = struct.unpack('>BxxxL', header)
-
-        buffer = []
-        while length > 0:
-            chunk = docker_out.read(length)
-            if not chunk:
-                break
-            length -= len(chunk)
-            buffer.append(chunk)
-
-        line = b"".join(buffer)
-        if stype == 1:
-            stdout.buffer.write(line)
-        elif stype == 2:
-            stderr.buffer.write(line)
+
+        view = memoryview(chunk)
+        pos = 0
+        while pos < len(view):
+            if remaining == 0:
+                want = _FRAME_HEADER.size - len(pending)
+                pending += view[pos:pos + want]
+                pos += want
+                if len(pending) < _FRAME_HEADER.size:
+                    break
+                stype, remaining = _FRAME_HEADER.unpack(pending)
+                del pending[:]
+                continue
+
+            end = min(pos + remaining, len(view))
+            output = outputs.get(stype)
+            if output is not None:
+                output.write(view[pos:end])
+            remaining -= end - pos
+            pos = end
+
+        view.release()
+        stdout.flush()
+        stderr.flush()
+
+class _LineTail(object):
+    """Keeps the last lines written to it"""
+
+    def __init__(self, size):
+        self._lines = collections.deque(maxlen=size)
+        self._partial = b""
+
+    def write(self, b):
+        lines = bytes(b).split(b"\n")
+        lines[0] = self._partial + lines[0]
+        self._partial = lines.pop()
+        self._lines.extend(lines)
+
+    def flush(self):
+        pass
+
+    def lines(self):
+        lines = list(self._lines)
+        if self._partial:
+            lines.append(self._partial)
+            del lines[:-self._lines.maxlen]
+        return lines
+
+class _Capture(object):
+    """Keeps the first `max_size` bytes written to it"""
+
+    def __init__(self, max_size):
+        self._file = tempfile.SpooledTemporaryFile(max_size=CAPTURE_SPOOL_SIZE)
+        self._left = max_size
+        self.truncated = False
+
+    def write(self, b):
+        if len(b) > self._left:
+            b = b[:self._left]
+            self.truncated = True
+        if b:
+            self._file.write(b)
+            self._left -= len(b)
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        self._file.close()
+
+class _Tee(object):
+    def __init__(self, *outputs):
+        self._outputs = outputs
+
+    def write(self, b):
+        for output in self._outputs:
+            output.write(b)
+
+    def flush(self):
+        for output in self._outputs:
+            output.flush()
 
 class _WriteCapture(io.BufferedIOBase):
     def __init__(self, inner, buf):
@@ -37,15 +131,23 @@ class _WriteCapture(io.BufferedIOBase):
         self._buf.write(b)
 
 class WatchResult(object):
-    def __init__(self, stdout=None):
+    def __init__(self, stdout=None, tail=None, stdout_truncated=False):
         self.stdout = stdout
+        # The captured stdout was cut at the display's capture_max_size
+        self.stdout_truncated = stdout_truncated
+        # The last lines of output, when only those were kept
+        self.tail = tail
 
 class Display(object):
-    def __init__(self, interactive=True, stdin=None, stdout=None, stderr=None):
+    def __init__(self, interactive=True, stdin=None, stdout=None, stderr=None, tail_lines=None,
+                 capture_max_size=CAPTURE_MAX_SIZE):
         self.interactive = interactive
         self.stdout = stdout if stdout is not None else sys.stdout
         self.stderr = stderr if stderr is not None else sys.stderr
         self.stdin = stdin if stdin is not None else sys.stdin
+        # Keep only this many lines of a command's output, shown if it fails
+        self.tail_lines = tail_lines
+        self.capture_max_size = capture_max_size
 
     def watch_container(self, docker_client, container, capture=False):
         stdin = self.stdin
@@ -54,28 +156,58 @@ class Display(object):
 
         cap_out = None
         if capture:
-            cap_out = io.BytesIO()
-            buffer = _WriteCapture(stdout.buffer, cap_out)
-            stdout = io.TextIOWrapper(buffer)
-
-        if self.interactive:
-            dockerpty.start(
-                docker_client.api, container.id,
-                stdout=stdout,
-                stderr=stderr,
-                stdin=stdin,
-                interactive=self.interactive,
-                logs=1
-            )
-        else:
-            docker_out = docker_client.api.attach_socket(container.id, {
-                'stdout': 1, 'stderr': 1, 'stream': 1
-            })
-            docker_client.api.start(container.id)
-
-            _pump_streams(docker_out, stdout, stderr)
-
-        return WatchResult(stdout=None if cap_out is None else cap_out.getvalue())
+            cap_out = _Capture(self.capture_max_size)
+
+        tail = None
+        try:
+            if self.interactive:
+                if cap_out is not None:
+                    stdout = io.TextIOWrapper(_WriteCapture(stdout.buffer, cap_out))
+
+                dockerpty.start(
+                    docker_client.api, container.id,
+                    stdout=stdout,
+                    stderr=stderr,
+                    stdin=stdin,
+                    interactive=self.interactive,
+                    logs=1
+                )
+            else:
+                docker_out = docker_client.api.attach_socket(container.id, {
+                    'stdout': 1, 'stderr': 1, 'stream': 1
+                })
+                docker_client.api.start(container.id)
+
+                stdout.flush()
+                stderr.flush()
+                if self.tail_lines:
+                    tail = _LineTail(self.tail_lines)
+                    out_sink = err_sink = tail
+                else:
+                    out_sink, err_sink = stdout.buffer, stderr.buffer
+                if cap_out is not None:
+                    out_sink = _Tee(out_sink, cap_out)
+
+                _pump_streams(docker_out, out_sink, err_sink)
+
+            result = WatchResult(tail=None if tail is None else tail.lines())
+            if cap_out is not None:
+                result.stdout = cap_out.getvalue()
+                result.stdout_truncated = cap_out.truncated
+        finally:
+            if cap_out is not None:
+                cap_out.close()
+
+        return result
+
+    def show_tail(self, result):
+        """Show the output kept of a failed command"""
+        if result is None or not result.tail:
+            return
+        self.echo("--- Last {} lines of output:".format(len(result.tail)), err=True)
+        self.stderr.flush()
+        self.stderr.buffer.write(b"".join(line + b"\n" for line in result.tail))
+        self.stderr.buffer.flush()
 
     def echo(self, *args, **kwargs):
         err = kwargs.get("err", False)
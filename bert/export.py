@@ -0,0 +1,330 @@
+
+import io
+import json
+import os
+import queue
+import stat
+import tarfile
+import tempfile
+import threading
+
+from .utils import copy_fileobj, json_hash, lock_file, open_output, TarGlobList
+
+# Entries queued ahead of each writer, when exporting to several
+EXPORT_QUEUE_SIZE = 64
+# File data up to this size is shared between writers in memory,
+# larger files through a temporary file
+EXPORT_MEMORY_SIZE = 2**20
+
+class ExportWriter(object):
+    """
+    One output of an export, such as a tar file or a package.  It is
+    given every exported file in order, between open() and close().
+    """
+
+    dest = None
+    # TarGlobList limiting which files this writer gets, matched against
+    # the exported name as an absolute path.
+    filter = None
+    # The task values the writer was made from, part of its stamp
+    config = None
+
+    @classmethod
+    def from_values(cls, job, values):
+        writer = cls(job, **values)
+        writer.config = values
+        return writer
+
+    def wants(self, ti):
+        if self.filter is None:
+            return True
+        return self.filter.matches("/" + ti.name.lstrip("/"))
+
+    def open(self):
+        pass
+
+    def add(self, ti, data):
+        raise NotImplementedError
+
+    def close(self, commit=True):
+        pass
+
+class _PreadFile(io.RawIOBase):
+    """Reads a region of a file descriptor with its own position"""
+
+    def __init__(self, fd, size, offset=0):
+        self._fd = fd
+        self._size = size
+        self._offset = offset
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        want = min(len(buf), self._size - self._pos)
+        if want <= 0:
+            return 0
+        data = os.pread(self._fd, want, self._offset + self._pos)
+        buf[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+class _SharedData(object):
+    """File data read once and handed to several writers"""
+
+    def __init__(self, fileobj, size, users):
+        self._users = users
+        self._lock = threading.Lock()
+        self._file = None
+        self._data = None
+        if size <= EXPORT_MEMORY_SIZE:
+            self._data = fileobj.read()
+        else:
+            self._file = tempfile.TemporaryFile()
+            self._size = copy_fileobj(fileobj, self._file)
+
+    def open(self):
+        if self._file is None:
+            return io.BytesIO(self._data)
+        return io.BufferedReader(_PreadFile(self._file.fileno(), self._size))
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0 and self._file is not None:
+                self._file.close()
+
+class _WriterThread(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue(EXPORT_QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            ti, shared = item
+            try:
+                if self.error is None:
+                    data = shared.open() if shared is not None else None
+                    self.writer.add(ti, data)
+            except BaseException as exc:
+                # keep draining, so the reader never blocks on this queue
+                self.error = exc
+            finally:
+                if shared is not None:
+                    shared.release()
+
+def write_entries(entries, writers):
+    """
+    Hand each (TarInfo, fileobj) entry to the writers that want it.  With
+    several writers, each runs on its own thread, so their compression
+    overlaps, and file data is read only once.
+    """
+    if len(writers) == 1:
+        writer = writers[0]
+        for ti, data in entries:
+            if writer.wants(ti):
+                writer.add(ti, data)
+        return
+
+    threads = [_WriterThread(writer) for writer in writers]
+    for thread in threads:
+        thread.thread.start()
+
+    try:
+        for ti, data in entries:
+            targets = [thread for thread in threads if thread.error is None and thread.writer.wants(ti)]
+            if not targets:
+                continue
+
+            shared = None
+            if data is not None:
+                shared = _SharedData(data, ti.size, len(targets))
+            for thread in targets:
+                thread.queue.put((ti, shared))
+
+            if any(thread.error is not None for thread in targets):
+                break
+    finally:
+        for thread in threads:
+            thread.queue.put(None)
+        for thread in threads:
+            thread.thread.join()
+
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+def _config_json(value):
+    if isinstance(value, TarGlobList):
+        return value.cache_key()
+    if hasattr(value, "__fspath__"):
+        return os.path.abspath(value.__fspath__())
+    if isinstance(value, bytes):
+        return {"bytes": value.hex()}
+    if isinstance(value, dict):
+        return {str(k): _config_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_config_json(v) for v in value]
+    return value
+
+class ExportCache(object):
+    """
+    Exported content spooled to disk, keyed by image id and paths, and
+    stamps recording what each exported artifact was made from.
+    """
+
+    def __init__(self, cache_dir):
+        self.root = os.path.join(cache_dir, "exports")
+
+    def spool_path(self, key):
+        return os.path.join(self.root, "spool", key + ".tar")
+
+    def _stamp_path(self, dest):
+        return os.path.join(self.root, "stamps", json_hash('sha256', os.path.abspath(dest)) + ".json")
+
+    def _dest_state(self, dest):
+        # Directories are never current: their size and mtime don't show
+        # changes to the files in them.
+        try:
+            st = os.stat(dest)
+        except OSError:
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            return None
+        return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+    def is_current(self, dest, key):
+        """True if `dest` is a file, which was last made from `key`"""
+        state = self._dest_state(dest)
+        if state is None:
+            return False
+        try:
+            with open(self._stamp_path(dest), "r") as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return stamp.get("key") == key and stamp.get("state") == state
+
+    def set_stamp(self, dest, key):
+        state = self._dest_state(dest)
+        if state is None:
+            return
+        with open_output(self._stamp_path(dest), "w") as f:
+            json.dump({"dest": os.path.abspath(dest), "key": key, "state": state}, f)
+
+def export_is_current(job, dest, stamp, exists=os.path.exists):
+    """
+    True if `dest` need not be exported again.  With the export cache, it
+    must be stamped with `stamp`.  Otherwise it is current if `exists`
+    and the job made no changes to the image.
+    """
+    if job.settings.export_cache:
+        return ExportCache(job.cache_dir).is_current(dest, stamp)
+    return exists(dest) and not job.changes
+
+def export_stamp(job, dest, stamp):
+    """Record that `dest` was made from `stamp`, with the export cache enabled"""
+    if job.settings.export_cache:
+        ExportCache(job.cache_dir).set_stamp(dest, stamp)
+
+def export_key(job, paths):
+    """
+    Identifies the content exported for `paths` from the current image.
+    When the content has to be read, job.create() first runs any deferred
+    pull of the base image, and restarts the stage if that changed it, so
+    content is never read from another image than the key names.
+    """
+    return json_hash('sha256', [job.current_image_id(), paths.cache_key()])
+
+def _iter_spooled(entries, spool_path):
+    """
+    Write (TarInfo, fileobj) entries to a tar file at `spool_path` while
+    yielding them, with each file's data read back from the spool.  The
+    spool is only kept if every entry was consumed.
+    """
+    with open_output(spool_path, "w+b") as f:
+        with tarfile.open(fileobj=f, mode="w", format=tarfile.PAX_FORMAT) as tout:
+            for ti, data in entries:
+                tout.addfile(ti, data)
+                if data is None:
+                    yield ti, None
+                    continue
+
+                # the data ends the archive so far, padded to a block
+                f.flush()
+                blocks = (ti.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+                offset = tout.offset - blocks * tarfile.BLOCKSIZE
+                yield ti, io.BufferedReader(_PreadFile(f.fileno(), ti.size, offset))
+
+def iter_export_entries(job, paths, key=None):
+    """
+    Yield (TarInfo, fileobj) for the files matching `paths` in the
+    current image.  With the export cache enabled, they are also spooled
+    to disk the first time, and later served from there without a
+    container.
+    """
+    if not job.settings.export_cache:
+        container = job.create({})
+        yield from paths.iter_container_files(container)
+        return
+
+    if key is None:
+        key = export_key(job, paths)
+    spool_path = ExportCache(job.cache_dir).spool_path(key)
+    os.makedirs(os.path.dirname(spool_path), exist_ok=True)
+    with lock_file(spool_path + ".lock"):
+        if not os.path.exists(spool_path):
+            container = job.create({})
+            yield from _iter_spooled(paths.iter_container_files(container), spool_path)
+            return
+
+    job.display.echo("--- Exporting from cache")
+
+    with open(spool_path, "rb") as f:
+        with tarfile.open(fileobj=f, mode="r|") as tin:
+            for ti in tin:
+                yield ti, tin.extractfile(ti) if ti.isreg() else None
+
+def run_export(job, paths, writers):
+    """
+    Export the files matching `paths` from the current image to every
+    writer, reading them once.  Writers whose output is current are
+    skipped, see export_is_current().
+    """
+    key = export_key(job, paths)
+
+    pending = []
+    for writer in writers:
+        stamp = json_hash('sha256', [key, type(writer).__name__, _config_json(writer.config)])
+        if not export_is_current(job, writer.dest, stamp):
+            pending.append((writer, stamp))
+    if not pending:
+        return
+    writers = [writer for writer, _ in pending]
+
+    opened = []
+    try:
+        for writer in writers:
+            writer.open()
+            opened.append(writer)
+        write_entries(iter_export_entries(job, paths, key), writers)
+    except BaseException:
+        for writer in opened:
+            writer.close(commit=False)
+        raise
+
+    for i, (writer, stamp) in enumerate(pending):
+        try:
+            writer.close()
+            export_stamp(job, writer.dest, stamp)
+        except BaseException:
+            # a writer that fails to close cleans up after itself
+            for other, _ in pending[i + 1:]:
+                other.close(commit=False)
+            raise
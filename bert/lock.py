@@ -0,0 +1,115 @@
+
+import json
+import os
+import threading
+
+import docker
+
+from .exc import BuildFailed, ConfigFailed
+from .utils import open_output
+
+LOCK_FILENAME = "bert.lock"
+LOCK_VERSION = 1
+
+class Lockfile(object):
+    """
+    Resolved versions of the build's external inputs: the image id of each
+    base image, the commit of each git ref and the digest of each fetched
+    url.  A build with a lockfile can compute its cache keys without
+    going to the network.
+    """
+
+    def __init__(self, filename, images=None, git=None, fetch=None):
+        self.filename = filename
+        self.images = dict(images or {})
+        self.git = {(e["repo"], e["ref"]): e["commit"] for e in git or ()}
+        self.fetch = {_fetch_key(e["url"], e.get("params")): e for e in fetch or ()}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, filename):
+        """Load the lockfile, or return None if there is none"""
+        try:
+            with open(filename, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as exc:
+            raise ConfigFailed("{}: Invalid lockfile: {}".format(filename, exc))
+
+        if not isinstance(data, dict) or data.get("version") != LOCK_VERSION:
+            raise ConfigFailed("{}: Unsupported lockfile version, regenerate it with bert lock".format(filename))
+
+        return cls(filename, data.get("images"), data.get("git"), data.get("fetch"))
+
+    def save(self):
+        data = {
+            "version": LOCK_VERSION,
+            "images": self.images,
+            "git": [
+                {"repo": repo, "ref": ref, "commit": commit}
+                for (repo, ref), commit in sorted(self.git.items())
+            ],
+            "fetch": [self.fetch[k] for k in sorted(self.fetch)],
+        }
+        with open_output(self.filename, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def image(self, name):
+        return self.images.get(name)
+
+    def set_image(self, name, img):
+        digests = img.attrs.get("RepoDigests") or ()
+        with self._lock:
+            self.images[name] = {
+                "id": img.id,
+                "digest": digests[0] if digests else None,
+            }
+
+    def git_commit(self, repo, ref):
+        return self.git.get((repo, ref))
+
+    def set_git_commit(self, repo, ref, commit):
+        with self._lock:
+            self.git[(repo, ref)] = commit
+
+    def fetch_checksum(self, url, params):
+        entry = self.fetch.get(_fetch_key(url, params))
+        if entry is None:
+            return None
+        return entry["checksum"]
+
+    def set_fetch_checksum(self, url, params, checksum):
+        with self._lock:
+            self.fetch[_fetch_key(url, params)] = {
+                "url": url,
+                "params": params,
+                "checksum": checksum,
+            }
+
+def _fetch_key(url, params):
+    return json.dumps([url, params], sort_keys=True)
+
+def lockfile_path(build_filename):
+    return os.path.join(os.path.dirname(build_filename), LOCK_FILENAME)
+
+def resolve_locked_image(docker_client, name, locked, pull=True):
+    """
+    Return the image pinned by the lockfile, pulling it by digest if it
+    isn't present locally.
+    """
+    try:
+        return docker_client.images.get(locked["id"])
+    except docker.errors.ImageNotFound:
+        pass
+
+    if not pull or not locked.get("digest"):
+        raise BuildFailed("Locked image {} ({}) is not present locally".format(name, locked["id"]))
+
+    img = docker_client.images.pull(locked["digest"])
+    if img.id != locked["id"]:
+        raise BuildFailed("Image {} pulled as {}, but the lockfile expects {}".format(
+            name, img.id, locked["id"]
+        ))
+    return img
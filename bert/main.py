@@ -4,12 +4,57 @@ import sys
 
 import click
 
-from .build import BertBuild, BuildFailed
+from .build import BertBuild, BuildFailed, BuildSettings, PULL_ALWAYS, PULL_POLICIES
+from .display import CAPTURE_MAX_SIZE
+from .utils import COMPRESS_TYPES
 
-@click.command()
-@click.option("--shell-fail/--no-shell-fail", help="Drop into shell when command fails")
-@click.argument('input', nargs=-1)
-def cli(input, shell_fail):
+class _DefaultBuildGroup(click.Group):
+    """Runs the build command unless another command is named"""
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] not in ctx.help_option_names):
+            args = ["build"] + list(args)
+        return super().parse_args(ctx, args)
+
+def _settings_options(func):
+    options = [
+        click.option("--upload-compress", type=click.Choice(("auto", "none") + COMPRESS_TYPES),
+                     default="auto", envvar="BERT_UPLOAD_COMPRESS", show_default=True,
+                     help="Compress archives uploaded to docker.  auto compresses with gzip "
+                     "when DOCKER_HOST points at a remote daemon."),
+        click.option("--upload-compress-level", type=int, envvar="BERT_UPLOAD_COMPRESS_LEVEL",
+                     help="Compression level for uploaded archives"),
+        click.option("--cache-dir", envvar="BERT_CACHE_DIR", type=click.Path(file_okay=False),
+                     help="Directory for local caches, such as git repositories.  "
+                     "This can be shared between builds and concurrent runs.  [default: cache]"),
+        click.option("--pull", type=click.Choice(PULL_POLICIES), default=PULL_ALWAYS,
+                     envvar="BERT_PULL", show_default=True,
+                     help="When to pull base images.  always pulls only once a task misses the "
+                     "cache, if-not-present uses local images as they are, and never works offline."),
+        click.option("--export-cache/--no-export-cache", default=False, envvar="BERT_EXPORT_CACHE",
+                     show_default=True,
+                     help="Spool exported files in the cache directory, so exports of an unchanged "
+                     "image don't need docker, and stamp each output with what it was made from, "
+                     "so it is only rewritten when that changes.  Without this, an output is kept "
+                     "if it exists and its stage made no changes.  Neither exports/spool nor "
+                     "exports/stamps is ever pruned, so clean them up as needed."),
+        click.option("--patch-cache/--no-patch-cache", default=False, envvar="BERT_PATCH_CACHE",
+                     show_default=True,
+                     help="Keep the results of patch tasks in the cache directory, so the same "
+                     "patches on the same files aren't applied again.  The patches directory "
+                     "is never pruned, so clean it up as needed."),
+        click.option("--log-tail", type=click.IntRange(min=1), envvar="BERT_LOG_TAIL", metavar="LINES",
+                     help="Run commands without a terminal and keep only the last LINES lines of "
+                     "their output, shown when a command fails.  This keeps CI logs short."),
+        click.option("--capture-max-size", type=click.IntRange(min=1), default=CAPTURE_MAX_SIZE,
+                     envvar="BERT_CAPTURE_MAX_SIZE", show_default=True, metavar="BYTES",
+                     help="Fail a task whose output captured into a variable is larger than this."),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+def _iter_builds(input, settings, **kwargs):
     if not input:
         input = ["."]
 
@@ -18,7 +63,7 @@ def cli(input, shell_fail):
             inp = os.path.join(inp, "bert-build.yml")
 
         try:
-            build = BertBuild(inp, shell_fail=shell_fail)
+            build = BertBuild(inp, settings=settings, **kwargs)
         except FileNotFoundError as fef:
             click.echo(str(fef), err=True)
             sys.exit(1)
@@ -26,8 +71,57 @@ def cli(input, shell_fail):
             click.echo(str(bf), err=True)
             sys.exit(1)
 
+        yield build
+
+@click.group(cls=_DefaultBuildGroup)
+def cli():
+    pass
+
+@cli.command()
+@click.option("--shell-fail/--no-shell-fail", help="Drop into shell when command fails")
+@click.option("--prefetch/--no-prefetch", default=False, show_default=True,
+              help="Pull images and fetch git and url sources concurrently before building.  "
+              "This contacts every source, even if all stages are cached.")
+@click.option("--lock/--no-lock", "use_lock", default=True, show_default=True,
+              help="Use the versions pinned in bert.lock, if present")
+@_settings_options
+@click.argument('input', nargs=-1)
+def build(input, shell_fail, prefetch, use_lock, **settings):
+    """Build from the given build files"""
+    settings = BuildSettings(**settings)
+
+    for build in _iter_builds(input, settings, shell_fail=shell_fail, use_lock=use_lock):
         try:
+            if prefetch:
+                build.prefetch()
             build.build()
         except BuildFailed as bf:
             click.echo(str(bf), err=True)
             sys.exit(1)
+
+@cli.command()
+@click.option("--jobs", "-j", type=int, help="Number of sources to fetch at once")
+@_settings_options
+@click.argument('input', nargs=-1)
+def prefetch(input, jobs, **settings):
+    """Pull images and fetch sources without building"""
+    settings = BuildSettings(**settings)
+
+    for build in _iter_builds(input, settings):
+        build.prefetch(workers=jobs)
+
+@cli.command()
+@click.option("--jobs", "-j", type=int, help="Number of sources to resolve at once")
+@_settings_options
+@click.argument('input', nargs=-1)
+def lock(input, jobs, **settings):
+    """Pin base images, git refs and urls in bert.lock"""
+    settings = BuildSettings(**settings)
+
+    for build in _iter_builds(input, settings, use_lock=False):
+        try:
+            lockfile = build.write_lock(workers=jobs)
+        except BuildFailed as bf:
+            click.echo(str(bf), err=True)
+            sys.exit(1)
+        click.echo("Wrote {}".format(lockfile.filename))
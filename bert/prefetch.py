@@ -0,0 +1,125 @@
+
+import concurrent.futures
+import threading
+
+import docker
+
+from .build import chain_configs, get_local_image, PULL_ALWAYS, PULL_NEVER
+from .exc import BuildFailed
+from .lock import resolve_locked_image
+
+PREFETCH_WORKERS = 4
+
+class PrefetchItem(object):
+    """
+    Something a build will need from the network, which can be fetched
+    ahead of time.  Items with the same key are only fetched once.
+    """
+
+    key = None
+
+    def run(self, prefetcher):
+        raise NotImplementedError
+
+    def lock(self, prefetcher, lockfile):
+        """Resolve the item and record it in `lockfile`"""
+        raise NotImplementedError
+
+class PrefetchImage(PrefetchItem):
+    def __init__(self, image):
+        self.image = image
+        self.key = ("image", image)
+
+    def __str__(self):
+        return "image {}".format(self.image)
+
+    def run(self, prefetcher):
+        build = prefetcher.build
+        locked = build.lock.image(self.image) if build.lock is not None else None
+        if locked is not None:
+            build.from_image_cache[self.image] = resolve_locked_image(prefetcher.docker_client, self.image, locked)
+            return
+
+        # Images already present are left for the build to resolve, which
+        # with the always policy only pulls once a task misses the cache.
+        if get_local_image(prefetcher.docker_client, self.image) is not None:
+            return
+        img = prefetcher.docker_client.images.pull(self.image)
+        prefetcher.build.from_image_cache[self.image] = img
+
+    def lock(self, prefetcher, lockfile):
+        client = prefetcher.docker_client
+        img = None
+        if prefetcher.settings.pull != PULL_ALWAYS:
+            img = get_local_image(client, self.image)
+            if img is None and prefetcher.settings.pull == PULL_NEVER:
+                raise BuildFailed("Image {} is not present locally and pulling is disabled".format(self.image))
+        if img is None:
+            img = client.images.pull(self.image)
+        lockfile.set_image(self.image, img)
+
+class Prefetcher(object):
+    def __init__(self, build, workers=None):
+        self.build = build
+        self.settings = build.settings
+        self.display = build.display
+        self.workers = workers if workers else PREFETCH_WORKERS
+        self._docker_client = None
+        self._lock = threading.Lock()
+
+    @property
+    def docker_client(self):
+        with self._lock:
+            if self._docker_client is None:
+                self._docker_client = docker.from_env(timeout=600)
+            return self._docker_client
+
+    def collect(self, all_images=False):
+        items = {}
+
+        def add(item):
+            items.setdefault(item.key, item)
+
+        if all_images or self.settings.pull != PULL_NEVER:
+            for configs in chain_configs(self.build):
+                for stage in self.build.stages:
+                    for image in stage.source_images(configs):
+                        if all_images or image not in self.build.from_image_cache:
+                            add(PrefetchImage(image))
+
+        for stage in self.build.stages:
+            for task in stage.tasks:
+                for item in task.iter_prefetch():
+                    add(item)
+
+        return list(items.values())
+
+    def run(self):
+        items = self.collect()
+        if not items:
+            return
+
+        self.display.echo(">>> Prefetching: {} sources".format(len(items)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(item.run, self): item for item in items}
+            for future in concurrent.futures.as_completed(futures):
+                exc = future.exception()
+                if exc is not None:
+                    # Not fatal, the task will try again and report properly
+                    self.display.echo("--- Prefetch failed for {}: {}".format(futures[future], exc), err=True)
+
+    def lock(self, lockfile):
+        """Resolve every item into `lockfile`, failing if any can't be"""
+        items = self.collect(all_images=True)
+
+        self.display.echo(">>> Locking: {} sources".format(len(items)))
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(item.lock, self, lockfile): item for item in items}
+            for future in concurrent.futures.as_completed(futures):
+                exc = future.exception()
+                if exc is not None:
+                    failed.append("{}: {}".format(futures[future], exc))
+
+        if failed:
+            raise BuildFailed("Unable to lock:\n  " + "\n  ".join(sorted(failed)))
@@ -90,6 +90,35 @@ class Task(object):
     def run_with_values(self, job, **kwargs):
         raise NotImplementedError
 
+    def static_values(self):
+        """
+        Return the task values if they can be known before the build
+        runs (no templating), otherwise None.
+        """
+        if self.Schema is None:
+            return None
+        try:
+            return self.schema.task_apply_values(_StaticJob(), self.value)
+        except (_NotStatic, ConfigFailed, ValueError, TypeError):
+            return None
+
+    def iter_prefetch(self):
+        """Yield prefetch items for sources this task will need"""
+        return iter(())
+
+class _NotStatic(Exception):
+    pass
+
+class _StaticJob(object):
+    def template(self, value):
+        if isinstance(value, str) and ("{{" in value or "{%" in value):
+            raise _NotStatic()
+        if isinstance(value, dict):
+            return {self.template(k): self.template(v) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [self.template(v) for v in value]
+        return value
+
 def _fixup_var_name(name):
     return name.replace("_", "-")
 
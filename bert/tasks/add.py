@@ -1,11 +1,10 @@
 
 import os
 import posixpath
-import tarfile
-import tempfile
 
 from . import Task, TaskVar
-from ..utils import expect_file_mode, IOHashWriter, LocalPath
+from ..exc import ConfigFailed
+from ..utils import expect_file_mode, LocalPath
 
 class TaskAdd(Task, name="add"):
     """
@@ -17,14 +16,25 @@ class TaskAdd(Task, name="add"):
         dest = TaskVar('dest', help="Destination path of file")
         mode = TaskVar(type=expect_file_mode, help="The unix file mode to use for the tar file.")
         template = TaskVar(help="Treat added file as a template", default=False, type=bool)
+        normalize = TaskVar(help="Add files owned by root with a fixed mtime instead of the local "
+                            "file ownership and times, so identical content gives identical "
+                            "images (and cache hits) on any machine", default=False, type=bool)
+        mtime = TaskVar(type=int, help="The mtime to use when normalizing, which requires "
+                        "normalize.  Defaults to SOURCE_DATE_EPOCH from the environment, or zero.")
+
+    def run_with_values(self, job, path, dest, mode, template, normalize, mtime):
+        if mtime is not None and not normalize:
+            raise ConfigFailed("add: mtime is only used with normalize", element=self.value)
+
+        # Key on the path as configured, relative to the build root, so
+        # the key doesn't depend on where the build is checked out.
+        job_args = {
+            'value': getattr(path, 'path', path),
+        }
 
-    def run_with_values(self, job, path, dest, mode, template):
         if hasattr(path, '__fspath__'):
             path = path.__fspath__()
 
-        job_args = {
-            'value': path,
-        }
         if mode is not None:
             job_args['mode'] = mode
         if template:
@@ -39,19 +49,12 @@ class TaskAdd(Task, name="add"):
             else:
                 arcname = dest
 
-        with tempfile.TemporaryFile() as tf:
-            hash_wrapper = IOHashWriter('sha256', tf)
-
-            with tarfile.open(fileobj=hash_wrapper, mode="w") as tar:
-                job.tarfile_add(tar, path, arcname=arcname, mode=mode, template=template)
-
-            tf.seek(0)
-            job_args['tar_sha256'] = hash_wrapper.hexdigest()
+        source = job.tar_source(path, arcname=arcname, mode=mode, template=template)
+        if normalize:
+            source.normalize(mtime)
+        job_args['content_hash'] = source.content_hash()
 
-            container = job.create(job_args)
-            container.put_archive(
-                path="/",
-                data=tf
-            )
+        job.create(job_args)
+        job.put_archive("/", source.iter_tar())
 
         job.commit()
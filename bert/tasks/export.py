@@ -0,0 +1,77 @@
+
+from . import Task, TaskVar
+from ..exc import ConfigFailed
+from .export_deb import TaskExportDeb, DebWriter
+from .export_rpm import TaskExportRpm, RPMBuild
+from .export_tar import TaskExportTar, TarWriter
+from ..export import run_export
+from ..utils import TarGlobList
+
+OUTPUT_TYPES = {
+    "tar": (TaskExportTar, TarWriter),
+    "deb": (TaskExportDeb, DebWriter),
+    "rpm": (TaskExportRpm, RPMBuild),
+}
+
+class _TemplatedJob(object):
+    """A job whose values were already templated"""
+
+    def __init__(self, job):
+        self._job = job
+
+    def template(self, value):
+        return value
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+class TaskExport(Task, name="export"):
+    """
+    Export files to several tar files and packages at once, reading them
+    from the image only once.  Each output is written on its own thread.
+
+    Example::
+
+        - export:
+            paths: [/usr]
+            outputs:
+              - tar:
+                  dest: usr.tar.gz
+              - rpm:
+                  name: foo
+                  paths: [/usr/bin]
+              - rpm:
+                  name: foo-devel
+                  paths: ["glob:/usr/include/*"]
+    """
+
+    class Schema:
+        paths = TaskVar(required=True, help="List of paths to read from the image", type=TarGlobList)
+        outputs = TaskVar(required=True,
+                          help="List of outputs, each a mapping of one of tar, deb or rpm to the "
+                          "options of export-tar, export-deb or export-rpm.  The `paths` of an "
+                          "output limit which of the exported files it gets, and default to all.")
+
+    def run_with_values(self, job, *, paths, outputs):
+        if not isinstance(outputs, list) or not outputs:
+            raise ConfigFailed("export outputs should be a non-empty list", element=self.value)
+
+        writers = []
+        for output in outputs:
+            if not isinstance(output, dict) or len(output) != 1:
+                raise ConfigFailed("Each export output should be a mapping with one of: {}".format(
+                    ", ".join(sorted(OUTPUT_TYPES))
+                ), element=output)
+
+            (output_type, value), = output.items()
+            try:
+                task_cls, writer_cls = OUTPUT_TYPES[output_type]
+            except KeyError:
+                raise ConfigFailed("Unknown export output type `{}'".format(output_type), element=output)
+
+            values = task_cls.schema.task_apply_values(_TemplatedJob(job), value)
+            writer = writer_cls.from_values(job, values)
+            writer.filter = values.get("paths")
+            writers.append(writer)
+
+        run_export(job, paths, writers)
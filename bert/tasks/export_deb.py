@@ -1,10 +1,10 @@
 
 import io
-import os
 import tarfile
 
 from . import Task, TaskVar
-from ..utils import TarGlobList, open_output, LocalPath
+from ..export import ExportWriter, run_export
+from ..utils import TarGlobList, open_output, LocalPath, CompressWriter, TAR_COMPRESS_TYPES
 
 class TaskExportDeb(Task, name="export-deb"):
     """
@@ -13,58 +13,108 @@ class TaskExportDeb(Task, name="export-deb"):
 
     """
 
-    CONTROL_FIELD_ORDER_START = (
-        'Package', 'Version', 'Architecture', 'Section'
-    )
-    CONTROL_FIELD_ORDER_END = (
-        'Homepage', 'Description'
-    )
-
     class Schema:
         dest = TaskVar("name", help="Local destination filename for package", type=LocalPath)
         paths = TaskVar(help="List of paths to include in package", type=TarGlobList)
         compress_type = TaskVar(default="xz", help="Compression to use for package")
+        compress_level = TaskVar(type=int, help="The compression level, 1 (fastest) to 9 (smallest)")
+        compress_threads = TaskVar(type=int, help="Compress gz or xz in blocks on this many threads, "
+                                   "or 0 for one per CPU.  The blocks are written as concatenated gzip "
+                                   "members or blocks of one xz stream, which compress slightly worse.")
         control = TaskVar(help="Control values for package, which is essentially the package metadata. "
                           "The control contents can be specified as the literal file contents, or as a mapping. "
                           "Consult the `Control Fields section of the Debian Policy Manual <https://www.debian.org/doc/debian-policy/ch-controlfields.html>`_ "
                           "for more information.")
 
-    def run_with_values(self, job, *, dest, paths, compress_type, control):
-        # Instead of using dpkg-deb, we'll build it manually.  This
-        # allows us to avoid playing games with fakeroot, and copy
-        # directly to the data tar.
-
-        if os.path.exists(dest) and not job.changes:
-            return
-
+    def run_with_values(self, job, *, paths, **kwargs):
         if not paths:
             raise ValueError("Need a path")
 
-        container = job.create({})
-        with open_output(dest, "w+b") as far:
-            far.write(b"!<arch>\n")
-
-            # package header
-            deb_bin_text = b"2.0\n"
-            self._write_ar_header(far, "debian-binary", size=len(deb_bin_text))
-            far.write(deb_bin_text)
-            self._align_ar_data(far)
-
-            # create control
-            offset_sz_control = self._write_ar_header(far, "control.tar.gz")
-            control_start = far.tell()
-            with tarfile.open(fileobj=far, mode="w|gz") as tarf:
-                self._write_control(job, tarf, control)
-            self._update_ar_size(far, offset_sz_control, far.tell() - control_start)
-            self._align_ar_data(far)
-
-            # create data
-            offset_sz_data = self._write_ar_header(far, "data.tar."+compress_type)
-            data_start = far.tell()
-            with tarfile.open(fileobj=far, mode="w|"+compress_type) as tarf:
-                self._copy_data(container, tarf, paths)
-            self._update_ar_size(far, offset_sz_data, far.tell() - data_start)
-            self._align_ar_data(far)
+        run_export(job, paths, [DebWriter.from_values(job, kwargs)])
+
+class DebWriter(ExportWriter):
+    # Instead of using dpkg-deb, we'll build it manually.  This
+    # allows us to avoid playing games with fakeroot, and copy
+    # directly to the data tar.
+
+    CONTROL_FIELD_ORDER_START = (
+        'Package', 'Version', 'Architecture', 'Section'
+    )
+    CONTROL_FIELD_ORDER_END = (
+        'Homepage', 'Description'
+    )
+
+    def __init__(self, job, *, dest, compress_type, control, paths=None,
+                 compress_level=None, compress_threads=None):
+        if hasattr(dest, "__fspath__"):
+            dest = dest.__fspath__()
+        self.dest = dest
+        self.job = job
+        self.compress_type = compress_type
+        self.compress_level = compress_level
+        self.compress_threads = compress_threads
+        self.control = control
+
+        self._output = None
+        self._far = None
+        self._comp = None
+        self._tarf = None
+
+    def open(self):
+        self._output = open_output(self.dest, "w+b")
+        far = self._far = self._output.__enter__()
+        far.write(b"!<arch>\n")
+
+        # package header
+        deb_bin_text = b"2.0\n"
+        self._write_ar_header(far, "debian-binary", size=len(deb_bin_text))
+        far.write(deb_bin_text)
+        self._align_ar_data(far)
+
+        # create control
+        offset_sz_control = self._write_ar_header(far, "control.tar.gz")
+        control_start = far.tell()
+        with tarfile.open(fileobj=far, mode="w|gz") as tarf:
+            self._write_control(self.job, tarf, self.control)
+        self._update_ar_size(far, offset_sz_control, far.tell() - control_start)
+        self._align_ar_data(far)
+
+        # create data
+        self._offset_sz_data = self._write_ar_header(far, "data.tar."+self.compress_type)
+        self._data_start = far.tell()
+        if self.compress_type in TAR_COMPRESS_TYPES:
+            self._comp = CompressWriter(far, TAR_COMPRESS_TYPES[self.compress_type],
+                                        self.compress_level, self.compress_threads)
+            self._tarf = tarfile.open(fileobj=self._comp, mode="w|")
+        else:
+            self._tarf = tarfile.open(fileobj=far, mode="w|"+self.compress_type)
+
+    def add(self, ti, data):
+        self._tarf.addfile(ti, data)
+
+    def close(self, commit=True):
+        try:
+            if commit:
+                far = self._far
+                self._tarf.close()
+                if self._comp is not None:
+                    self._comp.close()
+                self._update_ar_size(far, self._offset_sz_data, far.tell() - self._data_start)
+                self._align_ar_data(far)
+        except BaseException:
+            commit = False
+            raise
+        finally:
+            if not commit:
+                # finish the tar stream into the output being dropped,
+                # rather than when it is garbage collected
+                try:
+                    self._tarf.close()
+                except Exception:
+                    pass
+            if self._comp is not None:
+                self._comp.close(commit=False)
+            self._output.close(commit)
 
     def _update_ar_size(self, fileobj, write_offset, new_size):
         here = fileobj.tell()
@@ -155,7 +205,3 @@ class TaskExportDeb(Task, name="export-deb"):
         info = tarfile.TarInfo("control")
         info.size = len(control.getvalue())
         tarf.addfile(info, control)
-
-    def _copy_data(self, container, tarf, paths):
-        for ti, tdata in paths.iter_container_files(container):
-            tarf.addfile(ti, tdata)
@@ -4,7 +4,11 @@ import shutil
 import stat
 
 from . import Task, TaskVar
-from ..utils import TarGlobList, LocalPath
+from ..export import export_is_current, export_key, export_stamp, iter_export_entries
+from ..utils import TarGlobList, LocalPath, json_hash, COPY_CHUNK_SIZE
+
+# Runs of zeros this long, aligned, are left as holes in exported files
+SPARSE_BLOCK_SIZE = 2**16
 
 def _makedev(path, ti):
     mode = ti.mode | (stat.S_IFBLK if ti.isblk() else stat.S_IFCHR)
@@ -24,39 +28,123 @@ def _setmeta(path, ti):
     except EnvironmentError:
         pass
 
+def _copy_sparse(fsrc, fdst, size):
+    """Copy a regular file's data, seeking over blocks of zeros"""
+    zeros = bytes(SPARSE_BLOCK_SIZE)
+    buf = memoryview(bytearray(min(max(size, 1), COPY_CHUNK_SIZE)))
+    while True:
+        sz = fsrc.readinto(buf)
+        if not sz:
+            break
+        chunk = buf[:sz]
+        for off in range(0, sz, SPARSE_BLOCK_SIZE):
+            block = chunk[off:off+SPARSE_BLOCK_SIZE]
+            if len(block) == SPARSE_BLOCK_SIZE and block == zeros:
+                fdst.seek(SPARSE_BLOCK_SIZE, os.SEEK_CUR)
+            else:
+                fdst.write(block)
+    fdst.truncate()
+
+def _link_target(root, ti):
+    return os.path.normpath(os.path.join(root, ti.linkname.lstrip("/")))
+
+def _is_current(path, ti, root):
+    """Check if `path` already has the type, contents and metadata of `ti`"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+
+    if ti.issym():
+        return stat.S_ISLNK(st.st_mode) and os.readlink(path) == ti.linkname
+    if ti.islnk():
+        if root is None:
+            return True
+        try:
+            return os.path.samestat(st, os.lstat(_link_target(root, ti)))
+        except OSError:
+            return False
+
+    if stat.S_IMODE(st.st_mode) != stat.S_IMODE(ti.mode):
+        return False
+    if ti.isreg():
+        return stat.S_ISREG(st.st_mode) and st.st_size == ti.size and int(st.st_mtime) == int(ti.mtime)
+    if ti.isfifo():
+        return stat.S_ISFIFO(st.st_mode)
+    if ti.ischr() or ti.isblk():
+        return ((stat.S_ISCHR(st.st_mode) if ti.ischr() else stat.S_ISBLK(st.st_mode)) and
+                st.st_rdev == os.makedev(ti.devmajor, ti.devminor))
+    return True
+
+def _make_parents(root, path, made):
+    """
+    Create the directories above `path`, up to `root`, replacing any
+    files or symlinks in their place.  `made` holds the directories
+    already checked.
+    """
+    parent = os.path.dirname(path)
+    missing = []
+    while parent != root and parent not in made and parent != os.path.dirname(parent):
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+    for parent in reversed(missing):
+        if os.path.islink(parent) or (os.path.lexists(parent) and not os.path.isdir(parent)):
+            os.unlink(parent)
+        os.makedirs(parent, exist_ok=True)
+        made.add(parent)
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
 class TaskExportFile(Task, name="export-file"):
 
     class Schema:
         dest = TaskVar(help="Destination file name", type=LocalPath)
         paths = TaskVar('src', help="File or list of files to export", required=True, type=TarGlobList)
+        sync = TaskVar(default=False, type=bool,
+                       help="Update dest in place: only files whose type, size, mtime or mode changed "
+                       "are rewritten, and files no longer exported are deleted.  Otherwise dest is "
+                       "extracted anew and replaced.")
 
-    def run_with_values(self, job, dest=None, paths=None):
+    def run_with_values(self, job, dest=None, paths=None, sync=False):
         if hasattr(dest, "__fspath__"):
             dest = dest.__fspath__()
 
-        if os.path.isfile(dest) and not job.changes:
+        key = export_key(job, paths)
+        stamp = json_hash('sha256', [key, self.task_name])
+        if export_is_current(job, dest, stamp, exists=os.path.isfile):
             return
 
-        container = job.create({})
+        entries = iter_export_entries(job, paths, key)
+        if sync:
+            self._do_sync(entries, dest)
+            export_stamp(job, dest, stamp)
+            return
 
-        dest_temp = self._do_export(container, paths, dest)
+        dest_temp = self._do_export(entries, dest)
 
         if os.path.isdir(dest):
             shutil.rmtree(dest)
         os.rename(dest_temp, dest)
+        export_stamp(job, dest, stamp)
 
-    def _do_export(self, container, paths, dest):
+    def _do_export(self, entries, dest):
         made_dest = force_dir = is_dir = False
         while dest.endswith("/"):
             force_dir = True
             dest = dest[:-1]
 
         dest_out = dest+".tmp"
-        for ti, tdata in paths.iter_container_files(container):
+        root = None
+        for ti, tdata in entries:
             if not made_dest and (ti.isdir() or force_dir):
                 os.makedirs(dest_out, exist_ok=True)
                 made_dest = True
                 is_dir = True
+                root = dest_out
 
             tipath = ti.name
             while tipath.startswith("/"):
@@ -68,19 +156,83 @@ class TaskExportFile(Task, name="export-file"):
                 tipath = dest_out
 
             try:
-                self._extract_file(tipath, ti, tdata)
+                self._extract_file(tipath, ti, tdata, root)
             finally:
                 if tdata is not None:
                     tdata.close()
 
         return dest_out
 
-    def _extract_file(self, path, ti, tdata):
+    def _do_sync(self, entries, dest):
+        force_dir = False
+        while dest.endswith("/"):
+            force_dir = True
+            dest = dest[:-1]
+
+        root = None
+        seen = set()
+        made = set()
+        dirs = []
+        for ti, tdata in entries:
+            try:
+                if root is None and (ti.isdir() or force_dir):
+                    if not os.path.isdir(dest) or os.path.islink(dest):
+                        _remove(dest)
+                        os.makedirs(dest)
+                    root = os.path.normpath(dest)
+
+                if ti.islnk() and (root is None or _link_target(root, ti) not in seen):
+                    # the link's target isn't exported, so neither is the link
+                    continue
+
+                if root is not None:
+                    path = os.path.normpath(os.path.join(root, ti.name.lstrip("/")))
+                    _make_parents(root, path, made)
+                else:
+                    path = dest
+                seen.add(path)
+
+                if ti.isdir():
+                    if not os.path.isdir(path) or os.path.islink(path):
+                        _remove(path)
+                        os.makedirs(path)
+                    # adding files changes a directory's mtime, so set it last
+                    dirs.append((path, ti))
+                elif not _is_current(path, ti, root):
+                    temp = os.path.join(os.path.dirname(path), ".{}.tmp".format(os.path.basename(path)))
+                    _remove(temp)
+                    if self._extract_file(temp, ti, tdata, root):
+                        if os.path.isdir(path) and not os.path.islink(path):
+                            shutil.rmtree(path)
+                        os.replace(temp, path)
+            finally:
+                if tdata is not None:
+                    tdata.close()
+
+        if root is not None:
+            # directories made for files without an entry of their own are kept
+            seen.update(made)
+            for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    if path not in seen:
+                        _remove(path)
+
+        for path, ti in reversed(dirs):
+            _setmeta(path, ti)
+
+    def _extract_file(self, path, ti, tdata, root=None):
         os.makedirs(os.path.dirname(path), exist_ok=True)
 
         if ti.isreg():
             with open(path, "wb") as f:
-                shutil.copyfileobj(tdata, f)
+                _copy_sparse(tdata, f, ti.size)
+        elif ti.islnk():
+            # skipped if the link's target isn't exported
+            if root is None or not os.path.lexists(_link_target(root, ti)):
+                return False
+            os.link(_link_target(root, ti), path)
+            return True
         elif ti.isdir():
             os.makedirs(path, exist_ok=True)
         elif ti.isfifo():
@@ -90,7 +242,8 @@ class TaskExportFile(Task, name="export-file"):
         elif ti.issym():
             _makelink(path, ti)
         else:
-            return
+            return False
 
         if not ti.issym():
             _setmeta(path, ti)
+        return True
@@ -1,13 +1,13 @@
 
+from array import array
 from enum import IntEnum
-import gzip
 import hashlib
 import io
 from itertools import chain
 import os
 import re
+import sys
 import tempfile
-import shutil
 import struct
 
 try:
@@ -21,7 +21,11 @@ except ImportError:
     lzma = None
 
 from . import Task, TaskVar
-from ..utils import TarGlobList, open_output, LocalPath, IOHashWriter, TeeBytesWriter
+from ..export import ExportWriter, run_export
+from ..utils import (
+    TarGlobList, open_output, LocalPath, IOHashWriter, TeeBytesWriter, ThreadedWriter,
+    CompressWriter, copy_fileobj, COPY_CHUNK_SIZE
+)
 
 # This is derived from arch_canon entries in rpmrc
 # (We don't include the uname equiv portion)
@@ -68,9 +72,30 @@ class RPMSense(IntEnum):
 # RPM Tag Types
 #
 
+def _array_typecode(size):
+    for typecode in "BHILQ":
+        if array(typecode).itemsize == size:
+            return typecode
+    return None
+
+# array typecodes for the big endian integer tags, which are packed in
+# bulk rather than with a struct.pack per element
+_ARRAY_TYPECODES = {
+    '!B': _array_typecode(1),
+    '!H': _array_typecode(2),
+    '!I': _array_typecode(4),
+    '!Q': _array_typecode(8),
+}
+
 def _rpm_tag_multiple(type_tag, alignment, struct_type, val):
-    if isinstance(val, list):
-        return type_tag, alignment, len(val), b"".join(struct.pack(struct_type, v) for v in val)
+    if isinstance(val, (list, array)):
+        typecode = _ARRAY_TYPECODES.get(struct_type)
+        if typecode is None:
+            return type_tag, alignment, len(val), b"".join(struct.pack(struct_type, v) for v in val)
+        values = array(typecode, val)
+        if sys.byteorder == "little":
+            values.byteswap()
+        return type_tag, alignment, len(values), values.tobytes()
     else:
         return type_tag, alignment, 1, struct.pack(struct_type, val)
 
@@ -108,6 +133,9 @@ def rpm_tag_str_array(name, value):
     if not isinstance(value, list):
         value = [value]
 
+    if all(isinstance(v, str) for v in value):
+        return 8, 0, len(value), "".join(v + "\x00" for v in value).encode('utf-8')
+
     encoded_values = [v.encode('utf-8') if isinstance(v, str) else v for v in value]
     return 8, 0, len(value), b"".join(v + b'\x00' for v in encoded_values)
 
@@ -264,26 +292,86 @@ class HeaderBuilder(object):
 def make_rpm_header(*args, **kwargs):
     return HeaderBuilder().build(*args, **kwargs)
 
-class RPMFileItem(object):
-    def __init__(self, filename, size=0, mode=0o644, rdev=0, mtime=0, md5=None,
-                 nlink=1, linkto=None, flags=0, user="root", group="group",
-                 inode=0, device=0, lang=""):
-        self.filename = filename
-        self.basename = os.path.basename(filename)
-        self.dirname = os.path.join(os.path.dirname(filename), "")
-        self.size = size
-        self.mode = mode
-        self.rdev = rdev
-        self.mtime = mtime
-        self.md5 = md5
-        self.nlink = nlink
-        self.linkto = linkto
-        self.flags = flags
-        self.user = user
-        self.group = group
-        self.inode = inode
-        self.device = device
-        self.lang = lang
+class RPMFileTable(object):
+    """
+    Metadata of the files in a package, stored by column: integers in
+    arrays, and directory, user and group names interned.  Packages can
+    have hundreds of thousands of files, so there is no object per file.
+    """
+
+    def __init__(self):
+        self.dirnames = {}
+        self.filenames = []
+        self.dirindexes = array('L')
+        self.basenames = []
+        self.sizes = array('L')
+        self.modes = array('L')
+        self.mtimes = array('L')
+        self.md5s = []
+        self.linktos = []
+        self.users = []
+        self.groups = []
+        self.inodes = array('L')
+        self._names = {}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def _intern(self, value):
+        return self._names.setdefault(value, value)
+
+    def add(self, filename, size=0, mode=0o644, mtime=0, md5="", linkto="", user="root", group="root", inode=0):
+        dirname, basename = os.path.split(filename)
+        dirname = os.path.join(dirname, "")
+        self.filenames.append(filename)
+        self.dirindexes.append(self.dirnames.setdefault(dirname, len(self.dirnames)))
+        self.basenames.append(basename)
+        self.sizes.append(size)
+        self.modes.append(mode & 0xffff)
+        self.mtimes.append(mtime)
+        self.md5s.append(md5)
+        self.linktos.append(linkto or "")
+        self.users.append(self._intern(user))
+        self.groups.append(self._intern(group))
+        self.inodes.append(inode)
+
+    def header(self):
+        """The file tags of the header, with files sorted by name"""
+        count = len(self.filenames)
+        order = sorted(range(count), key=self.filenames.__getitem__)
+        if order == list(range(count)):
+            def column(values):
+                return values
+        else:
+            def column(values):
+                if isinstance(values, array):
+                    return array(values.typecode, map(values.__getitem__, order))
+                return list(map(values.__getitem__, order))
+
+        dirnames = sorted(self.dirnames)
+        renumber = [0] * len(dirnames)
+        for idx, dirname in enumerate(dirnames):
+            renumber[self.dirnames[dirname]] = idx
+        dirindexes = array('L', map(renumber.__getitem__, self.dirindexes))
+
+        zeros = array('L', [0]) * count
+        return {
+            'dirnames': dirnames,
+            'dirindexes': column(dirindexes),
+            'basenames': column(self.basenames),
+            'filesizes': column(self.sizes),
+            'filemodes': column(self.modes),
+            'filerdevs': zeros,
+            'filemtimes': column(self.mtimes),
+            'filemd5s': column(self.md5s),
+            'filelinktos': column(self.linktos),
+            'fileflags': zeros,
+            'fileusername': column(self.users),
+            'filegroupname': column(self.groups),
+            'fileinodes': column(self.inodes),
+            'filedevices': zeros,
+            'filelangs': [""] * count,
+        }
 
 class RPMDep(object):
     RE_VERSIONED = re.compile(r'^(?P<name>.*?)\s*(?P<cmp>=|>=|<=|>|<)\s*(?P<version>\d.*?)$')
@@ -310,9 +398,11 @@ class RPMDep(object):
         self.version = version
         self.flags = flags
 
-class RPMBuild(object):
-    def __init__(self, job, *, dest, dest_dir, provides, requires, conflicts, obsoletes, header, **params):
+class RPMBuild(ExportWriter):
+    def __init__(self, job, *, dest, dest_dir, provides, requires, conflicts, obsoletes, header,
+                 compress_threads=None, **params):
         self.__dict__.update(params)
+        self.compress_threads = compress_threads
 
         if not header:
             header = {}
@@ -335,7 +425,7 @@ class RPMBuild(object):
 
         if self.compress_type == "gzip":
             self.payload_flags = self.compress_level = 9
-            self.compressor = lambda f: gzip.GzipFile(filename='', fileobj=f, compresslevel=self.compress_level)
+            self.compressor = lambda f: CompressWriter(f, "gzip", self.compress_level, self.compress_threads)
         elif self.compress_type == "bzip2":
             if bz2 is None:
                 raise RuntimeError("bzip2 compression not available")
@@ -382,9 +472,6 @@ class RPMBuild(object):
         else:
             self.dest = dest
 
-        if not self.paths:
-            raise RuntimeError("Need path")
-
         self._add_to_header("name", self.name)
         self._add_to_header("epoch", self.epoch)
         self._add_to_header("url", self.url)
@@ -400,10 +487,7 @@ class RPMBuild(object):
     def _reset(self):
         self.path_idx = 0
         self.install_size = 0
-        self.files = []
-        self.contents_md5 = hashlib.md5()
-        self.contents_sha1 = hashlib.sha1()
-        self.contents_sha256 = hashlib.sha256()
+        self.files = RPMFileTable()
 
     def _add_to_header(self, name, value, override=False):
         if name in self.header and not override:
@@ -439,7 +523,32 @@ class RPMBuild(object):
         header[versionfield] = versions
         header[flagfield] = flags
 
-    def build(self, job):
+    def open(self):
+        self._reset()
+
+        # Only the compressed payload is spooled: it goes after the
+        # header, which needs the complete file list.
+        self._payload_f = tempfile.TemporaryFile()
+        self._payload_hasher = IOHashWriter(self.payload_digest, self._payload_f)
+        # cpio encoding and file hashing run on the caller's thread, and
+        # compression on another
+        self._payload_comp_f = ThreadedWriter(self.compressor(self._payload_hasher))
+        self._cpiof = TeeBytesWriter(self._payload_comp_f)
+
+    def add(self, ti, data):
+        self._copy_data(self._cpiof, ti, data)
+
+    def close(self, commit=True):
+        try:
+            if commit:
+                self._write_cpio_trailer(self._cpiof)
+                self._payload_comp_f.close()
+                self._write(self._payload_f, self._payload_hasher)
+        finally:
+            self._payload_comp_f.close()
+            self._payload_f.close()
+
+    def _write(self, payload_f, payload_hasher):
         lead = struct.pack(
             "!4sBBhh65sxhh16x",
             # unsigned char magic[4]
@@ -458,80 +567,52 @@ class RPMBuild(object):
             5
         )
 
-        self._reset()
-
-        container = job.create({})
-        with tempfile.TemporaryFile() as contents_f, tempfile.TemporaryFile() as payload_f:
-            payload_hasher = IOHashWriter(self.payload_digest, payload_f)
-            with self.compressor(payload_hasher) as payload_comp_f:
-                writer = TeeBytesWriter(payload_comp_f, contents_f)
-                for ti, tdata in self.paths.iter_container_files(container):
-                    self._copy_data(container, writer, ti, tdata)
-                self._write_cpio_trailer(writer)
-
-            files = sorted(self.files, key=lambda f: f.filename)
-            all_dirnames = sorted(set(f.dirname for f in files))
-            all_dirnames_lookup = {val: idx for idx, val in enumerate(all_dirnames)}
-
-            header = dict(self.header)
-            self._put_deps(header, self.requires, 'requirename', 'requireversion', 'requireflags')
-            self._put_deps(header, self.provides, 'providename', 'provideversion', 'provideflags')
-            self._put_deps(header, self.conflicts, 'conflictname', 'conflictversion', 'conflictflags')
-            self._put_deps(header, self.obsoletes, 'obsoletename', 'obsoleteversion', 'obsoleteflags')
-            header['dirnames'] = all_dirnames
-            header['dirindexes'] = [all_dirnames_lookup[f.dirname] for f in files]
-            header['basenames'] = [f.basename for f in files]
-            header['filesizes'] = [f.size for f in files]
-            header['filemodes'] = [f.mode & 0xffff for f in files]
-            header['filerdevs'] = [f.rdev & 0xffff for f in files]
-            header['filemtimes'] = [f.mtime for f in files]
-            header['filemd5s'] = [f.md5.hexdigest() if f.md5 is not None else '' for f in files]
-            header['filelinktos'] = [(f.linkto or "") for f in files]
-            header['fileflags'] = [f.flags for f in files]
-            header['fileusername'] = [f.user for f in files]
-            header['filegroupname'] = [f.group for f in files]
-            header['fileinodes'] = [f.inode for f in files]
-            header['filedevices'] = [f.device for f in files]
-            header['filelangs'] = [f.lang for f in files]
-            header['size'] = self.install_size
-            header['payloadformat'] = "cpio"
-            header['payloadcompressor'] = self.compress_type
-            header['payloadflags'] = self.payload_flags
-            header['payloaddigestalgo'] = self.payload_digest_id
-            header['payloaddigest'] = [payload_hasher.hexdigest()]
-
-            rpm_header = make_rpm_header(header, immutable_tag='header_immutable')
-
-            self.contents_md5.update(rpm_header)
-            self.contents_sha1.update(rpm_header)
-            self.contents_sha256.update(rpm_header)
-
-            contents_f.seek(0)
-            while True:
-                chunk = contents_f.read(2**14)
-                if not chunk:
-                    break
-                self.contents_md5.update(chunk)
-
-            sig_header = make_rpm_header({
-                'sig_size': contents_f.tell() + len(rpm_header),
-                'sig_md5': self.contents_md5.digest(),
-                'sig_sha1': self.contents_sha1.hexdigest(),
-                'sig_sha256': self.contents_sha256.hexdigest()
+        header = dict(self.header)
+        self._put_deps(header, self.requires, 'requirename', 'requireversion', 'requireflags')
+        self._put_deps(header, self.provides, 'providename', 'provideversion', 'provideflags')
+        self._put_deps(header, self.conflicts, 'conflictname', 'conflictversion', 'conflictflags')
+        self._put_deps(header, self.obsoletes, 'obsoletename', 'obsoleteversion', 'obsoleteflags')
+        header.update(self.files.header())
+        header['size'] = self.install_size
+        header['payloadformat'] = "cpio"
+        header['payloadcompressor'] = self.compress_type
+        header['payloadflags'] = self.payload_flags
+        header['payloaddigestalgo'] = self.payload_digest_id
+        header['payloaddigest'] = [payload_hasher.hexdigest()]
+
+        rpm_header = make_rpm_header(header, immutable_tag='header_immutable')
+
+        # The signature covers the header and the compressed payload.  Its
+        # size doesn't depend on the values, so it is written last, over a
+        # placeholder, once the payload has been hashed on its way out.
+        def sig_header(size, md5):
+            return make_rpm_header({
+                'sig_size': size,
+                'sig_md5': md5,
+                'sig_sha1': hashlib.sha1(rpm_header).hexdigest(),
+                'sig_sha256': hashlib.sha256(rpm_header).hexdigest()
             }, immutable_tag='header_signatures')
 
-            with open_output(self.dest, "wb") as f:
-                f.write(lead)
+        with open_output(self.dest, "wb") as f:
+            f.write(lead)
 
-                f.write(sig_header)
-                f.write(_align_padding(f.tell(), 8))
+            sig_offset = f.tell()
+            placeholder = sig_header(0, bytes(16))
+            f.write(placeholder)
+            f.write(_align_padding(f.tell(), 8))
 
-                f.write(rpm_header)
+            f.write(rpm_header)
 
-                payload_f.seek(0)
-                shutil.copyfileobj(payload_f, f)
+            md5 = hashlib.md5(rpm_header)
+            payload_f.seek(0)
+            payload_size = copy_fileobj(payload_f, f, update=md5.update)
 
-    def _copy_data(self, container, cpiof, ti, tdata):
+            sig = sig_header(len(rpm_header) + payload_size, md5.digest())
+            assert len(sig) == len(placeholder)
+            f.seek(sig_offset)
+            f.write(sig)
+
+    def _copy_data(self, cpiof, ti, tdata):
         self.path_idx += 1
         nlink = (2 if ti.isdir() else 1)
 
@@ -577,31 +658,26 @@ class RPMBuild(object):
         cpiof.write(_align_padding(cpiof.tell(), 4))
 
         # cpio contents
-        md5hash = None
+        md5 = ""
         if tdata is not None:
             md5hash = hashlib.md5()
-            while True:
-                chunk = tdata.read(2**14)
-                if not chunk:
-                    break
-                self.install_size += len(chunk)
-                md5hash.update(chunk)
-                cpiof.write(chunk)
+            self.install_size += copy_fileobj(tdata, cpiof, min(max(size, 1), COPY_CHUNK_SIZE),
+                                              update=md5hash.update)
+            md5 = md5hash.hexdigest()
 
         cpiof.write(_align_padding(cpiof.tell(), 4))
 
-        self.files.append(RPMFileItem(
+        self.files.add(
             filename,
             size=size,
             mode=ti.mode,
             mtime=ti.mtime,
-            md5=md5hash,
-            nlink=nlink,
+            md5=md5,
             linkto=ti.linkname,
             user=user,
             group=group,
             inode=self.path_idx,
-        ))
+        )
 
     def _write_cpio_trailer(self, cpiof):
         cpiof.write(
@@ -630,6 +706,8 @@ class TaskExportRpm(Task, name="export-rpm"):
         obsoletes = TaskVar(help='A list of packages this package obsoletes')
         header = TaskVar(type=dict, help='Additional rpm fields to provide manually')
         compress_type = TaskVar(default="bzip2", help='The compression to use for the package contents')
+        compress_threads = TaskVar(type=int, help="Compress a gzip payload in blocks on this many threads, "
+                                   "or 0 for one per CPU.  Other compression types use one thread.")
         dest = TaskVar(help="The destination file name to use for the package.  If not provided "
                        "it will be automatically be determined from the `dest_dir` and version values.", type=LocalPath)
         dest_dir = TaskVar(default=".", type=LocalPath,
@@ -638,9 +716,7 @@ class TaskExportRpm(Task, name="export-rpm"):
         paths = TaskVar(help="List of paths to include in package", type=TarGlobList)
 
     def run_with_values(self, job, **params):
-        build = RPMBuild(job, **params)
-
-        if os.path.exists(build.dest) and not job.changes:
-            return
+        if not params["paths"]:
+            raise RuntimeError("Need path")
 
-        build.build(job)
+        run_export(job, params["paths"], [RPMBuild.from_values(job, params)])
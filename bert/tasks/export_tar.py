@@ -4,7 +4,8 @@ import re
 import tarfile
 
 from . import Task, TaskVar
-from ..utils import TarGlobList, expect_file_mode, open_output, LocalPath
+from ..export import ExportWriter, run_export
+from ..utils import TarGlobList, expect_file_mode, open_output, LocalPath, CompressWriter, TAR_COMPRESS_TYPES
 
 RE_COMPRESS_EXT = re.compile(r'\.(bz2|xz|gz)$')
 
@@ -24,34 +25,75 @@ class TaskExportTar(Task, name="export-tar"):
         compress_type = TaskVar(help="The compression type to use for the tar file. "
                                 "If not specified, the compression type will be inferred from "
                                 "the destination file name.")
+        compress_level = TaskVar(type=int, help="The compression level, 1 (fastest) to 9 (smallest)")
+        compress_threads = TaskVar(type=int, help="Compress gz or xz in blocks on this many threads, "
+                                   "or 0 for one per CPU.  The blocks are written as concatenated gzip "
+                                   "members or blocks of one xz stream, which compress slightly worse.")
         mode = TaskVar(type=expect_file_mode, help="The unix file mode to use for the tar file.")
         paths = TaskVar(help="List of paths to include in tar file", type=TarGlobList)
 
-    def run_with_values(self, job, *, dest, preamble, preamble_encoding, compress_type, mode, paths):
+    def run_with_values(self, job, *, paths, **kwargs):
+        run_export(job, paths, [TarWriter.from_values(job, kwargs)])
+
+class TarWriter(ExportWriter):
+    def __init__(self, job, *, dest, preamble, preamble_encoding, compress_type, mode, paths=None,
+                 compress_level=None, compress_threads=None):
         if hasattr(dest, "__fspath__"):
             dest = dest.__fspath__()
-
-        if os.path.exists(dest) and not job.changes:
-            return
+        self.dest = dest
 
         if compress_type is None:
             m = RE_COMPRESS_EXT.search(dest)
             if m:
                 compress_type = m.group(1)
-        if not compress_type:
-            compress_type = ""
-
-        with open_output(dest, "wb") as f:
-            if preamble:
-                if isinstance(preamble, bytes):
-                    f.write(preamble)
-                else:
-                    f.write(preamble.encode(preamble_encoding))
-
-            container = job.create({})
-            with tarfile.open(fileobj=f, mode="w|"+compress_type) as tout:
-                for ti, tdata in paths.iter_container_files(container):
-                    tout.addfile(ti, tdata)
-
-            if mode is not None:
-                os.fchmod(f.fileno(), mode)
+        self.compress_type = compress_type or ""
+        self.compress_level = compress_level
+        self.compress_threads = compress_threads
+
+        self.preamble = preamble
+        if preamble and not isinstance(preamble, bytes):
+            self.preamble = preamble.encode(preamble_encoding)
+        self.mode = mode
+
+        self._output = None
+        self._f = None
+        self._comp = None
+        self._tout = None
+
+    def open(self):
+        self._output = open_output(self.dest, "wb")
+        self._f = self._output.__enter__()
+        if self.preamble:
+            self._f.write(self.preamble)
+        if self.compress_type in TAR_COMPRESS_TYPES:
+            self._comp = CompressWriter(self._f, TAR_COMPRESS_TYPES[self.compress_type],
+                                        self.compress_level, self.compress_threads)
+            self._tout = tarfile.open(fileobj=self._comp, mode="w|")
+        else:
+            self._tout = tarfile.open(fileobj=self._f, mode="w|"+self.compress_type)
+
+    def add(self, ti, data):
+        self._tout.addfile(ti, data)
+
+    def close(self, commit=True):
+        try:
+            if commit:
+                self._tout.close()
+                if self._comp is not None:
+                    self._comp.close()
+                if self.mode is not None:
+                    os.fchmod(self._f.fileno(), self.mode)
+        except BaseException:
+            commit = False
+            raise
+        finally:
+            if not commit:
+                # finish the tar stream into the output being dropped,
+                # rather than when it is garbage collected
+                try:
+                    self._tout.close()
+                except Exception:
+                    pass
+            if self._comp is not None:
+                self._comp.close(commit=False)
+            self._output.close(commit)
@@ -1,15 +1,43 @@
 
-import hashlib
 import json
+import os
+import posixpath
+import tarfile
+
 import requests
-import tempfile
 
-from . import Task, TaskVar
-from ..utils import LocalPath
+from . import Task, TaskVar, TaskFailed
+from ..prefetch import PrefetchItem
+from ..utils import expect_file_mode, iter_tar_stream
+from ..utils.download import DownloadCache, parse_checksum
+
+class FetchPrefetch(PrefetchItem):
+    def __init__(self, url, params, checksum):
+        self.url = url
+        self.params = params
+        self.checksum = checksum
+        self.key = ("fetch", url, json.dumps(params, sort_keys=True))
+
+    def __str__(self):
+        return "url {}".format(self.url)
+
+    def run(self, prefetcher):
+        checksum = self.checksum
+        lock = prefetcher.build.lock
+        if checksum is None and lock is not None:
+            checksum = lock.fetch_checksum(self.url, self.params)
+        DownloadCache(prefetcher.settings.cache_dir).fetch(self.url, params=self.params, checksum=checksum)
+
+    def lock(self, prefetcher, lockfile):
+        _, sha256 = DownloadCache(prefetcher.settings.cache_dir).fetch(self.url, params=self.params)
+        lockfile.set_fetch_checksum(self.url, self.params, "sha256:" + sha256)
 
 class TaskFetch(Task, name="fetch"):
     """
     Fetch a value from a url and save as a file in the image or variable.
+
+    Downloads are kept in a local cache and revalidated with the server's
+    ETag or Last-Modified, so unchanged content is not downloaded again.
     """
 
     class Schema(object):
@@ -20,47 +48,73 @@ class TaskFetch(Task, name="fetch"):
         json = TaskVar(default=False,
                        help="If set, destination variable will "
                        "be set with response converted from json")
-        dest = TaskVar(help="Destination file to put output in", type=LocalPath)
+        dest = TaskVar(help="Destination file in the image to put output in")
+        mode = TaskVar(type=expect_file_mode, help="The unix file mode for dest (default u=rw,g=r,o=r)")
+        checksum = TaskVar(help="Expected digest of the content, as sha256:<hex>.  If content "
+                           "with this digest is already cached, the url is not fetched at all.  "
+                           "Defaults to the digest recorded in bert.lock, if any.")
 
-    def run_with_values(self, job, url, params, method, dest_var, dest, **kwargs):
+    def run_with_values(self, job, url, params, method, dest_var, dest, mode, checksum, **kwargs):
         is_json = kwargs.get("json")
-        if method == "GET":
-            call_req = requests.get
-        elif method == "POST":
-            call_req = requests.post
-        else:
+        if method not in ("GET", "POST"):
             raise ValueError("Can't handle method %s" % method)
 
         if dest_var is None and dest is None:
             raise ValueError("No destination given")
 
-        sha256_h = hashlib.new("sha256")
-        with tempfile.TemporaryFile() as tf:
-            with call_req(url, params=params, stream=True) as resp:
-                for chunk in resp.iter_content(chunk_size=None):
-                    sha256_h.update(chunk)
-                    tf.write(chunk)
+        if checksum is None and method == "GET" and job.lock is not None:
+            checksum = job.lock.fetch_checksum(url, params)
+        _, want_sha256 = parse_checksum(checksum)
+
+        def download():
+            cache = DownloadCache(job.cache_dir)
+            try:
+                blob_path, sha256 = cache.fetch(url, params=params, method=method, checksum=checksum)
+            except requests.RequestException as exc:
+                raise TaskFailed("Fetching %s failed: %s" % (url, exc))
+
+            if want_sha256 is not None and sha256 != want_sha256:
+                raise TaskFailed("Checksum mismatch for %s: expected sha256:%s, got sha256:%s" % (
+                    url, want_sha256, sha256
+                ))
+            return blob_path, sha256
+
+        blob_path = None
+        if dest_var is not None or want_sha256 is None:
+            blob_path, sha256 = download()
+        else:
+            # The key is known up front, so a cache hit needs no download
+            sha256 = want_sha256
+
+        if dest_var is not None:
+            with open(blob_path, "rb") as f:
+                var_val = f.read().decode('utf-8')
+            if is_json:
+                var_val = json.loads(var_val)
+            job.set_var(dest_var, var_val)
 
-            if dest_var is not None:
-                tf.seek(0)
+        if dest is not None:
+            dest = posixpath.join(job.work_dir, dest)
+            if mode is None:
+                mode = 0o644
 
-                var_val = tf.read().decode('utf-8')
-                if is_json:
-                    var_val = json.loads(var_val)
-                job.set_var(dest_var, var_val)
+            job.create({
+                'file_sha256': sha256,
+                'dest': dest,
+                'mode': mode,
+            })
 
-            # XXX dest is not well tested
-            if dest is not None:
-                tf.seek(0)
+            if blob_path is None:
+                blob_path, _ = download()
 
-                container = job.create({
-                    'file_sha256': sha256_h.hexdigest(),
-                    'dest': dest
-                })
+            info = tarfile.TarInfo(dest.lstrip("/"))
+            info.mode = mode
+            info.size = os.path.getsize(blob_path)
+            job.put_archive("/", iter_tar_stream([(info, lambda: open(blob_path, "rb"))]))
 
-                container.put_archive(
-                    path=dest,
-                    data=tf
-                )
+            job.commit()
 
-                job.commit()
+    def iter_prefetch(self):
+        values = self.static_values()
+        if values and values.get("url") and values["method"] == "GET":
+            yield FetchPrefetch(values["url"], values["params"], values["checksum"])
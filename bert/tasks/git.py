@@ -1,14 +1,22 @@
 
 import hashlib
 import os
+import posixpath
 import re
+import shutil
 import subprocess
-import tarfile
 import tempfile
 
-from . import Task, TaskVar
+from . import Task, TaskVar, TaskFailed
+from ..prefetch import PrefetchItem
+from ..utils import iter_file_chunks, lock_file, open_output
 
 RE_CACHE_SUB = re.compile(r'[^-_.A-Za-z0-9]+')
+RE_FULL_COMMIT = re.compile(r'^([0-9a-f]{40}|[0-9a-f]{64})$')
+RE_SHORT_COMMIT = re.compile(r'^[0-9a-f]{7,63}$')
+# Turns off export-ignore and export-subst from the archived tree's
+# .gitattributes, so git archive gives the same files as a checkout
+ARCHIVE_ATTRIBUTES = "* -export-ignore -export-subst\n"
 
 def make_cache_key(path):
     prefix = hashlib.sha256(path.encode('utf-8')).hexdigest()
@@ -17,92 +25,294 @@ def make_cache_key(path):
         return "{}-{}".format(prefix, suffix)
     return prefix
 
-class GitRun(object):
-    def __init__(self, job, *, repo, dest, ref):
-        self.job = job
+def _ls_remote_pick(refs, ref):
+    """Pick the commit for `ref` out of ls-remote output, like git would"""
+    for name in ("refs/tags/%s^{}" % ref, "refs/tags/%s" % ref, "refs/heads/%s" % ref, ref):
+        commit = refs.get(name)
+        if commit is not None:
+            return commit
+    return None
+
+class GitCache(object):
+    """
+    A local cache of one remote repository: a shared bare object store,
+    plus immutable per-commit checkouts.
+    """
+
+    def __init__(self, cache_dir, repo):
         self.repo = repo
-        self.path = dest
-        self.ref = ref
 
-        self.src_path = os.path.join(job.cache_dir, make_cache_key(self.repo))
+        cache_key = make_cache_key(repo)
+        self.bare_path = os.path.join(cache_dir, "git", cache_key + ".git")
+        self.checkouts_path = os.path.join(cache_dir, "git", cache_key + ".checkouts")
 
-    def run(self):
-        commit = self.run_git()
+    def lock(self, shared=False):
+        """
+        Lock the bare repository.  Fetches take the lock exclusively, and
+        readers share it, so concurrent builds can use the same cache.
+        """
+        return lock_file(self.bare_path + ".lock", shared=shared)
 
-        container = self.job.create({
-            'path': self.path,
-            'commit': commit,
-        })
+    def _git(self, *args, **kwargs):
+        return subprocess.check_call(["git"] + list(args), cwd=self.bare_path, **kwargs)
 
-        with tempfile.TemporaryFile() as tf:
-            with tarfile.open(fileobj=tf, mode="w") as tar:
-                self.job.tarfile_add(tar, self.src_path, arcname=self.path)
-            tf.seek(0)
+    def _git_ok(self, *args):
+        return subprocess.call(["git"] + list(args), cwd=self.bare_path,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
 
-            container.put_archive(
-                path="/",
-                data=tf
-            )
+    def _git_output(self, *args):
+        return subprocess.check_output(["git"] + list(args), cwd=self.bare_path).decode('utf-8')
 
-        self.job.commit()
+    def init_cache(self):
+        if not os.path.isdir(self.bare_path):
+            os.makedirs(os.path.dirname(self.bare_path), exist_ok=True)
+            subprocess.check_call(["git", "init", "-q", "--bare", self.bare_path])
 
-    def have_static_ref(self, dest, ref):
+    def have_commit(self, commit):
+        return self._git_ok("cat-file", "-e", commit + "^{commit}")
+
+    def _local_commit(self, ref):
+        with self.lock(shared=True):
+            if not os.path.isdir(self.bare_path):
+                return None
+            try:
+                return self._git_output("rev-parse", "-q", "--verify", ref + "^{commit}").strip()
+            except subprocess.CalledProcessError:
+                return None
+
+    def resolve(self, ref):
         """
-        Determine is a reference is a tag or commit hash which
-        should not change.
+        Resolve the ref to a commit hash, without fetching any objects
+        when possible.  Commit hashes are resolved locally once the
+        commit is cached, while branches and tags are always looked up
+        on the remote, as they may have moved.
         """
-        if subprocess.call(["git", "show-ref", "-q", "--verify", "refs/tags/"+ref], cwd=dest) == 0:
-            return True
-        if subprocess.call(["git", "rev-parse", "-q", "--verify", ref+"^{commit}"], cwd=dest) == 0:
-            return True
-        return False
+        if RE_FULL_COMMIT.match(ref):
+            return ref
+        if RE_SHORT_COMMIT.match(ref):
+            commit = self._local_commit(ref)
+            if commit is not None:
+                return commit
 
-    def run_git(self, dest=None):
-        have_fetch_head = True
+        try:
+            # ls-remote only shows what an annotated tag points at when
+            # asked for the peeled ref as well
+            output = subprocess.check_output(["git", "ls-remote", self.repo, ref, ref + "^{}"]).decode('utf-8')
+        except subprocess.CalledProcessError as exc:
+            raise TaskFailed("Unable to list refs for %s" % self.repo) from exc
 
-        if dest is None:
-            dest = self.src_path
+        refs = {}
+        for line in output.splitlines():
+            commit, _, name = line.partition("\t")
+            refs[name] = commit
 
-        if not os.path.isdir(dest):
-            subprocess.check_call(["git", "clone", self.repo, dest])
+        commit = _ls_remote_pick(refs, ref)
+        if commit is not None:
+            return commit
 
-        if self.have_static_ref(dest, self.ref):
-            have_fetch_head = False
-        else:
+        # Maybe an abbreviated commit hash, which the remote can't tell us about
+        with self.lock():
+            self.init_cache()
+            if not self._git_ok("rev-parse", "-q", "--verify", ref + "^{commit}"):
+                self._fetch_all()
             try:
-                subprocess.check_call(["git", "fetch", self.repo, "--tags", self.ref], cwd=dest)
-            except subprocess.CalledProcessError:
-                have_fetch_head = False
-                # Some git repos forbit fetching via a commit hash, so retry
-                # with everything
-                print("Warning: fetching %s directly failed" % (self.ref, ))
-                subprocess.check_call(["git", "fetch", self.repo], cwd=dest)
+                return self._git_output("rev-parse", "-q", "--verify", ref + "^{commit}").strip()
+            except subprocess.CalledProcessError as exc:
+                raise TaskFailed("Unable to find %s in %s" % (ref, self.repo)) from exc
+
+    def fetch(self, commit, ref=None, depth=1):
+        """
+        Make sure `commit` is in the cache, fetching it (or `ref` if the
+        server refuses to fetch commits directly) if needed.
+        """
+        commit_ref = "refs/bert/commits/" + commit
+        with self.lock(shared=True):
+            if os.path.isdir(self.bare_path) and self._git_ok("rev-parse", "-q", "--verify", commit_ref):
+                return
+
+        with self.lock():
+            self.init_cache()
+            # someone else may have fetched it while we waited
+            if not self.have_commit(commit):
+                self._fetch_commit(commit, ref, depth)
 
+            # keep the commit reachable, so gc or later shallow fetches
+            # don't drop it
+            self._git("update-ref", commit_ref, commit)
+
+    def _fetch_commit(self, commit, ref, depth):
+        depth_args = ["--depth=%d" % depth] if depth else []
+
+        # Servers usually allow fetching a commit directly, which is the
+        # cheapest.  Fall back to the ref name, and then to everything.
+        for want in (commit, ref):
+            if want is None:
+                continue
             try:
-                if have_fetch_head:
-                    subprocess.check_call(["git", "checkout", "FETCH_HEAD"], cwd=dest)
+                self._git("fetch", "-q", "--no-tags", *depth_args, self.repo, want)
             except subprocess.CalledProcessError:
-                print("Warning: %s not found at FETCH_HEAD, retrying directly" % (self.ref,))
-                have_fetch_head = False
+                print("Warning: fetching %s directly failed" % (want, ))
+                continue
+            if self.have_commit(commit):
+                return
 
-        if not have_fetch_head:
-            subprocess.check_call(["git", "checkout", self.ref], cwd=dest)
+        self._fetch_all()
+        if not self.have_commit(commit):
+            raise TaskFailed("Commit %s not found in %s" % (commit, self.repo))
 
-        hashval = subprocess.check_output(["git", "log", "-1", "--format=%H"], cwd=dest)
-        return hashval.decode('utf-8').strip()
+    def _fetch_all(self):
+        unshallow = ["--unshallow"] if os.path.exists(os.path.join(self.bare_path, "shallow")) else []
+        self._git("fetch", "-q", *unshallow, self.repo,
+                  "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*")
+
+    def _ensure_archive_attributes(self):
+        path = os.path.join(self.bare_path, "info", "attributes")
+        try:
+            with open(path, "r") as f:
+                if f.read() == ARCHIVE_ATTRIBUTES:
+                    return
+        except FileNotFoundError:
+            pass
+        with open_output(path, "w") as f:
+            f.write(ARCHIVE_ATTRIBUTES)
+
+    def archive(self, commit, prefix, put_archive):
+        """
+        Stream `git archive` of `commit` into the `put_archive` callable.
+        The files are those of a checkout: export-ignore and export-subst
+        attributes are not applied.
+        """
+        with self.lock(shared=True):
+            self._ensure_archive_attributes()
+            proc = subprocess.Popen(
+                ["git", "archive", "--format=tar", "--prefix=" + prefix, commit],
+                cwd=self.bare_path, stdout=subprocess.PIPE
+            )
+            try:
+                put_archive(iter_file_chunks(proc.stdout))
+            finally:
+                proc.stdout.close()
+                rc = proc.wait()
+        if rc != 0:
+            raise TaskFailed("git archive failed", rc=rc)
+
+    def ensure_checkout(self, commit):
+        """
+        Return a checkout of `commit`, with a .git directory holding only
+        the fetched history.  Checkouts are created once per commit and
+        never modified after, so builds can share them.
+        """
+        path = os.path.join(self.checkouts_path, commit)
+        if os.path.isdir(path):
+            return path
+
+        with lock_file(path + ".lock"):
+            if os.path.isdir(path):
+                return path
+
+            tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=self.checkouts_path)
+            try:
+                subprocess.check_call(["git", "init", "-q", tmp_path])
+                with self.lock(shared=True):
+                    subprocess.check_call(["git", "fetch", "-q", "--no-tags", "--update-shallow",
+                                           os.path.abspath(self.bare_path),
+                                           "refs/bert/commits/" + commit], cwd=tmp_path)
+                subprocess.check_call(["git", "checkout", "-q", "--detach", commit], cwd=tmp_path)
+                subprocess.check_call(["git", "remote", "add", "origin", self.repo], cwd=tmp_path)
+                os.rename(tmp_path, path)
+            except BaseException:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise
+
+        return path
+
+class GitPrefetch(PrefetchItem):
+    def __init__(self, repo, ref, depth):
+        self.repo = repo
+        self.ref = ref
+        self.depth = depth
+        self.key = ("git", repo, ref)
+
+    def __str__(self):
+        return "git {}@{}".format(self.repo, self.ref)
+
+    def run(self, prefetcher):
+        cache = GitCache(prefetcher.settings.cache_dir, self.repo)
+        git_ref_cache = prefetcher.build.git_ref_cache
+        commit = git_ref_cache.get((self.repo, self.ref))
+        if commit is None:
+            commit = git_ref_cache[(self.repo, self.ref)] = cache.resolve(self.ref)
+        cache.fetch(commit, self.ref, self.depth)
+
+    def lock(self, prefetcher, lockfile):
+        cache = GitCache(prefetcher.settings.cache_dir, self.repo)
+        lockfile.set_git_commit(self.repo, self.ref, cache.resolve(self.ref))
+
+class GitRun(object):
+    def __init__(self, job, *, repo, dest, ref, git_dir=False, depth=1):
+        self.job = job
+        self.repo = repo
+        self.path = dest if dest is not None else job.work_dir
+        self.ref = ref
+        self.git_dir = git_dir
+        self.depth = depth
+        self.cache = GitCache(job.cache_dir, repo)
+
+    def resolve(self):
+        key = (self.repo, self.ref)
+        commit = self.job.git_ref_cache.get(key)
+        if commit is None:
+            commit = self.job.git_ref_cache[key] = self.cache.resolve(self.ref)
+        return commit
+
+    def run(self):
+        commit = self.resolve()
+
+        # A cache hit leaves create() early, before anything is fetched
+        key = {
+            'path': self.path,
+            'commit': commit,
+        }
+        if self.git_dir:
+            key['git_dir'] = True
+        self.job.create(key)
+
+        self.cache.fetch(commit, self.ref, self.depth)
+        if self.git_dir:
+            checkout = self.cache.ensure_checkout(commit)
+            self.job.put_archive("/", self.job.tar_source(checkout, arcname=self.path).iter_tar())
+        else:
+            prefix = posixpath.join(self.path.strip("/"), "")
+            self.cache.archive(commit, prefix, lambda data: self.job.put_archive("/", data))
+
+        self.job.commit()
 
 class TaskGit(Task, name="git"):
     """
     Add a git checkout to container image.
 
-    Before being added to the image, the git repo contents will be locally cached.
+    The ref is resolved to a commit first, so an unchanged ref needs no fetch
+    at all.  Branches and tags are resolved on the remote on every build,
+    unless pinned in ``bert.lock``; commit hashes need no network once cached.  Otherwise the commit is fetched (shallowly where possible) into
+    a local bare repository cache, and the tree exported with `git archive`.
+    The files are the same as in a checkout; ``export-ignore`` and
+    ``export-subst`` attributes are not applied.
     """
 
     class Schema:
         repo = TaskVar(help="Git repository URL")
         dest = TaskVar('path', help="Destination in container image")
         ref = TaskVar(default="master", help="Branch, tag or commit to checkout at")
+        git_dir = TaskVar(default=False, type=bool,
+                          help="Include the .git directory, as a checkout of only the fetched history")
+        depth = TaskVar(default=1, type=int,
+                        help="History depth to fetch into the cache.  Use 0 to fetch full history.")
 
     def run_with_values(self, job, **kwargs):
         gr = GitRun(job, **kwargs)
         gr.run()
+
+    def iter_prefetch(self):
+        values = self.static_values()
+        if values and values.get("repo"):
+            yield GitPrefetch(values["repo"], values["ref"], values["depth"])
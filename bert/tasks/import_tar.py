@@ -15,15 +15,12 @@ class TaskImportTar(Task, name="import-tar"):
         if dest is None:
             dest = job.work_dir
 
-        container = job.create({
+        job.create({
             'file_sha256': file_hash('sha256', src),
             'dest': dest
         })
 
         with open(src, "rb") as f:
-            container.put_archive(
-                path=dest,
-                data=f
-            )
+            job.put_archive(dest, f)
 
         job.commit()
@@ -1,15 +1,16 @@
 
+import bisect
 import collections
 import os
 import posixpath
-import shutil
-import tarfile
 import tempfile
 
 import whatthepatch
 
 from . import Task, TaskVar
-from ..utils import file_hash, IOFromIterable, LocalPath
+from ..utils import (
+    file_hash, json_hash, open_output, copy_fileobj, iter_container_paths, TarSource, LocalPath
+)
 
 class PatchError(Exception):
     pass
@@ -76,59 +77,87 @@ class PatchedFile(object):
                 fileobj.write("%s%s" % line)
 
     def apply_diff(self, changes):
+        """
+        Apply the hunks of one diff.  Hunks are located in the file as it
+        was before the diff, in order and without overlapping, and then
+        spliced in with a single pass over the lines.
+        """
         if not changes:
             return
 
+        index = None
+        placed = []
+        offset = self.offset_moved
+        min_start = 1
         for hunk in _split_hunks(changes):
-            self.apply_hunk(hunk)
-
-    def apply_hunk(self, hunk):
-        # TODO: Handle lack of context in diff?
-        old_lines = [line.line for line in hunk if line.old is not None]
-        old_start = hunk[0].old + self.offset_moved
-
-        # best case is diff is exactly where we expect it
-        if self._match_at(old_start, old_lines):
-            return self._apply_at(old_start, hunk)
-
-        # text likely moved, so start looking forward and backwards
-        backward_at = forward_at = 0
-        while old_start + forward_at < len(self.lines) or old_start + backward_at > 1:
-            if old_start + forward_at < len(self.lines):
-                forward_at += 1
-                if self._match_at(old_start + forward_at, old_lines):
-                    return self._apply_at(old_start + forward_at, hunk)
-
-            if old_start + backward_at > 1:
-                backward_at -= 1
-                if self._match_at(old_start + backward_at, old_lines):
-                    return self._apply_at(old_start + backward_at, hunk)
+            old_lines = [line.line for line in hunk if line.old is not None]
+            hunk_old = next((line.old for line in hunk if line.old is not None), None)
+            if hunk_old is None:
+                # only additions, there is nothing to match
+                hunk_old = hunk[0].new
+
+            start = hunk_old + offset
+            if start < min_start or not self._match_at(start, old_lines):
+                if index is None:
+                    index = self._line_index()
+                start = self._find_hunk(index, start, old_lines, min_start)
+
+            end = start + len(old_lines)
+            new_lines = [(line.line, self.eol) for line in hunk if line.new is not None]
+            placed.append((start, end, new_lines, hunk_old))
+            offset = start - hunk_old
+            min_start = end
+
+        lines = []
+        prev = 0
+        for start, end, new_lines, hunk_old in placed:
+            lines.extend(self.lines[prev:start])
+            self.offset_moved = len(lines) - hunk_old
+            lines.extend(new_lines)
+            prev = end
+        lines.extend(self.lines[prev:])
+        self.lines = lines
+
+    def _line_index(self):
+        """Map each line's text to the line numbers it appears at, in order"""
+        index = collections.defaultdict(list)
+        for linenum in range(1, len(self.lines)):
+            index[self.lines[linenum][0]].append(linenum)
+        return index
+
+    def _find_hunk(self, index, expected, old_lines, min_start):
+        """
+        Find where `old_lines` are, nearest to the expected line, looking
+        forward first at each distance.
+        """
+        if not old_lines:
+            return max(min(expected, len(self.lines)), min_start)
+
+        candidates = index.get(old_lines[0], ())
+        lo = bisect.bisect_left(candidates, min_start)
+        mid = max(bisect.bisect_left(candidates, expected), lo)
+        forward, backward = mid, mid - 1
+        while forward < len(candidates) or backward >= lo:
+            if backward < lo or (forward < len(candidates) and
+                                 candidates[forward] - expected <= expected - candidates[backward]):
+                pos = candidates[forward]
+                forward += 1
+            else:
+                pos = candidates[backward]
+                backward -= 1
+            if self._match_at(pos, old_lines):
+                return pos
 
         raise PatchError("Patch rejected")
 
     def _match_at(self, lineno_start, lines):
+        if lineno_start < 1 or lineno_start + len(lines) > len(self.lines):
+            return False
         for linenum, line in enumerate(lines, start=lineno_start):
-            try:
-                orig = self.lines[linenum]
-            except IndexError:
-                return False
-
-            if orig[0] != line:
+            if self.lines[linenum][0] != line:
                 return False
         return True
 
-    def _apply_at(self, start, changes):
-        # cut out old lines
-        last = start + sum(1 for line in changes if line.old is not None)
-        self.lines[start:last] = []
-
-        # insert in new lines
-        new_lines = [change for change in changes if change.new is not None]
-        for off, change in enumerate(new_lines):
-            self.lines.insert(start+off, (change.line, self.eol))
-
-        self.offset_moved = start - changes[0].old
-
 class Patch(object):
     def __init__(self, patch, strip_dir=0, chdir=None):
         self.root_dir = None
@@ -178,6 +207,8 @@ class Patch(object):
 
             if file_lookup is not None:
                 fn = file_lookup.get(fn)
+                if fn is None:
+                    raise PatchError("%s does not exist" % fn_orig)
                 fn_adj = True
             if root_dir is not None:
                 fn = os.path.join(root_dir, fn)
@@ -196,13 +227,19 @@ class Patch(object):
             pf.save()
 
 class ContainerPatcher(object):
-    def __init__(self, container, chdir, strip_dir):
+    def __init__(self, container, chdir, strip_dir, job, cache_dir=None):
         self.container = container
+        self.job = job
         self.chdir = chdir
         self.strip_dir = strip_dir
         self.files = {}
         self.file_idx = 0
         self.tempdir = tempfile.TemporaryDirectory()
+        # Archives of patched files, by the digests of the originals and patches
+        self.cache_dir = None if cache_dir is None else os.path.join(cache_dir, "patches")
+        self._result = None
+        self._cached = False
+        self._applied = False
 
     def __enter__(self):
         return self
@@ -213,53 +250,100 @@ class ContainerPatcher(object):
     def cleanup(self):
         self.tempdir.cleanup()
 
-    def _load_file(self, fn):
-        if not os.path.isabs(fn):
-            load_fn = os.path.join(self.chdir, fn)
+    def _container_path(self, fn):
+        return posixpath.normpath(posixpath.join(self.chdir, fn))
+
+    def load_files(self, fns):
+        """
+        Fetch the files to patch from the container, unless they were
+        already fetched (and maybe patched).
+        """
+        wanted = {}
+        for fn in fns:
+            if fn not in self.files:
+                wanted[self._container_path(fn)] = fn
+                # files that don't exist in the container stay None
+                self.files[fn] = None
+
+        for ti, data in iter_container_paths(self.container, wanted):
+            if not ti.isreg():
+                continue
+            out_fn = os.path.join(self.tempdir.name, str(self.file_idx))
+            self.file_idx += 1
+            with open(out_fn, "wb") as fb:
+                copy_fileobj(data, fb)
+            self.files[wanted[ti.name]] = out_fn
+
+    def read_patch(self, fn):
+        with open(os.fspath(fn)) as f:
+            return Patch(f.read(), strip_dir=self.strip_dir)
 
-        tstream, tstat = self.container.get_archive(load_fn)
-        tf = IOFromIterable(tstream)
+    def apply_patch(self, fn):
+        self.apply_patches([fn])
+
+    def _result_key(self, fns, files):
+        return json_hash('sha256', {
+            "files": sorted(
+                [fn, file_hash('sha256', self.files[fn]) if self.files[fn] is not None else None]
+                for fn in files
+            ),
+            "patches": [file_hash('sha256', fn) for fn in fns],
+            "strip_dir": self.strip_dir,
+            "chdir": self.chdir,
+        })
 
-        with tarfile.open(fileobj=tf, mode="r|") as tin:
-            while True:
-                ti = tin.next()
-                if ti is None:
-                    break
+    def apply_patches(self, fns):
+        """
+        Apply patch files in order, fetching every file they touch up
+        front.  With a cache directory, a series already applied to the
+        same original files is not applied again: save() uploads the
+        archive of its results.
+        """
+        patches = [self.read_patch(fn) for fn in fns]
+        files = set().union(*(p.files for p in patches))
+        self.load_files(files)
+
+        if self._cached:
+            raise RuntimeError("Can't apply more patches after a cached series")
+        if self.cache_dir is not None and not self._applied:
+            self._result = os.path.join(self.cache_dir, self._result_key(fns, files) + ".tar")
+            if os.path.exists(self._result):
+                self._cached = True
+                return
+        else:
+            # the results depend on the earlier patches too
+            self._result = None
+        self._applied = True
 
-                fn = os.path.join(os.path.dirname(fn), ti.name)
-                if ti.isreg():
-                    out_fn = os.path.join(self.tempdir.name, str(self.file_idx))
-                    self.file_idx += 1
+        for p in patches:
+            p.apply(file_lookup=self.files)
 
-                    with open(out_fn, "wb") as fb:
-                        shutil.copyfileobj(tin.extractfile(ti), fb)
-                    self.files[fn] = out_fn
-                else:
-                    self.files[fn] = None
+    def save(self):
+        if self._cached:
+            with open(self._result, "rb") as f:
+                self._put_archive(f)
+            return
 
-    def apply_patch(self, fn):
-        fn = os.fspath(fn)
-        with open(fn) as f:
-            p = Patch(f.read(), strip_dir=self.strip_dir)
+        source = TarSource()
+        for fn, fp in self.files.items():
+            if fp is None:
+                continue
+            if not os.path.isabs(fn):
+                fn = os.path.join(self.chdir, fn)
+            source.add_path(fp, arcname=fn, recursive=False)
 
-        for fn in p.files:
-            self._load_file(fn)
+        if self._result is None:
+            self._put_archive(source.iter_tar())
+            return
 
-        p.apply(file_lookup=self.files)
+        with open_output(self._result, "wb") as f:
+            for chunk in source.iter_tar():
+                f.write(chunk)
+        with open(self._result, "rb") as f:
+            self._put_archive(f)
 
-    def save(self):
-        with tempfile.TemporaryFile() as tf:
-            with tarfile.open(fileobj=tf, mode="w") as tar:
-                for fn, fp in self.files.items():
-                    if not os.path.isabs(fn):
-                        fn = os.path.join(self.chdir, fn)
-                    tar.add(fp, arcname=fn)
-            tf.seek(0)
-
-            self.container.put_archive(
-                path="/",
-                data=tf
-            )
+    def _put_archive(self, data):
+        self.job.put_archive("/", data, container=self.container)
 
 class TaskPatch(Task, name="patch"):
     class Schema:
@@ -279,9 +363,10 @@ class TaskPatch(Task, name="patch"):
             'strip_dir': strip_dir
         })
 
-        with ContainerPatcher(container, chdir=chdir, strip_dir=strip_dir) as patcher:
-            for fn in patch_files:
-                patcher.apply_patch(fn)
+        cache_dir = job.cache_dir if job.settings.patch_cache else None
+        with ContainerPatcher(container, chdir=chdir, strip_dir=strip_dir, job=job,
+                              cache_dir=cache_dir) as patcher:
+            patcher.apply_patches(patch_files)
             patcher.save()
 
         job.commit()
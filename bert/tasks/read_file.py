@@ -1,34 +1,126 @@
 
-import tarfile
-import tempfile
+import contextlib
+import json
+import os
+import posixpath
 
 from . import Task, TaskVar
+from ..exc import BuildFailed, ConfigFailed
+from ..utils import iter_container_paths, json_hash, open_output
+
+# Largest file read into a variable, unless max-size says otherwise
+READ_FILE_MAX_SIZE = 2**20
+# Symlinks followed for one path, like the kernel's limit
+READ_FILE_MAX_LINKS = 40
 
 class TaskReadFile(Task, name="read-file"):
     """
-    Read contents of a file in the image into a variable.
+    Read contents of files in the image into variables.
+
+    Values read from an image are kept in the cache directory, so reading
+    the same files from the same image again doesn't need a container.
+    Symlinks are followed within the image.
+
+    Example::
+
+        - read-file:
+            paths:
+              os_release: /etc/os-release
+              app_version: /opt/app/VERSION
     """
 
     class Schema:
         path = TaskVar(help="Container file path to read data from")
         var = TaskVar(help="Destination variable name to write file contents to")
+        paths = TaskVar(type=dict, help="Mapping of variable names to container file paths, "
+                        "all read with one container")
+        max_size = TaskVar(default=READ_FILE_MAX_SIZE, type=int,
+                           help="Fail if a file is larger than this many bytes")
+
+    def run_with_values(self, job, *, var, path, paths, max_size):
+        targets = dict(paths or {})
+        if var is not None or path is not None:
+            if var is None or path is None:
+                raise ConfigFailed("read-file needs both var and path", element=self.value)
+            targets[var] = path
+        if not targets:
+            raise ConfigFailed("read-file needs var and path, or paths", element=self.value)
+        targets = {name: posixpath.normpath(posixpath.join("/", p)) for name, p in targets.items()}
+
+        # The values become variables, so they must not come from a base
+        # image a deferred pull is about to replace.
+        job.pull_pending()
+        cache_path = os.path.join(job.cache_dir, "read-file", json_hash('sha256', [
+            job.current_image_id(), targets, max_size
+        ]) + ".json")
+        try:
+            with open(cache_path, "r") as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            values = None
+
+        if values is None:
+            container = job.create({})
+            try:
+                values = self._read(container, targets, max_size)
+            finally:
+                job.cancel()
 
-    def run_with_values(self, job, *, var, path):
-        container = job.create({})
+            with open_output(cache_path, "w") as f:
+                json.dump(values, f)
+        else:
+            job.display.echo("--- Read from cache")
 
-        with tempfile.TemporaryFile() as tf:
-            tstream, tstat = container.get_archive(path)
-            for chunk in tstream:
-                tf.write(chunk)
-            tf.seek(0)
+        for name, value in values.items():
+            job.set_var(name, value)
 
-            with tarfile.open(fileobj=tf, mode="r") as tar:
-                for item in tar.members:
-                    data = tar.extractfile(item).read().decode('utf-8')
-                    if data.endswith("\n"):
-                        data = data[:-1]
+    def _read(self, container, targets, max_size):
+        data = {}
+        links = {}
+        wanted = set(targets.values())
+        for _ in range(READ_FILE_MAX_LINKS + 1):
+            if not wanted:
+                break
+            wanted = self._read_paths(container, wanted, max_size, data, links)
 
-                    job.set_var(var, data)
+        values = {}
+        for name, path in targets.items():
+            found = path
+            for _ in range(READ_FILE_MAX_LINKS):
+                if found not in links:
                     break
+                found = links[found]
+            else:
+                raise BuildFailed("read-file: {}: too many levels of symbolic links".format(path))
+            if found not in data:
+                raise BuildFailed("read-file: {} does not exist".format(path))
+            value = data[found]
+            if value.endswith("\n"):
+                value = value[:-1]
+            values[name] = value
+        return values
 
-        job.cancel()
+    def _read_paths(self, container, paths, max_size, data, links):
+        """
+        Read `paths` into `data`, and the targets of symlinks among them
+        into `links`.  Returns the link targets still to be read.
+        """
+        wanted = set()
+        # Files over the spool size are streamed rather than read ahead,
+        # so a file that is too large fails before its data is read.
+        with contextlib.closing(iter_container_paths(container, paths)) as items:
+            for ti, fileobj in items:
+                if ti.issym():
+                    target = posixpath.normpath(posixpath.join(posixpath.dirname(ti.name), ti.linkname))
+                    links[ti.name] = target
+                    if target not in data and target not in links:
+                        wanted.add(target)
+                    continue
+                if fileobj is None:
+                    raise BuildFailed("read-file: {} is not a regular file".format(ti.name))
+                if ti.size > max_size:
+                    raise BuildFailed("read-file: {} is {} bytes, more than max-size {}".format(
+                        ti.name, ti.size, max_size
+                    ))
+                data[ti.name] = fileobj.read().decode('utf-8')
+        return wanted
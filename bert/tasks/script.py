@@ -3,10 +3,9 @@ import io
 import os
 import shlex
 import tarfile
-import tempfile
 
 from . import Task, TaskVar
-from ..utils import file_hash, value_hash, LocalPath
+from ..utils import file_hash, value_hash, iter_tar_stream, LocalPath
 
 class TaskScript(Task, name="script"):
     """
@@ -49,17 +48,16 @@ class TaskScript(Task, name="script"):
             self._run(job, self._job_key(
                 value=script_job_value,
                 file_sha256=content_hash
-            ), script_info, io.BytesIO(contents_bytes), script_name, script_args)
+            ), script_info, lambda: io.BytesIO(contents_bytes), script_name, script_args)
         else:
             script_info = tarfile.TarInfo(name=script_name)
             script_info.mode = 0o755
             script_info.size = os.path.getsize(script[0])
 
-            with open(script[0], "rb") as script_fileobj:
-                self._run(job, self._job_key(
-                    value=script_job_value,
-                    file_sha256=file_hash('sha256', script[0])
-                ), script_info, script_fileobj, script_name, script_args)
+            self._run(job, self._job_key(
+                value=script_job_value,
+                file_sha256=file_hash('sha256', script[0])
+            ), script_info, lambda: open(script[0], "rb"), script_name, script_args)
 
     def _job_key(self, *, value, file_sha256):
         return {
@@ -67,19 +65,11 @@ class TaskScript(Task, name="script"):
             'file_sha256': file_sha256,
         }
 
-    def _run(self, job, job_json, script_info, script_fileobj, script_name, args):
+    def _run(self, job, job_json, script_info, script_opener, script_name, args):
         # TODO XXX Remove the script after it runs.  Unfortunately we
         # don't want to assume rm exists, so this is more difficult
         # (push a script wrapper binary perhaps?)
-        container = job.create(job_json, command=[script_name] + args)
-        with tempfile.TemporaryFile() as tf:
-            with tarfile.open(fileobj=tf, mode="w") as tar:
-                tar.addfile(script_info, fileobj=script_fileobj)
-            tf.seek(0)
-
-            container.put_archive(
-                path="/",
-                data=tf
-            )
+        job.create(job_json, command=[script_name] + args)
+        job.put_archive("/", iter_tar_stream([(script_info, script_opener)]))
 
         job.commit()
@@ -1,12 +1,25 @@
 
 from .common import (  # noqa: F401
-    decode_bin, open_output, expect_file_mode, json_hash,
-    file_hash, value_hash, IOHashWriter, TeeBytesWriter,
-    IOFromIterable
+    decode_bin, open_output, lock_file, expect_file_mode, json_hash,
+    value_hash, IOHashWriter, TeeBytesWriter, ThreadedWriter,
+    IOFromIterable, open_iterable, copy_fileobj, COPY_CHUNK_SIZE
+)
+from .archive import (  # noqa: F401
+    iter_archives, iter_container_paths
+)
+from .compress import (  # noqa: F401
+    COMPRESS_TYPES, TAR_COMPRESS_TYPES, CompressWriter, is_compressed,
+    iter_compressed, iter_file_chunks
+)
+from .hashing import (  # noqa: F401
+    file_hash, hash_files, walk_tree, CONTENT_HASH
 )
 from .paths import (  # noqa: F401
     LocalPath
 )
+from .tarsource import (  # noqa: F401
+    TarSource, iter_tar_stream
+)
 from .targlob import (  # noqa: F401
     TarGlobList, TarGlob
 )
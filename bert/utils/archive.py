@@ -0,0 +1,246 @@
+
+import collections
+import concurrent.futures
+import functools
+import io
+import posixpath
+import queue
+import tarfile
+import threading
+
+import docker
+
+from .common import COPY_CHUNK_SIZE, open_iterable
+
+# Archives read at once
+ARCHIVE_WORKERS = 4
+# Members decoded ahead of the consumer, per archive
+ARCHIVE_QUEUE_SIZE = 32
+# Member data held ahead of the consumer, per archive
+ARCHIVE_QUEUE_BYTES = 2**23
+# Member data up to this size is read ahead into memory.  Larger members
+# are streamed to the consumer straight from the archive.
+ARCHIVE_SPOOL_SIZE = 2**20
+
+_END = object()
+
+class _Failed(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+class _Cancelled(Exception):
+    pass
+
+def _close_item(item):
+    if isinstance(item, tuple) and item[1] is not None:
+        item[1].close()
+
+class _MemberStream(io.RawIOBase):
+    """
+    Data of one large member, handed over chunk by chunk from the thread
+    reading the archive while the consumer reads it.
+    """
+
+    def __init__(self, stop):
+        self._stop = stop
+        self._chunks = queue.Queue(4)
+        self._current = b""
+        self._pos = 0
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self._pos >= len(self._current):
+            if self._done:
+                return 0
+            item = self._chunks.get()
+            if item is _END:
+                self._done = True
+                return 0
+            if isinstance(item, _Failed):
+                self._done = True
+                raise item.exc
+            self._current, self._pos = item, 0
+
+        n = min(len(buf), len(self._current) - self._pos)
+        buf[:n] = self._current[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def _put(self, item):
+        while not self.closed:
+            if self._stop.is_set():
+                raise _Cancelled()
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed(self, fileobj):
+        """Hand over the data of `fileobj`, until it ends or the consumer closes"""
+        try:
+            while True:
+                chunk = fileobj.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if not self._put(chunk):
+                    return
+        except _Cancelled:
+            raise
+        except BaseException as exc:
+            self._put(_Failed(exc))
+            raise
+        self._put(_END)
+
+class _ArchiveReader(object):
+    def __init__(self, source, queue_size, queue_bytes, stop):
+        self.source = source
+        self.queue_size = queue_size
+        self.queue_bytes = queue_bytes
+        self.stop = stop
+        self._items = collections.deque()
+        self._bytes = 0
+        self._cond = threading.Condition()
+
+    def _full(self, size):
+        if not self._items:
+            return False
+        return len(self._items) >= self.queue_size or self._bytes + size > self.queue_bytes
+
+    def _put(self, item, size=0):
+        with self._cond:
+            while self._full(size) and not self.stop.is_set():
+                self._cond.wait(0.1)
+            if self.stop.is_set():
+                _close_item(item)
+                raise _Cancelled()
+            self._items.append((item, size))
+            self._bytes += size
+            self._cond.notify_all()
+
+    def _get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._cond.notify_all()
+            return item
+
+    def run(self):
+        if self.stop.is_set():
+            return
+        try:
+            for ti, data in self.source():
+                if data is None:
+                    self._put((ti, None))
+                elif ti.size <= ARCHIVE_SPOOL_SIZE:
+                    self._put((ti, io.BytesIO(data.read())), ti.size)
+                else:
+                    stream = _MemberStream(self.stop)
+                    self._put((ti, io.BufferedReader(stream, COPY_CHUNK_SIZE)))
+                    stream.feed(data)
+                    # the consumer may have given up on the archive
+                    if self.stop.is_set():
+                        raise _Cancelled()
+            self._put(_END)
+        except _Cancelled:
+            pass
+        except BaseException as exc:
+            try:
+                self._put(_Failed(exc))
+            except _Cancelled:
+                pass
+
+    def __iter__(self):
+        while True:
+            item = self._get()
+            if item is _END:
+                return
+            if isinstance(item, _Failed):
+                raise item.exc
+            yield item
+
+    def drain(self):
+        with self._cond:
+            while self._items:
+                _close_item(self._items.popleft()[0])
+            self._bytes = 0
+
+def iter_archives(sources, workers=None, queue_size=ARCHIVE_QUEUE_SIZE, queue_bytes=ARCHIVE_QUEUE_BYTES):
+    """
+    Read several archives concurrently, yielding their members in order.
+
+    Each source is a callable returning an iterator of ``(TarInfo,
+    fileobj)`` pairs, where the file object is only valid until the next
+    member, as with a streaming tarfile.  Sources are read on background
+    threads, ahead of the consumer, up to `queue_size` members or
+    `queue_bytes` of data per source.  Small members are read ahead into
+    memory; a large one is streamed to the consumer from its archive,
+    which holds up that source until it is consumed.  Members are still
+    yielded source by source, in the order given; each file object is
+    closed once the next member is requested.
+    """
+    if workers is None:
+        workers = ARCHIVE_WORKERS
+
+    stop = threading.Event()
+    readers = [_ArchiveReader(source, queue_size, queue_bytes, stop) for source in sources]
+    if not readers:
+        return
+
+    # Readers run in submission order, so the one being consumed always
+    # has a thread while later ones wait for a free worker.
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        for reader in readers:
+            pool.submit(reader.run)
+
+        for reader in readers:
+            for ti, data in reader:
+                try:
+                    yield ti, data
+                except BaseException:
+                    # stop before closing, so a streamed member isn't
+                    # read to its end for nothing
+                    stop.set()
+                    raise
+                finally:
+                    if data is not None:
+                        data.close()
+    finally:
+        stop.set()
+        pool.shutdown(wait=True)
+        for reader in readers:
+            reader.drain()
+
+def _iter_path_archive(container, path):
+    try:
+        tstream, tstat = container.get_archive(path)
+    except docker.errors.NotFound:
+        return
+
+    parent = posixpath.dirname(path)
+    with tarfile.open(fileobj=open_iterable(tstream), mode="r|") as tin:
+        for ti in tin:
+            if posixpath.normpath(posixpath.join(parent, ti.name)) == path:
+                ti.name = path
+                yield ti, tin.extractfile(ti) if ti.isreg() else None
+                # the archive of a directory goes on with its contents
+                return
+
+def iter_container_paths(container, paths, workers=None):
+    """
+    Yield ``(TarInfo, fileobj)`` for the given absolute paths in a
+    container, with each name set to the full path.  Paths that don't
+    exist are left out.  Each path is its own request, run concurrently:
+    an archive of the directory they share could be far larger than the
+    files wanted.
+    """
+    wanted = sorted(set(posixpath.normpath(path) for path in paths))
+    sources = [functools.partial(_iter_path_archive, container, path) for path in wanted]
+    yield from iter_archives(sources, workers)
@@ -3,8 +3,17 @@ import hashlib
 import io
 import json
 import os
+import queue
 import re
-import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Read size for open_iterable and copy_fileobj
+COPY_CHUNK_SIZE = 2**20
 
 def decode_bin(s, encoding=None):
     if encoding is None:
@@ -17,14 +26,24 @@ class open_output(object):
     def __init__(self, filename, mode="wb"):
         self._dirname = os.path.dirname(filename)
         self.filename = str(filename)
-        self._tmpname = self.filename+".tmp"
+        self._tmpname = None
         self.mode = mode
         self._fileobj = None
 
     def __enter__(self):
         if self._dirname:
             os.makedirs(self._dirname, exist_ok=True)
-        self._fileobj = open(self._tmpname, self.mode)
+        # A unique temporary name, so concurrent writers of the same file
+        # don't write into each other's output.  Unlike mkstemp, this
+        # keeps the usual permissions.
+        while True:
+            self._tmpname = "{}.{}.tmp".format(self.filename, os.urandom(6).hex())
+            try:
+                fd = os.open(self._tmpname, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+                break
+            except FileExistsError:
+                pass
+        self._fileobj = os.fdopen(fd, self.mode)
         return self._fileobj
 
     def __exit__(self, type, value, tb):
@@ -39,6 +58,32 @@ class open_output(object):
                 os.unlink(self._tmpname)
             self._fileobj = None
 
+class lock_file(object):
+    """
+    Hold an advisory lock on `filename` (created if needed), shared
+    between readers or exclusive.  Works across threads and processes.
+    """
+
+    def __init__(self, filename, shared=False):
+        self.filename = str(filename)
+        self.shared = shared
+        self._fileobj = None
+
+    def __enter__(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._fileobj = open(self.filename, "a")
+        if fcntl is not None:
+            fcntl.flock(self._fileobj.fileno(), fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self._fileobj is not None:
+            # closing releases the lock
+            self._fileobj.close()
+            self._fileobj = None
+
 def expect_file_mode(mode, _sub_mode_re=re.compile('^(u|g|o)=([rwx]+)$')):
     if mode is None or mode == "":
         return None
@@ -64,50 +109,6 @@ def json_hash(name, value):
     h.update(json.dumps(value, sort_keys=True).encode('utf-8'))
     return h.hexdigest()
 
-def _file_hash(name, filename, chunk_size=2**16):
-    h = hashlib.new(name)
-    sz = 0
-
-    with open(filename, "rb") as f:
-        while True:
-            chunk = f.read()
-            if not chunk:
-                break
-
-            sz += len(chunk)
-            h.update(chunk)
-
-    return h, sz
-
-def file_hash(name, filename):
-    filename = os.fspath(filename)
-    if os.path.isfile(filename):
-        h, _ = _file_hash(name, filename)
-        return h.hexdigest()
-
-    h = hashlib.new(name)
-    dirs = [filename]
-
-    while dirs:
-        dirs = sorted(dirs)
-        dirname = dirs.pop()
-
-        for n in os.listdir(dirname):
-            fn = os.path.join(dirname, n)
-            if os.path.isdir(fn):
-                dirs.append(fn)
-            else:
-                fn_u8 = fn.encode('utf-8')
-
-                h.update(struct.pack('L', len(fn_u8)))
-                h.update(fn_u8)
-
-                hf, sf = _file_hash(name, fn)
-
-                h.update(struct.pack('Q', sf))
-                h.update(hf.digest())
-    return h.hexdigest()
-
 def value_hash(name, value):
     h = hashlib.new(name)
     if isinstance(value, str):
@@ -176,21 +177,127 @@ class TeeBytesWriter(io.RawIOBase):
         for f in self.fileobjs:
             f.write(b)
 
+class ThreadedWriter(io.RawIOBase):
+    """
+    Writes to `fileobj` on a background thread, so that whatever it does
+    with the data, such as compressing it, overlaps with the caller.
+    Writes are gathered into chunks of `chunk_size`, and at most
+    `queue_size` chunks are pending.  Closing waits for the thread, closes
+    `fileobj` and raises any error it hit.
+    """
+
+    def __init__(self, fileobj, chunk_size=COPY_CHUNK_SIZE, queue_size=4):
+        self._inner = fileobj
+        self._chunk_size = chunk_size
+        self._buf = bytearray()
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is None:
+                try:
+                    self._inner.write(chunk)
+                except BaseException as exc:
+                    self._error = exc
+
+    def write(self, b):
+        if self._error is not None:
+            raise self._error
+        self._buf += b
+        if len(self._buf) >= self._chunk_size:
+            self._queue.put(bytes(self._buf))
+            self._buf = bytearray()
+        return len(b)
+
+    def close(self):
+        if self._thread is not None:
+            try:
+                if self._buf:
+                    self._queue.put(bytes(self._buf))
+                    self._buf = bytearray()
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+                if self._error is not None:
+                    raise self._error
+                self._inner.close()
+            finally:
+                super().close()
+
 class IOFromIterable(io.RawIOBase):
+    """
+    A raw stream reading from an iterable of bytes chunks.  Whatever part
+    of a chunk doesn't fit the caller's buffer is kept as a memoryview
+    for the next read, so chunks of any size are copied only once.
+    """
+
     def __init__(self, iterable):
         self._iter = iter(iterable)
         self._pos = 0
+        self._leftover = None
 
-    def readinto(self, buf):
-        try:
-            chunk = next(self._iter)
-        except StopIteration:
-            return 0
+    def readable(self):
+        return True
 
-        sz = len(chunk)
-        buf[:sz] = chunk
+    def readinto(self, buf):
+        leftover = self._leftover
+        while not leftover:
+            try:
+                leftover = memoryview(next(self._iter))
+            except StopIteration:
+                self._leftover = None
+                return 0
+
+        sz = min(len(buf), len(leftover))
+        buf[:sz] = leftover[:sz]
+        self._leftover = leftover[sz:]
         self._pos += sz
         return sz
 
     def tell(self):
         return self._pos
+
+def open_iterable(iterable, buffer_size=COPY_CHUNK_SIZE):
+    """Return a buffered file object reading from an iterable of bytes chunks"""
+    return io.BufferedReader(IOFromIterable(iterable), buffer_size)
+
+def copy_fileobj(fsrc, fdst, chunk_size=COPY_CHUNK_SIZE, update=None):
+    """
+    Copy fsrc to fdst like shutil.copyfileobj, reading into one reused
+    buffer when fsrc supports readinto.  `update` is called with each
+    chunk, e.g. a hash's update.  Returns the number of bytes copied.
+    """
+    total = 0
+    readinto = getattr(fsrc, "readinto", None)
+    if readinto is None:
+        while True:
+            chunk = fsrc.read(chunk_size)
+            if not chunk:
+                return total
+            if update is not None:
+                update(chunk)
+            fdst.write(chunk)
+            total += len(chunk)
+
+    view = memoryview(bytearray(chunk_size))
+    while True:
+        sz = readinto(view)
+        if not sz:
+            return total
+        chunk = view[:sz]
+        if update is not None:
+            update(chunk)
+        fdst.write(chunk)
+        total += sz
@@ -0,0 +1,221 @@
+
+import concurrent.futures
+import os
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+COMPRESS_TYPES = ("gzip", "xz")
+COMPRESS_DEFAULT_LEVEL = {
+    "gzip": 6,
+    "xz": 6,
+}
+FILE_CHUNK_SIZE = 2**20
+# Input compressed as one independent gzip member or xz block, when
+# compressing on several threads.  xz needs larger blocks to make use
+# of its dictionary.
+COMPRESS_BLOCK_SIZE = {
+    "gzip": 2**20,
+    "xz": 2**24,
+}
+# Names used by tarfile and in file extensions
+TAR_COMPRESS_TYPES = {
+    "gz": "gzip",
+    "xz": "xz",
+}
+
+_MAGIC = (
+    b"\x1f\x8b",                   # gzip
+    b"BZh",                        # bzip2
+    b"\xfd7zXZ\x00",               # xz
+    b"\x28\xb5\x2f\xfd",           # zstd
+)
+
+def is_compressed(head):
+    """Check if `head` starts like a compressed stream"""
+    return any(head.startswith(m) for m in _MAGIC)
+
+def make_compressor(compress_type, level=None):
+    if level is None:
+        level = COMPRESS_DEFAULT_LEVEL[compress_type]
+
+    if compress_type == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compress_type == "xz":
+        if lzma is None:
+            raise RuntimeError("LZMA compression not available")
+        return lzma.LZMACompressor(preset=level)
+    raise ValueError("Unknown compression type %s" % compress_type)
+
+def iter_file_chunks(fileobj, chunk_size=FILE_CHUNK_SIZE):
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def _vli(value):
+    """Encode a variable length integer, as used in xz headers"""
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _read_vli(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+def _xz_split(stream):
+    """
+    Split a single xz stream into its stream header, its blocks and the
+    (unpadded size, uncompressed size) index record of each block.
+    """
+    backward_size = (struct.unpack_from("<I", stream, len(stream) - 8)[0] + 1) * 4
+    index_start = len(stream) - 12 - backward_size
+    count, pos = _read_vli(stream, index_start + 1)
+    records = []
+    for _ in range(count):
+        unpadded, pos = _read_vli(stream, pos)
+        uncompressed, pos = _read_vli(stream, pos)
+        records.append((unpadded, uncompressed))
+    return stream[:12], stream[12:index_start], records
+
+def _xz_index_footer(stream_flags, records):
+    """The index and stream footer ending an xz stream of these blocks"""
+    index = bytearray(b"\x00")
+    index += _vli(len(records))
+    for unpadded, uncompressed in records:
+        index += _vli(unpadded)
+        index += _vli(uncompressed)
+    index += bytes(-len(index) % 4)
+    index += struct.pack("<I", zlib.crc32(index))
+
+    footer = struct.pack("<I", len(index) // 4 - 1) + stream_flags
+    return bytes(index) + struct.pack("<I", zlib.crc32(footer)) + footer + b"YZ"
+
+def _compress_block(compress_type, level, data):
+    comp = make_compressor(compress_type, level)
+    out = comp.compress(data) + comp.flush()
+    if compress_type == "xz":
+        return _xz_split(out)
+    return out
+
+class CompressWriter(object):
+    """
+    A writable file object compressing into `fileobj`, which is left open.
+
+    With more than one thread, the input is cut into blocks which are
+    compressed independently on a thread pool and written in order.  For
+    gzip they are concatenated members, which gzip, tar and dpkg read as
+    one stream, though Python's streaming ``r|gz`` mode only reads the
+    first.  For xz they are the blocks of a single stream, as written by
+    ``xz -T``, which any xz reader handles.  The output only depends on
+    the data, level and thread count.
+    """
+
+    def __init__(self, fileobj, compress_type, level=None, threads=None, block_size=None):
+        if threads is None:
+            threads = 1
+        elif threads <= 0:
+            threads = os.cpu_count() or 1
+        if block_size is None:
+            block_size = COMPRESS_BLOCK_SIZE[compress_type]
+
+        self._fileobj = fileobj
+        self._compress_type = compress_type
+        self._level = level
+        self._block_size = block_size
+        self._threads = threads
+        self._comp = None
+        self._pool = None
+        self._pending = []
+        self._buf = bytearray()
+        # stream flags and index records of an xz stream written in blocks
+        self._xz_flags = None
+        self._xz_records = []
+
+        if threads == 1:
+            self._comp = make_compressor(compress_type, level)
+        else:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._comp is not None:
+            out = self._comp.compress(data)
+            if out:
+                self._fileobj.write(out)
+            return len(data)
+
+        self._buf += data
+        while len(self._buf) >= self._block_size:
+            self._submit(bytes(self._buf[:self._block_size]))
+            del self._buf[:self._block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(_compress_block, self._compress_type, self._level, block))
+        # bound the blocks held in memory
+        while len(self._pending) > 2 * self._threads:
+            self._write_block(self._pending.pop(0).result())
+
+    def _write_block(self, block):
+        if self._compress_type != "xz":
+            self._fileobj.write(block)
+            return
+
+        header, blocks, records = block
+        if self._xz_flags is None:
+            self._xz_flags = header[6:8]
+            self._fileobj.write(header)
+        self._fileobj.write(blocks)
+        self._xz_records.extend(records)
+
+    def flush(self):
+        pass
+
+    def close(self, commit=True):
+        """Finish the compressed stream, or with commit=False abandon it"""
+        if self._comp is not None:
+            if commit:
+                self._fileobj.write(self._comp.flush())
+            self._comp = None
+        elif self._pool is not None:
+            try:
+                if commit:
+                    if self._buf or not self._pending:
+                        self._submit(bytes(self._buf))
+                    for future in self._pending:
+                        self._write_block(future.result())
+                    if self._xz_flags is not None:
+                        self._fileobj.write(_xz_index_footer(self._xz_flags, self._xz_records))
+            finally:
+                for future in self._pending:
+                    future.cancel()
+                self._pending = []
+                self._buf = bytearray()
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+def iter_compressed(chunks, compress_type, level=None):
+    """Compress an iterable of byte chunks, yielding compressed chunks"""
+    comp = make_compressor(compress_type, level)
+    for chunk in chunks:
+        out = comp.compress(chunk)
+        if out:
+            yield out
+    yield comp.flush()
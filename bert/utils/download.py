@@ -0,0 +1,126 @@
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import requests
+
+from .common import json_hash, open_output
+
+DOWNLOAD_CHUNK_SIZE = 2**16
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Return a requests session shared by the whole process, for keep-alive"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        return _session
+
+def parse_checksum(checksum):
+    """Split a ``sha256:<hex>`` style checksum into the hash name and digest"""
+    if checksum is None:
+        return None, None
+    name, sep, value = checksum.partition(":")
+    if not sep or name != "sha256" or not value:
+        raise ValueError("Invalid checksum %r, expected sha256:<hex>" % (checksum, ))
+    return name, value.lower()
+
+class DownloadCache(object):
+    """
+    A content addressed store of downloaded files.  Blobs are stored by
+    their sha256, and each url remembers its validators (ETag and
+    Last-Modified) so later fetches can be conditional.
+    """
+
+    def __init__(self, cache_dir, session=None):
+        self.root = os.path.join(cache_dir, "downloads")
+        self.session = session if session is not None else get_session()
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, "sha256", sha256[:2], sha256)
+
+    def _index_path(self, method, url, params):
+        return os.path.join(self.root, "urls", json_hash('sha256', [method, url, params]) + ".json")
+
+    def _load_index(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self, sha256):
+        """Return the path of a stored blob, or None"""
+        path = self.blob_path(sha256)
+        if os.path.isfile(path):
+            return path
+        return None
+
+    def fetch(self, url, params=None, method="GET", checksum=None):
+        """
+        Fetch `url`, returning the blob path and its sha256.  If a sha256
+        `checksum` is given and already stored, no request is made.
+        """
+        _, want_sha256 = parse_checksum(checksum)
+        if want_sha256 is not None:
+            path = self.lookup(want_sha256)
+            if path is not None:
+                return path, want_sha256
+
+        index_path = self._index_path(method, url, params)
+        headers = {}
+        index = None
+        if method == "GET":
+            index = self._load_index(index_path)
+            if index is not None and self.lookup(index["sha256"]) is not None:
+                if index.get("etag"):
+                    headers["If-None-Match"] = index["etag"]
+                if index.get("last_modified"):
+                    headers["If-Modified-Since"] = index["last_modified"]
+            else:
+                index = None
+
+        with self.session.request(method, url, params=params, headers=headers, stream=True) as resp:
+            if resp.status_code == 304 and index is not None:
+                return self.blob_path(index["sha256"]), index["sha256"]
+            resp.raise_for_status()
+
+            sha256 = self._store(resp)
+            if method == "GET":
+                with open_output(index_path, "w") as f:
+                    json.dump({
+                        "url": url,
+                        "etag": resp.headers.get("ETag"),
+                        "last_modified": resp.headers.get("Last-Modified"),
+                        "sha256": sha256
+                    }, f)
+
+        return self.blob_path(sha256), sha256
+
+    def _store(self, resp):
+        os.makedirs(self.root, exist_ok=True)
+        h = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    h.update(chunk)
+                    f.write(chunk)
+
+            sha256 = h.hexdigest()
+            path = self.blob_path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return sha256
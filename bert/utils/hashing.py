@@ -0,0 +1,116 @@
+
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import posixpath
+import struct
+
+# hashlib releases the GIL for updates larger than a couple KiB, so
+# hashing files concurrently on threads does use all cores.
+HASH_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+HASH_CHUNK_SIZE = 2**20
+HASH_MMAP_THRESHOLD = 2**23
+
+# Digest for cache keys that never leave bert.  blake2b is considerably
+# faster than sha256 on 64-bit hosts.
+CONTENT_HASH = 'blake2b'
+
+def _file_hash(name, filename, chunk_size=HASH_CHUNK_SIZE):
+    h = hashlib.new(name)
+    sz = 0
+
+    with open(filename, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    for offset in range(0, len(view), chunk_size):
+                        with view[offset:offset+chunk_size] as chunk:
+                            h.update(chunk)
+                sz = len(mm)
+        else:
+            buf = bytearray(min(chunk_size, max(file_size, 1)))
+            with memoryview(buf) as view:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    sz += n
+                    h.update(view[:n])
+
+    return h, sz
+
+def hash_files(name, filenames, workers=None):
+    """
+    Hash several files concurrently.  Returns a list of ``(hash, size)``
+    tuples in the same order as `filenames`.
+    """
+    filenames = list(filenames)
+    if workers is None:
+        workers = HASH_WORKERS
+
+    if workers <= 1 or len(filenames) <= 1:
+        return [_file_hash(name, fn) for fn in filenames]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(filenames))) as pool:
+        return list(pool.map(lambda fn: _file_hash(name, fn), filenames))
+
+def walk_tree(top):
+    """
+    Walk a directory tree in sorted pre-order, yielding ``(relpath, DirEntry)``
+    for everything below `top`.  Symlinks to directories are not followed.
+    """
+    stack = [("", top)]
+    while stack:
+        relbase, dirname = stack.pop()
+        with os.scandir(dirname) as it:
+            entries = sorted(it, key=lambda e: e.name)
+
+        subdirs = []
+        for entry in entries:
+            relpath = posixpath.join(relbase, entry.name) if relbase else entry.name
+            yield relpath, entry
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((relpath, entry.path))
+
+        stack.extend(reversed(subdirs))
+
+def file_hash(name, filename, workers=None):
+    filename = os.fspath(filename)
+    if os.path.isfile(filename):
+        h, _ = _file_hash(name, filename)
+        return h.hexdigest()
+
+    names = []
+    links = {}
+    files = []
+    for relpath, entry in walk_tree(filename):
+        if entry.is_dir(follow_symlinks=False):
+            continue
+        names.append(relpath)
+        if entry.is_symlink():
+            links[relpath] = os.readlink(entry.path)
+        else:
+            files.append(entry.path)
+
+    file_hashes = iter(hash_files(name, files, workers=workers))
+
+    h = hashlib.new(name)
+    for relpath in names:
+        fn_u8 = relpath.encode('utf-8')
+        h.update(struct.pack('!Q', len(fn_u8)))
+        h.update(fn_u8)
+
+        link = links.get(relpath)
+        if link is not None:
+            link_u8 = link.encode('utf-8')
+            h.update(b'l')
+            h.update(struct.pack('!Q', len(link_u8)))
+            h.update(link_u8)
+        else:
+            hf, sf = next(file_hashes)
+            h.update(b'f')
+            h.update(struct.pack('!Q', sf))
+            h.update(hf.digest())
+    return h.hexdigest()
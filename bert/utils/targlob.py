@@ -2,12 +2,20 @@
 import collections
 from enum import Enum
 import fnmatch
+import functools
 import pathlib
 import posixpath
 import re
 import tarfile
 
+import docker
+
 from .. import utils
+from .archive import iter_archives
+
+# Most subtrees to fetch separately after discovering matching paths,
+# before falling back to fetching their parent directories instead
+DISCOVERY_MAX_TARGETS = 64
 
 REGEX_SAFE_BACKSLASH = {
     '[': '[', '\\': '\\', '/': '/', ']': ']', '(': '(', ')': ')',
@@ -168,10 +176,151 @@ class _TargetTree(object):
                 for subpath in tree:
                     yield path + subpath
 
+def _normalize_path(path):
+    """Return `path` as str(PurePosixPath(path)), skipping the object when it is already clean"""
+    if isinstance(path, str):
+        if (not path or path == "." or "//" in path or "/./" in path
+                or path.startswith("./") or path.endswith(("/", "/."))):
+            return str(pathlib.PurePosixPath(path))
+        return path
+    return str(path)
+
+def _is_matched_level(path):
+    # TarGlobList only tests paths of more than one part, so never "/"
+    # or a lone relative name.
+    return "/" in path and path not in ("/", "//")
+
+def _parent_path(path):
+    i = path.rfind("/")
+    if i <= 0 or (i == 1 and path.startswith("//")):
+        return None
+    return path[:i]
+
+class _CompiledGlobList(object):
+    """
+    All items of a TarGlobList folded into a few checks: a set of exact
+    literals, a tuple of literal prefixes and one combined regex.  The
+    result for each parent directory is memoized, since tar members of a
+    directory arrive together.
+    """
+
+    def __init__(self, items):
+        exact = set()
+        prefixes = set()
+        patterns = []
+        self.regexes = []
+
+        for item in items:
+            if item._regex is not None:
+                # numbered backreferences and named groups don't survive
+                # being combined, so keep patterns with groups on their own
+                if item._regex.groups:
+                    self.regexes.append(item._regex)
+                else:
+                    patterns.append(item._regex_pattern)
+            else:
+                exact.add(item.value)
+                prefixes.add(item.value if item.value.endswith("/") else item.value + "/")
+
+        if patterns:
+            try:
+                self.regexes.append(re.compile("|".join("(?:%s)" % p for p in patterns)))
+            except re.error:
+                self.regexes.extend(re.compile(p) for p in patterns)
+
+        self.exact = frozenset(exact)
+        self.prefixes = tuple(sorted(prefixes))
+        self._dir_cache = {}
+
+    def matches(self, path):
+        path = _normalize_path(path)
+        if not _is_matched_level(path):
+            return False
+        # An ancestor starting with a prefix means the path does too
+        if self.prefixes and path.startswith(self.prefixes):
+            return True
+        return self._matches_up(path)
+
+    def _matches_up(self, path):
+        if path in self.exact:
+            return True
+        for regex in self.regexes:
+            if regex.search(path):
+                return True
+
+        parent = _parent_path(path)
+        if parent is None or not _is_matched_level(parent):
+            return False
+        result = self._dir_cache.get(parent)
+        if result is None:
+            result = self._dir_cache[parent] = self._matches_up(parent)
+        return result
+
+def _path_sort_key(path):
+    return path.split("/")
+
+def _outermost_paths(paths):
+    """Drop paths that are below another path in `paths`"""
+    result = []
+    for path in sorted(paths, key=_path_sort_key):
+        if result and (path == result[-1] or path.startswith(result[-1] + "/")):
+            continue
+        result.append(path)
+    return result
+
+def _minimal_targets(paths, max_targets=DISCOVERY_MAX_TARGETS):
+    """
+    Reduce matching paths to the subtrees to fetch.  When there are too
+    many, the deepest are replaced by their parents until few enough.
+    """
+    targets = _outermost_paths(paths)
+    while len(targets) > max_targets:
+        depth = max(t.count("/") for t in targets)
+        if depth <= 1:
+            break
+        targets = _outermost_paths(
+            posixpath.dirname(t) if t.count("/") == depth else t
+            for t in targets
+        )
+    return targets
+
+def _list_container_paths(container):
+    """
+    List every path in the container's root filesystem by running find
+    in a short lived container of the same image.  Returns None if that
+    isn't possible, such as for images without find.
+    """
+    try:
+        output = container.client.containers.run(
+            image=container.attrs["Image"],
+            entrypoint=["find"],
+            command=["/", "-xdev", "-print0"],
+            user="0",
+            network_disabled=True,
+            stdout=True,
+            stderr=False,
+            remove=True
+        )
+    except docker.errors.DockerException:
+        return None
+
+    return [
+        path.decode("utf-8", "surrogateescape")
+        for path in output.split(b"\0") if path
+    ]
+
 #
 #
 #
 
+def _strip_at(name, at):
+    if at:
+        if name.startswith(at):
+            name = name[len(at):]
+        while name.startswith("/"):
+            name = name[1:]
+    return name
+
 class TarGlobList(object):
     def __init__(self, items=None):
         if items is not None:
@@ -181,22 +330,23 @@ class TarGlobList(object):
                 self._items = [TarGlob(i) for i in items]
         else:
             self._items = []
+        self._compiled = None
 
     def __iter__(self):
         return iter(self._items)
 
+    def cache_key(self):
+        """A JSON serializable description of the items, for cache keys"""
+        return [[item.type.name.lower(), item.value, item.at] for item in self]
+
     def iter_targets(self):
         yield from _TargetTree(_TargetItem(item.static_prefix.path, item.at) for item in self)
 
     def matches(self, path):
-        if not isinstance(path, pathlib.PurePosixPath):
-            path = pathlib.PurePosixPath(path)
-        while len(path.parts) > 1:
-            for item in self:
-                if item.matches(str(path)):
-                    return True
-            path = pathlib.PurePosixPath(*path.parts[:-1])
-        return False
+        """True if `path` or one of its parent directories matches an item"""
+        if self._compiled is None:
+            self._compiled = _CompiledGlobList(self._items)
+        return self._compiled.matches(path)
 
     def _rewrite_path(self, path, path_prefix, target_prefix):
         path = pathlib.PurePosixPath(path)
@@ -207,39 +357,66 @@ class TarGlobList(object):
             pass
         return target_prefix / path
 
-    def iter_container_files(self, container):
+    def _iter_container_targets(self, container):
         for target in self.iter_targets():
-            tstream, tstat = container.get_archive(target.path)
+            if target.path not in ("", "/"):
+                yield target
+                continue
 
-            target_prefix = pathlib.PurePosixPath(target.path)
-            if not target.path.endswith("/"):
-                target_prefix = target_prefix.parent
-                path_prefix = None
-            else:
-                path_prefix = tstat['name']
-
-            tf = utils.IOFromIterable(tstream)
-            at = posixpath.normpath(target.at) if target.at else None
-            with tarfile.open(fileobj=tf, mode="r|") as tin:
-                while True:
-                    ti = tin.next()
-                    if ti is None:
-                        break
-
-                    tname = self._rewrite_path(ti.name, path_prefix, target_prefix)
-                    if self.matches(tname):
-                        str_tname = str(tname)
-                        if at:
-                            if str_tname.startswith(at):
-                                str_tname = str_tname[len(at):]
-                            while str_tname.startswith("/"):
-                                str_tname = str_tname[1:]
-
-                        if ti.islnk():
-                            ti.linkname = str(self._rewrite_path(ti.linkname, path_prefix, target_prefix))
-
-                        ti.name = str_tname
-                        yield ti, tin.extractfile(ti) if ti.isreg() else None
+            # Without a static prefix, the whole filesystem would be
+            # streamed just to filter it.  Find the matching paths first.
+            paths = _list_container_paths(container)
+            if paths is None:
+                yield target
+                continue
+
+            for path in _minimal_targets(p for p in paths if self.matches(p)):
+                yield _TargetItem(path, target.at)
+
+    def _iter_target_files(self, container, target):
+        tstream, tstat = container.get_archive(target.path)
+
+        target_prefix = pathlib.PurePosixPath(target.path)
+        if not target.path.endswith("/"):
+            target_prefix = target_prefix.parent
+            path_prefix = None
+        else:
+            path_prefix = tstat['name']
+
+        tf = utils.open_iterable(tstream)
+        at = posixpath.normpath(target.at) if target.at else None
+        with tarfile.open(fileobj=tf, mode="r|") as tin:
+            while True:
+                ti = tin.next()
+                if ti is None:
+                    break
+
+                tname = self._rewrite_path(ti.name, path_prefix, target_prefix)
+                if self.matches(tname):
+                    if ti.islnk():
+                        linkname = self._rewrite_path(ti.linkname, path_prefix, target_prefix)
+                        ti.linkname = _strip_at(str(linkname), at)
+
+                    ti.name = _strip_at(str(tname), at)
+                    yield ti, tin.extractfile(ti) if ti.isreg() else None
+
+    def iter_container_files(self, container, workers=None):
+        """
+        Yield (TarInfo, fileobj) for each matching file in the container.
+        Targets are fetched and decoded concurrently by `workers` threads
+        (1 reads them one at a time), but yielded in a fixed order.  Each
+        file object is only valid until the next item.
+        """
+        targets = list(self._iter_container_targets(container))
+        if workers == 1:
+            for target in targets:
+                yield from self._iter_target_files(container, target)
+            return
+
+        yield from iter_archives(
+            [functools.partial(self._iter_target_files, container, target) for target in targets],
+            workers=workers
+        )
 
     def __len__(self):
         return len(self._items)
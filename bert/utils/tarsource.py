@@ -0,0 +1,238 @@
+
+import hashlib
+import io
+import os
+import posixpath
+import stat
+import tarfile
+
+try:
+    import grp
+except ImportError:
+    grp = None
+
+try:
+    import pwd
+except ImportError:
+    pwd = None
+
+from .common import json_hash
+from .hashing import CONTENT_HASH, hash_files, walk_tree
+
+TAR_STREAM_CHUNK_SIZE = 2**20
+
+def iter_tar_stream(members, chunk_size=TAR_STREAM_CHUNK_SIZE):
+    """
+    Generate a tar archive as a series of byte chunks, suitable as a
+    chunked request body.  `members` yields ``(TarInfo, opener)`` pairs,
+    where `opener` returns a file object for regular files.
+    """
+    buf = bytearray()
+    offset = 0
+
+    for ti, opener in members:
+        header = ti.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape")
+        buf += header
+        offset += len(header)
+
+        if ti.isreg() and ti.size > 0:
+            remaining = ti.size
+            with opener() as fi:
+                while remaining > 0:
+                    if len(buf) >= chunk_size:
+                        yield bytes(buf)
+                        buf.clear()
+                    chunk = fi.read(min(remaining, chunk_size))
+                    if not chunk:
+                        raise OSError("unexpected end of data for %s" % ti.name)
+                    buf += chunk
+                    remaining -= len(chunk)
+            offset += ti.size
+
+            blocks, remainder = divmod(ti.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                pad = tarfile.BLOCKSIZE - remainder
+                buf += tarfile.NUL * pad
+                offset += pad
+
+        if len(buf) >= chunk_size:
+            yield bytes(buf)
+            buf.clear()
+
+    end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    buf += end
+    offset += len(end)
+    blocks, remainder = divmod(offset, tarfile.RECORDSIZE)
+    if remainder > 0:
+        buf += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    yield bytes(buf)
+
+def _lookup_name(db, id_):
+    if db is None:
+        return ""
+    try:
+        return db(id_)[0]
+    except KeyError:
+        return ""
+
+class TarSourceEntry(object):
+    __slots__ = ('info', 'path', 'data', 'digest')
+
+    def __init__(self, info, path=None, data=None):
+        self.info = info
+        self.path = path
+        self.data = data
+        self.digest = None
+
+    def open(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, "rb")
+
+class TarSource(object):
+    """
+    Tar members backed by local files.  Collecting the members is
+    separate from writing them, so the content can be hashed for a
+    cache key before (or without) building the archive.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self._inodes = {}
+        self._users = {}
+        self._groups = {}
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_path(self, srcname, arcname=None, recursive=True, mode=None, content_filter=None):
+        if arcname is None:
+            arcname = srcname
+
+        self._add(srcname, arcname, os.lstat(srcname), mode, content_filter)
+        if recursive and os.path.isdir(srcname) and not os.path.islink(srcname):
+            for relpath, entry in walk_tree(srcname):
+                self._add(entry.path, posixpath.join(arcname, relpath),
+                          entry.stat(follow_symlinks=False), mode, content_filter)
+
+    def _add(self, path, arcname, st, mode, content_filter):
+        ti = self._make_info(path, arcname, st)
+        if ti is None:
+            return
+
+        if mode is not None:
+            ti.mode = (ti.mode & ~0o777) | mode
+
+        data = None
+        if ti.isreg() and content_filter is not None:
+            data = content_filter(path)
+            ti.size = len(data)
+
+        self.entries.append(TarSourceEntry(ti, path=path if ti.isreg() else None, data=data))
+
+    def _make_info(self, path, arcname, st):
+        st_mode = st.st_mode
+        ti = tarfile.TarInfo(arcname)
+        ti.mode = stat.S_IMODE(st_mode)
+        ti.uid = st.st_uid
+        ti.gid = st.st_gid
+        ti.mtime = int(st.st_mtime)
+
+        if stat.S_ISREG(st_mode):
+            inode = (st.st_ino, st.st_dev)
+            if st.st_nlink > 1 and inode in self._inodes:
+                ti.type = tarfile.LNKTYPE
+                ti.linkname = self._inodes[inode]
+            else:
+                if st.st_nlink > 1:
+                    self._inodes[inode] = arcname
+                ti.type = tarfile.REGTYPE
+                ti.size = st.st_size
+        elif stat.S_ISDIR(st_mode):
+            ti.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st_mode):
+            ti.type = tarfile.SYMTYPE
+            ti.linkname = os.readlink(path)
+        elif stat.S_ISFIFO(st_mode):
+            ti.type = tarfile.FIFOTYPE
+        elif stat.S_ISCHR(st_mode) or stat.S_ISBLK(st_mode):
+            ti.type = tarfile.CHRTYPE if stat.S_ISCHR(st_mode) else tarfile.BLKTYPE
+            ti.devmajor = os.major(st.st_rdev)
+            ti.devminor = os.minor(st.st_rdev)
+        else:
+            # sockets and friends can't be archived
+            return None
+
+        uname = self._users.get(ti.uid)
+        if uname is None:
+            uname = self._users[ti.uid] = _lookup_name(pwd and pwd.getpwuid, ti.uid)
+        gname = self._groups.get(ti.gid)
+        if gname is None:
+            gname = self._groups[ti.gid] = _lookup_name(grp and grp.getgrgid, ti.gid)
+        ti.uname = uname
+        ti.gname = gname
+
+        return ti
+
+    def normalize(self, mtime=None):
+        """
+        Strip host specific metadata, so the same content produces the
+        same archive anywhere.  Members are owned by root, and the mtime
+        defaults to ``SOURCE_DATE_EPOCH`` if set, or zero otherwise.
+        """
+        if mtime is None:
+            mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
+        for entry in self.entries:
+            ti = entry.info
+            ti.mtime = mtime
+            ti.uid = ti.gid = 0
+            ti.uname = ti.gname = ""
+
+    def hash(self, name=CONTENT_HASH, workers=None):
+        """Compute content digests for every regular file"""
+        pending = []
+        for entry in self.entries:
+            if entry.digest is not None or not entry.info.isreg():
+                continue
+            if entry.data is not None:
+                entry.digest = hashlib.new(name, entry.data).hexdigest()
+            else:
+                pending.append(entry)
+
+        for entry, (h, _) in zip(pending, hash_files(name, (e.path for e in pending), workers=workers)):
+            entry.digest = h.hexdigest()
+
+    def manifest(self):
+        items = []
+        for entry in self.entries:
+            ti = entry.info
+            items.append([
+                ti.name, ti.type.decode('ascii'), ti.mode,
+                ti.uid, ti.gid, ti.uname, ti.gname, ti.mtime,
+                ti.size, ti.linkname, ti.devmajor, ti.devminor,
+                entry.digest
+            ])
+        return items
+
+    def content_hash(self, name=CONTENT_HASH, workers=None):
+        """
+        Return a digest covering the metadata and contents of every member,
+        without needing to build the archive itself.
+        """
+        self.hash(name, workers=workers)
+        return "{}:{}".format(name, json_hash(name, self.manifest()))
+
+    def iter_tar(self, chunk_size=TAR_STREAM_CHUNK_SIZE):
+        return iter_tar_stream(((entry.info, entry.open) for entry in self.entries), chunk_size=chunk_size)
+
+    def write_to(self, tf):
+        for entry in self.entries:
+            if entry.info.isreg():
+                with entry.open() as fi:
+                    tf.addfile(entry.info, fi)
+            else:
+                tf.addfile(entry.info)
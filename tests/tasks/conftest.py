@@ -0,0 +1,120 @@
+
+import io
+import posixpath
+import tarfile
+import tempfile
+from unittest import mock
+
+import docker
+import pytest
+
+class FakePaths(object):
+    """A TarGlobList yielding fixed (TarInfo, data) entries"""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def cache_key(self):
+        return [[ti.name, ti.mtime, ti.size] for ti, _ in self.entries]
+
+    def iter_container_files(self, container):
+        for ti, data in self.entries:
+            yield ti, io.BytesIO(data) if data is not None else None
+
+class FakeContainer(object):
+    """
+    A container holding `files`, a mapping of absolute path to content,
+    or to a symlink's target as a str
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+        self.uploads = []
+
+    def put_archive(self, path, data):
+        self.uploads.append(data.read() if hasattr(data, "read") else b"".join(data))
+
+    def get_archive(self, path):
+        self.requests.append(path)
+        names = [fn for fn in self.files if fn == path or fn.startswith(path.rstrip("/") + "/")]
+        if not names:
+            raise docker.errors.NotFound(path)
+
+        parent = posixpath.dirname(path)
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tf:
+            for fn in sorted(names):
+                ti = tarfile.TarInfo(posixpath.relpath(fn, parent))
+                if isinstance(self.files[fn], str):
+                    ti.type = tarfile.SYMTYPE
+                    ti.linkname = self.files[fn]
+                    tf.addfile(ti)
+                    continue
+                ti.size = len(self.files[fn])
+                tf.addfile(ti, io.BytesIO(self.files[fn]))
+        return [buf.getvalue()], {"name": posixpath.basename(path)}
+
+class FakeJob(object):
+    """Enough of a BuildJob to run tasks without docker"""
+
+    def __init__(self, cache_dir, container=None, export_cache=False, patch_cache=False):
+        self.cache_dir = cache_dir
+        self.container = container
+        self.settings = mock.Mock(export_cache=export_cache, patch_cache=patch_cache)
+        self.image_id = "sha256:image"
+        self.display = mock.Mock()
+        self.lock = None
+        self.vars = {}
+        self.changes = []
+        self.created = 0
+
+    def pull_pending(self):
+        pass
+
+    def current_image_id(self):
+        return self.image_id
+
+    def create(self, key):
+        self.created += 1
+        return self.container
+
+    def cancel(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def put_archive(self, path, data, container=None):
+        (container or self.container).put_archive(path, data)
+
+    def template(self, value):
+        return value
+
+    def set_var(self, name, value):
+        self.vars[name] = value
+
+@pytest.fixture
+def tempdir():
+    with tempfile.TemporaryDirectory() as tempdir:
+        yield tempdir
+
+@pytest.fixture
+def cache_dir():
+    with tempfile.TemporaryDirectory() as tempdir:
+        yield tempdir
+
+@pytest.fixture
+def fake_job():
+    """The FakeJob class"""
+    return FakeJob
+
+@pytest.fixture
+def fake_paths():
+    """The FakePaths class"""
+    return FakePaths
+
+@pytest.fixture
+def fake_container():
+    """The FakeContainer class"""
+    return FakeContainer
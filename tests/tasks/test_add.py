@@ -0,0 +1,62 @@
+
+import os
+
+import pytest
+
+from bert.build import BuildJob
+
+@pytest.fixture
+def add_job(fake_job):
+    class AddJob(fake_job):
+        tar_source = BuildJob.tar_source
+
+        def __init__(self, root_dir):
+            super().__init__(None)
+            self.root_dir = root_dir
+            self.work_dir = "/"
+            self.keys = []
+
+        def resolve_path(self, path):
+            return os.path.join(self.root_dir, path)
+
+        def create(self, key):
+            self.keys.append(key)
+
+        def put_archive(self, path, data):
+            b"".join(data)
+
+        def commit(self):
+            pass
+    return AddJob
+
+def test_normalized_key_independent_of_checkout(tempdir, add_job):
+    from bert.tasks.add import TaskAdd
+    from bert.utils import LocalPath
+
+    keys = []
+    for i, checkout in enumerate(("one", "two")):
+        root = os.path.join(tempdir, checkout)
+        os.makedirs(os.path.join(root, "src"))
+        fn = os.path.join(root, "src", "file")
+        with open(fn, "w") as f:
+            f.write("content")
+        os.utime(fn, (1000 + i, 1000 + i))
+
+        job = add_job(root)
+        TaskAdd(None).run_with_values(job, path=LocalPath("src", job), dest="/opt/", mode=None,
+                                      template=False, normalize=True, mtime=None)
+        keys.extend(job.keys)
+
+    assert keys[0] == keys[1]
+    assert keys[0]['value'] == "src"
+
+def test_mtime_needs_normalize(tempdir, add_job):
+    from bert.exc import ConfigFailed
+    from bert.tasks.add import TaskAdd
+    from bert.utils import LocalPath
+
+    job = add_job(tempdir)
+    with pytest.raises(ConfigFailed, match="normalize"):
+        TaskAdd(None).run_with_values(job, path=LocalPath("src", job), dest="/opt/", mode=None,
+                                      template=False, normalize=False, mtime=1000)
+    assert job.keys == []
@@ -0,0 +1,311 @@
+
+import io
+import os
+import shutil
+import tarfile
+
+import pytest
+
+def make_entries():
+    entries = []
+    for name, data in (("/usr", None), ("/usr/bin", None), ("/usr/bin/tool", b"#!/bin/sh\n"),
+                       ("/usr/include", None), ("/usr/include/tool.h", b"x" * (3 * 2**20))):
+        ti = tarfile.TarInfo(name)
+        if data is None:
+            ti.type = tarfile.DIRTYPE
+        else:
+            ti.size = len(data)
+        entries.append((ti, data))
+    return entries
+
+@pytest.fixture
+def export_paths(fake_paths):
+    return lambda: fake_paths(make_entries())
+
+def read_tar(path):
+    with tarfile.open(path) as tf:
+        return {ti.name: tf.extractfile(ti).read() if ti.isreg() else None for ti in tf}
+
+def test_fan_out(tempdir, fake_job, export_paths):
+    from bert.export import run_export
+    from bert.tasks.export_deb import DebWriter
+    from bert.tasks.export_rpm import RPMBuild
+    from bert.tasks.export_tar import TarWriter
+    from bert.utils import TarGlobList
+
+    def tar_writer(name, filter=None):
+        writer = TarWriter(None, dest=os.path.join(tempdir, name), preamble=None,
+                           preamble_encoding="utf-8", compress_type=None, mode=None)
+        writer.filter = filter
+        return writer
+
+    def rpm_writer(name, filter):
+        writer = RPMBuild(None, dest=None, dest_dir=tempdir, provides=None, requires=None, conflicts=None,
+                          obsoletes=None, header=None, name=name, epoch=None, version="1.0", release="1",
+                          arch="noarch", rpm_os="Linux", url=None, summary=None, description=None,
+                          compress_type="gzip", paths=filter)
+        writer.filter = filter
+        return writer
+
+    job = fake_job(os.path.join(tempdir, "cache"))
+    deb = DebWriter(job, dest=os.path.join(tempdir, "tool.deb"), compress_type="gz", control={
+        "Package": "tool", "Version": "1.0", "Architecture": "all"
+    })
+    writers = [
+        tar_writer("all.tar"),
+        tar_writer("bin.tar", TarGlobList(["/usr/bin"])),
+        rpm_writer("tool", TarGlobList(["/usr/bin"])),
+        rpm_writer("tool-devel", TarGlobList(["glob:/usr/include/*"])),
+        deb,
+    ]
+    run_export(job, export_paths(), writers)
+
+    single = tar_writer("single.tar")
+    run_export(job, export_paths(), [single])
+
+    expected = {ti.name: data for ti, data in make_entries()}
+    assert read_tar(os.path.join(tempdir, "all.tar")) == expected
+    with open(os.path.join(tempdir, "all.tar"), "rb") as f1, open(os.path.join(tempdir, "single.tar"), "rb") as f2:
+        assert f1.read() == f2.read()
+    assert read_tar(os.path.join(tempdir, "bin.tar")) == {
+        "/usr/bin": None, "/usr/bin/tool": b"#!/bin/sh\n"
+    }
+    assert [len(w.files) for w in writers[2:4]] == [2, 1]
+    for name in ("tool-1.0-1.noarch.rpm", "tool-devel-1.0-1.noarch.rpm", "tool.deb"):
+        assert os.path.getsize(os.path.join(tempdir, name)) > 0
+
+def test_writer_failure(tempdir, fake_job, export_paths):
+    from bert.export import ExportWriter, run_export
+
+    class Broken(ExportWriter):
+        dest = os.path.join(tempdir, "broken")
+
+        def add(self, ti, data):
+            raise OSError("disk full")
+
+    class Counting(ExportWriter):
+        dest = os.path.join(tempdir, "counting")
+        closed = None
+
+        def add(self, ti, data):
+            if data is not None:
+                data.read()
+
+        def close(self, commit=True):
+            self.closed = commit
+
+    counting = Counting()
+    with pytest.raises(OSError, match="disk full"):
+        run_export(fake_job(tempdir), export_paths(), [Broken(), counting])
+    assert counting.closed is False
+
+def test_export_cache(tempdir, fake_job, export_paths):
+    from bert.export import run_export
+    from bert.tasks.export_tar import TarWriter
+
+    def writer(**kwargs):
+        values = dict(dest=os.path.join(tempdir, "out.tar"), preamble=None, preamble_encoding="utf-8",
+                      compress_type=None, mode=None)
+        values.update(kwargs)
+        return TarWriter.from_values(None, values)
+
+    job = fake_job(os.path.join(tempdir, "cache"), export_cache=True)
+    run_export(job, export_paths(), [writer()])
+    expected = {ti.name: data for ti, data in make_entries()}
+    assert read_tar(os.path.join(tempdir, "out.tar")) == expected
+    assert job.created == 1
+
+    # unchanged inputs: the artifact is left alone
+    mtime = os.stat(os.path.join(tempdir, "out.tar")).st_mtime_ns
+    run_export(job, export_paths(), [writer()])
+    assert os.stat(os.path.join(tempdir, "out.tar")).st_mtime_ns == mtime
+
+    # different options: rewritten from the spool, without a container
+    run_export(job, export_paths(), [writer(preamble="x")])
+    assert os.path.getsize(os.path.join(tempdir, "out.tar")) > 0
+    assert job.created == 1
+
+    # a new image is read again
+    job.image_id = "sha256:other"
+    run_export(job, export_paths(), [writer()])
+    assert job.created == 2
+
+def test_export_without_cache(tempdir, fake_job, export_paths):
+    from bert.export import run_export
+    from bert.tasks.export_tar import TarWriter
+
+    dest = os.path.join(tempdir, "out.tar")
+    writer = TarWriter.from_values(None, dict(dest=dest, preamble=None, preamble_encoding="utf-8",
+                                              compress_type=None, mode=None))
+    job = fake_job(os.path.join(tempdir, "cache"))
+    run_export(job, export_paths(), [writer])
+    assert job.created == 1
+    # no stamps or spool without the export cache
+    assert not os.path.exists(job.cache_dir)
+
+    # an existing output is kept while the stage made no changes
+    run_export(job, export_paths(), [writer])
+    assert job.created == 1
+
+    job.changes.append("sha256:layer")
+    run_export(job, export_paths(), [writer])
+    assert job.created == 2
+
+def read_rpm_header(f):
+    import struct
+    magic, nindex, hsize = struct.unpack("!8sII", f.read(16))
+    assert magic.startswith(b"\x8e\xad\xe8")
+    index = [struct.unpack("!iiii", f.read(16)) for _ in range(nindex)]
+    store = f.read(hsize)
+    return {tag: (offset, count, store) for tag, _, offset, count in index}
+
+@pytest.fixture
+def build_rpm(tempdir, fake_job, export_paths):
+    def build_rpm(name, compress_type, compress_threads=None):
+        from bert.export import run_export
+        from bert.tasks.export_rpm import RPMBuild
+
+        writer = RPMBuild(None, dest=None, dest_dir=tempdir, provides=None, requires=None, conflicts=None,
+                          obsoletes=None, header=None, name=name, epoch=None, version="1.0", release="1",
+                          arch="noarch", rpm_os="Linux", url=None, summary=None, description=None,
+                          compress_type=compress_type, compress_threads=compress_threads, paths=None)
+        run_export(fake_job(tempdir), export_paths(), [writer])
+        with open(writer.dest, "rb") as f:
+            return f.read()
+    return build_rpm
+
+def test_rpm_signature(build_rpm):
+    import gzip
+    import hashlib
+    import struct
+
+    for threads in (None, 3):
+        f = io.BytesIO(build_rpm("tool", "gzip", threads))
+        f.seek(96)
+        sig = read_rpm_header(f)
+        f.seek((f.tell() + 7) // 8 * 8)
+        rest = f.read()
+
+        offset, _, store = sig[1000]
+        assert struct.unpack_from("!I", store, offset)[0] == len(rest)
+        offset, count, store = sig[1004]
+        assert store[offset:offset + count] == hashlib.md5(rest).digest()
+
+        f = io.BytesIO(rest)
+        read_rpm_header(f)
+        payload = gzip.decompress(f.read())
+        assert payload.startswith(b"070701")
+        assert b"#!/bin/sh\n" in payload
+
+def test_rpm_reproducible(build_rpm):
+    for compress_type in ("gzip", "bzip2", "xz"):
+        assert build_rpm("a", compress_type) == build_rpm("a", compress_type)
+    assert build_rpm("a", "gzip", 2) == build_rpm("a", "gzip", 2)
+
+def test_rpm_file_table():
+    import struct
+    from bert.tasks.export_rpm import RPMFileTable, rpm_tag_int16, rpm_tag_int32
+
+    assert rpm_tag_int32("x", [1, 2**32 - 1]) == (4, 4, 2, struct.pack("!II", 1, 2**32 - 1))
+    assert rpm_tag_int16("x", [0o100644]) == (3, 2, 1, struct.pack("!H", 0o100644 & 0xffff))
+
+    table = RPMFileTable()
+    table.add("/usr/bin/b", size=2, mode=0o100755, user="bin")
+    table.add("/usr/a", size=1)
+    table.add("/usr/bin/a", size=3)
+    header = table.header()
+    assert header["dirnames"] == ["/usr/", "/usr/bin/"]
+    assert list(header["dirindexes"]) == [0, 1, 1]
+    assert header["basenames"] == ["a", "a", "b"]
+    assert list(header["filesizes"]) == [1, 3, 2]
+    assert header["fileusername"] == ["root", "root", "bin"]
+
+def test_export_cache_streams(tempdir, fake_job, export_paths):
+    from bert.export import ExportCache, ExportWriter, export_key, run_export
+
+    job = fake_job(os.path.join(tempdir, "cache"), export_cache=True)
+    paths = export_paths()
+    spool_path = ExportCache(job.cache_dir).spool_path(export_key(job, paths))
+
+    class Recording(ExportWriter):
+        # never exists, so never current
+        dest = os.path.join(tempdir, "recording")
+
+        def __init__(self):
+            self.files = {}
+            self.spooled = []
+
+        def add(self, ti, data):
+            self.spooled.append(os.path.exists(spool_path))
+            self.files[ti.name] = data.read() if data is not None else None
+
+    for spooled in (False, True):
+        writer = Recording()
+        run_export(job, export_paths(), [writer])
+        # the first export gets the files while they are spooled
+        assert set(writer.spooled) == {spooled}
+        assert writer.files == {ti.name: data for ti, data in make_entries()}
+    assert job.created == 1
+
+def test_close_failure(tempdir, fake_job, export_paths):
+    from unittest import mock
+    from bert.export import ExportWriter, run_export
+    from bert.tasks.export_tar import TarWriter
+
+    def tar_writer(name, compress_type=None):
+        return TarWriter(None, dest=os.path.join(tempdir, name), preamble=None, preamble_encoding="utf-8",
+                         compress_type=compress_type, mode=None, compress_threads=2)
+
+    writer = tar_writer("out.tar.gz")
+    writer.open()
+    with mock.patch.object(writer._comp, "close", side_effect=[OSError("disk full"), None]):
+        with pytest.raises(OSError, match="disk full"):
+            writer.close()
+    assert os.listdir(tempdir) == []
+
+    class BrokenClose(ExportWriter):
+        dest = os.path.join(tempdir, "broken")
+
+        def add(self, ti, data):
+            pass
+
+        def close(self, commit=True):
+            if commit:
+                raise OSError("disk full")
+
+    with pytest.raises(OSError, match="disk full"):
+        run_export(fake_job(os.path.join(tempdir, "cache")), export_paths(),
+                   [tar_writer("first.tar"), BrokenClose(), tar_writer("last.tar")])
+    assert os.listdir(tempdir) == ["first.tar"]
+
+@pytest.mark.skipif(shutil.which("dpkg-deb") is None, reason="dpkg-deb is not installed")
+def test_deb_parallel_xz(tempdir, fake_job, fake_paths):
+    import subprocess
+    from unittest import mock
+    from bert.export import run_export
+    from bert.tasks.export_deb import DebWriter
+
+    entries = [tarfile.TarInfo("/opt")]
+    entries[0].type = tarfile.DIRTYPE
+    entries = [(entries[0], None)]
+    for i in range(40):
+        data = os.urandom(3000)
+        ti = tarfile.TarInfo("/opt/f%d" % i)
+        ti.size = len(data)
+        entries.append((ti, data))
+
+    job = fake_job(os.path.join(tempdir, "cache"))
+    dest = os.path.join(tempdir, "tool.deb")
+    writer = DebWriter(job, dest=dest, compress_type="xz", compress_threads=3, control={
+        "Package": "tool", "Version": "1.0", "Architecture": "all"
+    })
+    with mock.patch.dict("bert.utils.compress.COMPRESS_BLOCK_SIZE", {"xz": 8192}):
+        run_export(job, fake_paths(entries), [writer])
+
+    listing = subprocess.check_output(["dpkg-deb", "-c", dest]).decode("utf-8")
+    assert len(listing.splitlines()) == len(entries)
+    fsys = subprocess.check_output(["dpkg-deb", "--fsys-tarfile", dest])
+    with tarfile.open(fileobj=io.BytesIO(fsys)) as tf:
+        assert {ti.name: tf.extractfile(ti).read() for ti in tf if ti.isreg()} == {
+            ti.name: data for ti, data in entries if data is not None
+        }
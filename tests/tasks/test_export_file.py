@@ -0,0 +1,103 @@
+
+import os
+import tarfile
+
+def entry(name, data=None, type=tarfile.REGTYPE, mtime=1000, linkname=""):
+    ti = tarfile.TarInfo(name)
+    ti.type = type
+    ti.mtime = mtime
+    ti.linkname = linkname
+    ti.mode = 0o755 if type == tarfile.DIRTYPE else 0o644
+    if data is not None:
+        ti.size = len(data)
+    return ti, data
+
+def test_sync(tempdir, fake_job, fake_paths):
+    from bert.tasks.export_file import TaskExportFile
+
+    task = TaskExportFile({"src": "/usr"})
+    job = fake_job(os.path.join(tempdir, "cache"))
+    dest = os.path.join(tempdir, "out")
+    entries = [
+        entry("/usr", type=tarfile.DIRTYPE),
+        entry("/usr/a", b"a"),
+        entry("/usr/b", b"b"),
+        entry("/usr/c", type=tarfile.LNKTYPE, linkname="/usr/a"),
+        entry("/usr/big", bytes(2**17) + b"end"),
+    ]
+    task.run_with_values(job, dest=dest, paths=fake_paths(entries), sync=True)
+
+    def path(name):
+        return os.path.join(dest, "usr", name)
+
+    with open(path("big"), "rb") as f:
+        assert f.read() == bytes(2**17) + b"end"
+    assert os.path.samefile(path("a"), path("c"))
+    assert os.stat(path("a")).st_mtime == 1000
+    inode_a, inode_b = os.stat(path("a")).st_ino, os.stat(path("b")).st_ino
+
+    entries[2] = entry("/usr/b", b"bb", mtime=2000)
+    del entries[4]
+    entries.append(entry("/usr/d", b"d"))
+    task.run_with_values(job, dest=dest, paths=fake_paths(entries), sync=True)
+
+    assert sorted(os.listdir(os.path.join(dest, "usr"))) == ["a", "b", "c", "d"]
+    assert os.stat(path("a")).st_ino == inode_a
+    assert os.stat(path("b")).st_ino != inode_b
+    with open(path("b"), "rb") as f:
+        assert f.read() == b"bb"
+    assert os.path.samefile(path("a"), path("c"))
+    assert os.stat(os.path.join(dest, "usr")).st_mtime == 1000
+
+def test_directory_restored(tempdir, fake_job, fake_paths):
+    from bert.tasks.export_file import TaskExportFile
+
+    task = TaskExportFile({"src": "/usr"})
+    job = fake_job(os.path.join(tempdir, "cache"))
+    dest = os.path.join(tempdir, "out")
+    entries = [entry("/usr", type=tarfile.DIRTYPE), entry("/usr/a", b"a")]
+
+    task.run_with_values(job, dest=dest, paths=fake_paths(entries), sync=False)
+    os.unlink(os.path.join(dest, "usr", "a"))
+    # directories are exported again, even from the same image
+    task.run_with_values(job, dest=dest, paths=fake_paths(entries), sync=False)
+    with open(os.path.join(dest, "usr", "a"), "rb") as f:
+        assert f.read() == b"a"
+
+def test_link_target_not_exported(tempdir, fake_job, fake_paths):
+    from bert.tasks.export_file import TaskExportFile
+
+    task = TaskExportFile({"src": "/usr/c"})
+    job = fake_job(os.path.join(tempdir, "cache"))
+    # the paths filter left out the link's target, /usr/a
+    entries = [
+        entry("/usr", type=tarfile.DIRTYPE),
+        entry("/usr/b", b"b"),
+        entry("/usr/c", type=tarfile.LNKTYPE, linkname="/usr/a"),
+    ]
+    for sync in (False, True):
+        dest = os.path.join(tempdir, "out-{}".format(sync))
+        task.run_with_values(job, dest=dest, paths=fake_paths(entries), sync=sync)
+        assert os.listdir(os.path.join(dest, "usr")) == ["b"]
+
+def test_sync_file_replaced_by_directory(tempdir, fake_job, fake_paths):
+    from bert.tasks.export_file import TaskExportFile
+
+    task = TaskExportFile({"src": "/usr"})
+    job = fake_job(os.path.join(tempdir, "cache"))
+    dest = os.path.join(tempdir, "out")
+    task.run_with_values(job, dest=dest, paths=fake_paths([
+        entry("/usr", type=tarfile.DIRTYPE),
+        entry("/usr/lib", b"a file"),
+    ]), sync=True)
+
+    # /usr/lib becomes a directory, without an entry of its own
+    task.run_with_values(job, dest=dest, paths=fake_paths([
+        entry("/usr", type=tarfile.DIRTYPE),
+        entry("/usr/lib/a", b"a"),
+        entry("/usr/lib/sub/b", b"b"),
+    ]), sync=True)
+    with open(os.path.join(dest, "usr", "lib", "a"), "rb") as f:
+        assert f.read() == b"a"
+    with open(os.path.join(dest, "usr", "lib", "sub", "b"), "rb") as f:
+        assert f.read() == b"b"
@@ -0,0 +1,101 @@
+
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+CONTENT = b'{"hello": "world"}'
+ETAG = '"v1"'
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path.startswith("/missing"):
+            self.send_response(404)
+            self.end_headers()
+        elif self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Length", str(len(CONTENT)))
+            self.end_headers()
+            self.wfile.write(CONTENT)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    httpd = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:%d" % httpd.server_address[1]
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_revalidate(server, cache_dir):
+    from bert.utils.download import DownloadCache
+
+    cache = DownloadCache(cache_dir)
+    path, sha256 = cache.fetch(server + "/data")
+    assert sha256 == hashlib.sha256(CONTENT).hexdigest()
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT
+
+    path2, sha256_2 = cache.fetch(server + "/data")
+    assert (path2, sha256_2) == (path, sha256)
+    assert Handler.requests == [("/data", None), ("/data", ETAG)]
+
+def test_checksum_skips_network(server, cache_dir):
+    from bert.utils.download import DownloadCache
+
+    cache = DownloadCache(cache_dir)
+    _, sha256 = cache.fetch(server + "/data")
+    cache.fetch(server + "/other", checksum="sha256:" + sha256)
+    assert Handler.requests == [("/data", None)]
+
+def run_fetch(job, **values):
+    from bert.tasks.fetch import TaskFetch
+
+    params = dict(params=None, method="GET", dest_var="out", dest=None, mode=None, checksum=None)
+    params.update(values)
+    TaskFetch(None).run_with_values(job, **params)
+    return job.vars
+
+def test_task_var(server, cache_dir, fake_job):
+    assert run_fetch(fake_job(cache_dir), url=server + "/data", json=True) == {"out": {"hello": "world"}}
+
+def test_task_checksum_mismatch(server, cache_dir, fake_job):
+    from bert.tasks import TaskFailed
+
+    with pytest.raises(TaskFailed, match="Checksum mismatch"):
+        run_fetch(fake_job(cache_dir), url=server + "/data", checksum="sha256:" + "0" * 64)
+
+def test_task_http_error(server, cache_dir, fake_job):
+    from bert.tasks import TaskFailed
+
+    with pytest.raises(TaskFailed, match="failed"):
+        run_fetch(fake_job(cache_dir), url=server + "/missing")
+
+def test_task_lock_checksum(server, cache_dir, fake_job):
+    from bert.lock import Lockfile
+    from bert.tasks.fetch import TaskFetch
+    from bert.utils.download import DownloadCache
+
+    _, sha256 = DownloadCache(cache_dir).fetch(server + "/data")
+
+    job = fake_job(cache_dir)
+    job.lock = Lockfile(None)
+    job.lock.set_fetch_checksum(server + "/data", None, "sha256:" + sha256)
+    TaskFetch(None).run_with_values(job, url=server + "/data", params=None, method="GET", dest_var="out",
+                                    dest=None, mode=None, checksum=None)
+    assert job.vars == {"out": CONTENT.decode("utf-8")}
+    assert Handler.requests == [("/data", None)]
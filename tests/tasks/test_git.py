@@ -0,0 +1,160 @@
+
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+
+def git(cwd, *args):
+    return subprocess.check_output(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args),
+        cwd=cwd
+    ).decode("utf-8").strip()
+
+@pytest.fixture
+def remote(tempdir):
+    """A repository with a branch, a lightweight tag and an annotated tag"""
+    path = os.path.join(tempdir, "remote")
+    os.makedirs(path)
+    git(path, "init", "-q")
+    git(path, "symbolic-ref", "HEAD", "refs/heads/master")
+    with open(os.path.join(path, ".gitattributes"), "w") as f:
+        f.write("secret export-ignore\nversion export-subst\n")
+    for fn, data in (("secret", "s\n"), ("version", "$Format:%H$\n")):
+        with open(os.path.join(path, fn), "w") as f:
+            f.write(data)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "one")
+    git(path, "tag", "light")
+
+    git(path, "checkout", "-q", "-b", "dev")
+    with open(os.path.join(path, "dev"), "w") as f:
+        f.write("dev\n")
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "two")
+    git(path, "tag", "-a", "v1", "-m", "release")
+    git(path, "checkout", "-q", "master")
+
+    return {
+        "url": "file://" + path,
+        "master": git(path, "rev-parse", "master"),
+        "dev": git(path, "rev-parse", "dev"),
+    }
+
+def archive_files(cache, commit, prefix=""):
+    chunks = []
+    cache.archive(commit, prefix, lambda data: chunks.extend(data))
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as tf:
+        return {ti.name: tf.extractfile(ti).read() for ti in tf if ti.isreg()}
+
+def test_resolve(tempdir, remote):
+    from bert.tasks.git import GitCache
+
+    cache = GitCache(os.path.join(tempdir, "cache"), remote["url"])
+    assert cache.resolve("master") == remote["master"]
+    assert cache.resolve("dev") == remote["dev"]
+    assert cache.resolve("light") == remote["master"]
+    # an annotated tag resolves to its commit, not the tag object
+    assert cache.resolve("v1") == remote["dev"]
+    assert cache.resolve(remote["dev"]) == remote["dev"]
+    assert cache.resolve(remote["dev"][:10]) == remote["dev"]
+
+def test_fetch_and_archive(tempdir, remote):
+    from bert.tasks.git import GitCache
+
+    cache = GitCache(os.path.join(tempdir, "cache"), remote["url"])
+    commit = cache.resolve("v1")
+    cache.fetch(commit, "v1")
+    assert git(cache.bare_path, "cat-file", "-t", commit) == "commit"
+    assert git(cache.bare_path, "rev-parse", "refs/bert/commits/" + commit) == commit
+
+    # the same files as a checkout, whatever .gitattributes says
+    assert archive_files(cache, commit, "src/") == {
+        "src/.gitattributes": b"secret export-ignore\nversion export-subst\n",
+        "src/secret": b"s\n",
+        "src/version": b"$Format:%H$\n",
+        "src/dev": b"dev\n",
+    }
+
+def test_ensure_checkout(tempdir, remote):
+    from bert.tasks.git import GitCache
+
+    cache = GitCache(os.path.join(tempdir, "cache"), remote["url"])
+    commit = cache.resolve("master")
+    cache.fetch(commit, "master")
+    path = cache.ensure_checkout(commit)
+    assert git(path, "rev-parse", "HEAD") == commit
+    assert not os.path.exists(os.path.join(path, "dev"))
+    assert cache.ensure_checkout(commit) == path
+
+def test_resolve_cached_commit(tempdir, remote):
+    from bert.tasks import TaskFailed
+    from bert.tasks.git import GitCache
+
+    cache = GitCache(os.path.join(tempdir, "cache"), remote["url"])
+    cache.fetch(remote["dev"], "dev")
+    # a cached commit resolves without the remote
+    cache.repo = "file://" + os.path.join(tempdir, "missing")
+    assert cache.resolve(remote["dev"][:10]) == remote["dev"]
+    with pytest.raises(TaskFailed):
+        cache.resolve("dev")
+
+def test_concurrent_fetch_and_checkout(tempdir, remote):
+    import concurrent.futures
+    from bert.tasks.git import GitCache
+
+    cache_dir = os.path.join(tempdir, "cache")
+    commits = [remote["master"], remote["dev"]] * 4
+
+    def run(commit):
+        cache = GitCache(cache_dir, remote["url"])
+        cache.fetch(commit)
+        return cache.ensure_checkout(commit)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(commits)) as pool:
+        paths = list(pool.map(run, commits))
+
+    assert len(set(paths)) == 2
+    for commit, path in zip(commits, paths):
+        assert git(path, "rev-parse", "HEAD") == commit
+    cache = GitCache(cache_dir, remote["url"])
+    for commit in commits[:2]:
+        assert cache.have_commit(commit)
+        assert archive_files(cache, commit)
+    checkouts = os.listdir(cache.checkouts_path)
+    assert not [fn for fn in checkouts if fn.startswith(".tmp-")]
+
+def test_task_key(tempdir, remote, fake_job):
+    from bert.build import BuildJob
+    from bert.tasks.git import GitRun
+
+    class GitJob(fake_job):
+        tar_source = BuildJob.tar_source
+
+        def __init__(self, cache_dir):
+            super().__init__(cache_dir)
+            self.work_dir = "/"
+            self.git_ref_cache = {}
+            self.keys = []
+
+        def create(self, key):
+            self.keys.append(key)
+
+        def put_archive(self, path, data):
+            b"".join(data)
+
+        def commit(self):
+            pass
+
+    job = GitJob(os.path.join(tempdir, "cache"))
+    for git_dir in (False, True):
+        GitRun(job, repo=remote["url"], dest="/src", ref="master", git_dir=git_dir).run()
+    # keys without a .git directory are the same as before git_dir existed
+    assert job.keys == [
+        {"path": "/src", "commit": remote["master"]},
+        {"path": "/src", "commit": remote["master"], "git_dir": True},
+    ]
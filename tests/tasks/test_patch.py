@@ -109,4 +109,70 @@ def test_patcher_fails(input, patch, exc, flags):
         with exc(PatchError):
             run_patcher(tempdir, input, patch, flags)
     finally:
-        tempdir.cleanup()
\ No newline at end of file
+        tempdir.cleanup()
+
+def test_container_patcher_load_files(fake_job, fake_container):
+    from bert.tasks.patch import ContainerPatcher
+
+    files = {"/src/a/%d.c" % i: b"file %d\n" % i for i in range(20)}
+    files["/abs.c"] = b"abs\n"
+    container = fake_container(files)
+    with ContainerPatcher(container, chdir="/src", strip_dir=1, job=fake_job(None, container)) as patcher:
+        patcher.load_files(["a/%d.c" % i for i in range(20)] + ["a/missing.c"])
+        # one request per file, never the directory they share
+        assert sorted(container.requests) == sorted(["/src/a/%d.c" % i for i in range(20)] + ["/src/a/missing.c"])
+        with open(patcher.files["a/3.c"], "rb") as f:
+            assert f.read() == b"file 3\n"
+        assert patcher.files["a/missing.c"] is None
+
+        del container.requests[:]
+        patcher.load_files(["/abs.c", "a/3.c"])
+        assert container.requests == ["/abs.c"]
+        with open(patcher.files["/abs.c"], "rb") as f:
+            assert f.read() == b"abs\n"
+
+def test_container_patcher_cache(fake_job, fake_container):
+    import io
+    import tarfile
+    from unittest import mock
+
+    from bert.tasks.patch import ContainerPatcher
+
+    with open(os.path.join(PATCH_DATA, "hello-in-1.txt"), "rb") as f:
+        original = f.read()
+    with open(os.path.join(PATCH_DATA, "hello-out-1.txt"), "rb") as f:
+        expected = f.read()
+    patch_file = os.path.join(PATCH_DATA, "hello-1-nostrip.diff")
+
+    tempdir = tempfile.TemporaryDirectory()
+    try:
+        uploads = []
+        for i in range(2):
+            container = fake_container({"/src/hello.txt": original})
+            with ContainerPatcher(container, chdir="/src", strip_dir=0, job=fake_job(None, container),
+                                  cache_dir=tempdir.name) as patcher:
+                if i:
+                    with mock.patch("bert.tasks.patch.Patch.apply", side_effect=AssertionError):
+                        patcher.apply_patches([patch_file])
+                else:
+                    patcher.apply_patches([patch_file])
+                patcher.save()
+            uploads.extend(container.uploads)
+
+        assert uploads[0] == uploads[1]
+        with tarfile.open(fileobj=io.BytesIO(uploads[1])) as tf:
+            assert tf.extractfile("/src/hello.txt").read().split(b"\n") == expected.split(b"\n")
+    finally:
+        tempdir.cleanup()
+
+@pytest.mark.parametrize("patch_cache", [False, True])
+def test_patch_cache_setting(cache_dir, fake_job, fake_container, patch_cache):
+    from bert.tasks.patch import TaskPatch
+
+    with open(os.path.join(PATCH_DATA, "hello-in-1.txt"), "rb") as f:
+        container = fake_container({"/src/hello.txt": f.read()})
+    job = fake_job(cache_dir, container, patch_cache=patch_cache)
+    TaskPatch(None).run_with_values(job, src=os.path.join(PATCH_DATA, "hello-1-nostrip.diff"),
+                                    chdir="/src", strip_dir=0)
+    assert len(container.uploads) == 1
+    assert os.path.exists(os.path.join(cache_dir, "patches")) == patch_cache
@@ -0,0 +1,88 @@
+
+import pytest
+
+def run(job, **kwargs):
+    from bert.tasks.read_file import TaskReadFile, READ_FILE_MAX_SIZE
+
+    values = dict(var=None, path=None, paths=None, max_size=READ_FILE_MAX_SIZE)
+    values.update(kwargs)
+    TaskReadFile(values).run_with_values(job, **values)
+
+def test_read_many_and_cache(cache_dir, fake_job, fake_container):
+    container = fake_container({"/etc/version": b"1.2\n", "/opt/name": b"app"})
+    job = fake_job(cache_dir, container)
+    run(job, var="version", path="etc/version", paths={"name": "/opt/name"})
+    assert job.vars == {"version": "1.2", "name": "app"}
+    assert sorted(container.requests) == ["/etc/version", "/opt/name"]
+
+    job = fake_job(cache_dir, None)
+    run(job, var="version", path="etc/version", paths={"name": "/opt/name"})
+    assert job.vars == {"version": "1.2", "name": "app"}
+    assert job.created == 0
+
+def test_read_errors(cache_dir, fake_job, fake_container):
+    from bert.exc import BuildFailed
+
+    job = fake_job(cache_dir, fake_container({"/big": b"x" * 10}))
+    with pytest.raises(BuildFailed, match="max-size"):
+        run(job, var="v", path="/big", max_size=5)
+    with pytest.raises(BuildFailed, match="does not exist"):
+        run(job, var="v", path="/missing")
+
+def test_symlinks(cache_dir, fake_job, fake_container):
+    from bert.exc import BuildFailed
+
+    container = fake_container({
+        "/etc/os-release": "../usr/lib/os-release",
+        "/usr/lib/os-release": b"ID=debian\n",
+        "/opt/current": "/opt/v1",
+        "/opt/v1": "version",
+        "/opt/version": b"1.0",
+        "/loop": "/loop",
+        "/dangling": "/nowhere",
+    })
+    job = fake_job(cache_dir, container)
+    run(job, paths={"os": "/etc/os-release", "version": "/opt/current"})
+    assert job.vars == {"os": "ID=debian", "version": "1.0"}
+
+    with pytest.raises(BuildFailed, match="too many levels"):
+        run(job, var="v", path="/loop")
+    with pytest.raises(BuildFailed, match="/dangling does not exist"):
+        run(job, var="v", path="/dangling")
+
+def test_pending_pull_before_key(cache_dir, fake_job, fake_container):
+    container = fake_container({"/etc/version": b"1"})
+    run(fake_job(cache_dir, container), var="v", path="/etc/version")
+
+    class PullingJob(fake_job):
+        def pull_pending(self):
+            self.image_id = "sha256:pulled"
+
+    # the key names the pulled image, so the old value isn't served
+    container.files["/etc/version"] = b"2"
+    job = PullingJob(cache_dir, container)
+    run(job, var="v", path="/etc/version")
+    assert job.vars == {"v": "2"}
+    assert job.created == 1
+
+def test_too_large_not_read(cache_dir, fake_job, fake_container):
+    from bert.exc import BuildFailed
+
+    class StreamingContainer(fake_container):
+        sent = 0
+
+        def get_archive(self, path):
+            chunks, stat = super().get_archive(path)
+            data = chunks[0]
+
+            def iter_chunks():
+                for i in range(0, len(data), 2**16):
+                    self.sent += 2**16
+                    yield data[i:i + 2**16]
+            return iter_chunks(), stat
+
+    size = 2**25
+    container = StreamingContainer({"/big": b"x" * size})
+    with pytest.raises(BuildFailed, match="max-size"):
+        run(fake_job(cache_dir, container), var="v", path="/big")
+    assert container.sent < size // 4
@@ -0,0 +1,131 @@
+
+from unittest import mock
+
+import docker
+import pytest
+
+class FakeImages(object):
+    def __init__(self, local=None, remote=None):
+        self.local = dict(local or {})
+        self.remote = dict(remote or {})
+        self.pulled = []
+
+    def get(self, name):
+        try:
+            return self.local[name]
+        except KeyError:
+            raise docker.errors.ImageNotFound(name)
+
+    def pull(self, name):
+        self.pulled.append(name)
+        self.local[name] = self.remote[name]
+        return self.local[name]
+
+def make_image(id):
+    return mock.Mock(id=id, attrs={"Config": {}})
+
+def make_job(images, pull):
+    from bert.build import BertBuild, BuildJob, BuildSettings, chain_configs
+
+    config = {"from": "base", "stages": {"main": {"tasks": []}}}
+    build = BertBuild(None, config=config, settings=BuildSettings(pull=pull))
+    with mock.patch("docker.from_env") as from_env:
+        from_env.return_value.images = images
+        return BuildJob(build.stages[0], next(chain_configs(build)), display=mock.Mock())
+
+def test_always_defers_pull():
+    local, remote = make_image("sha256:old"), make_image("sha256:new")
+    images = FakeImages(local={"base": local}, remote={"base": remote})
+    job = make_job(images, "always")
+
+    job.setup("base")
+    assert job.current_image.image is local
+    assert images.pulled == []
+
+    from bert.build import BaseImageChanged
+    with pytest.raises(BaseImageChanged):
+        job._run_pending_pull()
+    assert images.pulled == ["base"]
+
+    job.reset()
+    job.setup("base")
+    assert job.current_image.image is remote
+    assert job._pending_pull is None
+
+def test_if_not_present():
+    images = FakeImages(remote={"base": make_image("sha256:new")})
+    job = make_job(images, "if-not-present")
+
+    job.setup("base")
+    job.reset()
+    job.setup("base")
+    assert images.pulled == ["base"]
+
+def test_never():
+    from bert.exc import BuildFailed
+
+    job = make_job(FakeImages(remote={"base": make_image("sha256:new")}), "never")
+    with pytest.raises(BuildFailed, match="not present locally"):
+        job.setup("base")
+
+def test_current_image_id_does_not_pull():
+    local, remote = make_image("sha256:old"), make_image("sha256:new")
+    images = FakeImages(local={"base": local}, remote={"base": remote})
+    job = make_job(images, "always")
+
+    job.setup("base")
+    assert job.current_image_id() == "sha256:old"
+    assert images.pulled == []
+
+def test_pull_pending():
+    from bert.build import BaseImageChanged
+
+    local, remote = make_image("sha256:old"), make_image("sha256:new")
+    images = FakeImages(local={"base": local}, remote={"base": remote})
+    job = make_job(images, "always")
+
+    job.setup("base")
+    with pytest.raises(BaseImageChanged):
+        job.pull_pending()
+    assert images.pulled == ["base"]
+    job.pull_pending()
+    assert images.pulled == ["base"]
+
+def test_truncated_capture_fails():
+    from bert.build import BertTask, BuildSettings, CurrentTask
+    from bert.display import WatchResult
+    from bert.exc import BuildFailed
+
+    job = make_job(FakeImages(local={"base": make_image("sha256:old")}), "never")
+    job.current_task = CurrentTask(BertTask("run", "cat big", capture="out"))
+    job.current_task.command = "cat big"
+    job.current_task.container = container = mock.Mock()
+    container.wait.return_value = {"StatusCode": 0}
+    job.display.watch_container.return_value = WatchResult(b"0123456789", stdout_truncated=True)
+
+    with pytest.raises(BuildFailed, match="Captured output is larger than 10 bytes"):
+        job.commit()
+    assert not container.commit.called
+    assert "out" not in job.vars
+
+    assert BuildSettings(capture_max_size=10).capture_max_size == 10
+
+def test_reset_restores_vars():
+    from bert.build import BaseImageChanged
+
+    local, remote = make_image("sha256:old"), make_image("sha256:new")
+    images = FakeImages(local={"base": local}, remote={"base": remote})
+    job = make_job(images, "always")
+    job.set_var("before", "kept")
+
+    job.setup("base")
+    # a set-var from the stale image, then a task that pulls
+    job.set_var("before", "stale")
+    job.set_var("version", "old")
+    with pytest.raises(BaseImageChanged):
+        job.pull_pending()
+
+    job.reset()
+    assert job.vars["before"] == job.saved_vars["before"] == "kept"
+    assert "version" not in job.vars
+    assert "version" not in job.saved_vars
@@ -0,0 +1,62 @@
+
+import unittest
+
+class TestPumpStreams(unittest.TestCase):
+    def frames(self, *frames):
+        import struct
+        return b"".join(struct.pack(">BxxxL", stype, len(data)) + data for stype, data in frames)
+
+    def test_demux(self):
+        import io
+        from bert.display import _pump_streams
+
+        frames = [(1, b"out one\n"), (2, b"err\n"), (1, b""), (1, b"x" * 100000), (2, b"tail")]
+        raw = self.frames(*frames)
+        for read_size in (1, 3, 8, 13, 2**16):
+            out, err = io.BytesIO(), io.BytesIO()
+            _pump_streams(io.BytesIO(raw), out, err, read_size=read_size)
+            self.assertEqual(out.getvalue(), b"out one\n" + b"x" * 100000)
+            self.assertEqual(err.getvalue(), b"err\ntail")
+
+    def test_watch_tail_and_capture(self):
+        import io
+        from unittest import mock
+        from bert.display import Display
+
+        raw = self.frames(*[(1 + i % 2, "line {}\n".format(i).encode()) for i in range(100)])
+        client = mock.Mock()
+        client.api.attach_socket.return_value = io.BytesIO(raw + self.frames((1, b"end")))
+
+        stdout = io.TextIOWrapper(io.BytesIO())
+        stderr = io.TextIOWrapper(io.BytesIO())
+        display = Display(interactive=False, stdout=stdout, stderr=stderr, tail_lines=3)
+        result = display.watch_container(client, mock.Mock(), capture=True)
+
+        self.assertEqual(result.tail, [b"line 98", b"line 99", b"end"])
+        self.assertEqual(result.stdout, b"".join("line {}\n".format(i).encode() for i in range(0, 100, 2)) + b"end")
+        self.assertEqual(stdout.buffer.getvalue(), b"")
+
+        display.show_tail(result)
+        self.assertTrue(stderr.buffer.getvalue().endswith(b"line 98\nline 99\nend\n"))
+
+    def test_capture_max_size(self):
+        import io
+        from unittest import mock
+        from bert.display import Display
+
+        client = mock.Mock()
+        stdout = io.TextIOWrapper(io.BytesIO())
+        display = Display(interactive=False, stdout=stdout, stderr=io.TextIOWrapper(io.BytesIO()),
+                          capture_max_size=10)
+
+        client.api.attach_socket.return_value = io.BytesIO(self.frames((1, b"0123456"), (1, b"789abc")))
+        result = display.watch_container(client, mock.Mock(), capture=True)
+        self.assertEqual(result.stdout, b"0123456789")
+        self.assertTrue(result.stdout_truncated)
+        # only the capture is cut, not what is shown
+        self.assertEqual(stdout.buffer.getvalue(), b"0123456789abc")
+
+        client.api.attach_socket.return_value = io.BytesIO(self.frames((1, b"short")))
+        result = display.watch_container(client, mock.Mock(), capture=True)
+        self.assertEqual(result.stdout, b"short")
+        self.assertFalse(result.stdout_truncated)
@@ -0,0 +1,38 @@
+
+import os
+import tempfile
+from unittest import mock
+
+import pytest
+
+def test_roundtrip():
+    from bert.lock import Lockfile
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "bert.lock")
+        lock = Lockfile(filename)
+        lock.set_image("debian:stable", mock.Mock(id="sha256:1234", attrs={
+            "RepoDigests": ["debian@sha256:abcd"]
+        }))
+        lock.set_git_commit("https://example.com/repo.git", "master", "a" * 40)
+        lock.set_fetch_checksum("https://example.com/data", {"q": 1}, "sha256:" + "b" * 64)
+        lock.save()
+
+        lock = Lockfile.load(filename)
+        assert lock.image("debian:stable") == {"id": "sha256:1234", "digest": "debian@sha256:abcd"}
+        assert lock.git_commit("https://example.com/repo.git", "master") == "a" * 40
+        assert lock.fetch_checksum("https://example.com/data", {"q": 1}) == "sha256:" + "b" * 64
+        assert lock.fetch_checksum("https://example.com/data", None) is None
+
+def test_missing_and_invalid():
+    from bert.exc import ConfigFailed
+    from bert.lock import Lockfile
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "bert.lock")
+        assert Lockfile.load(filename) is None
+
+        with open(filename, "w") as f:
+            f.write('{"version": 0}')
+        with pytest.raises(ConfigFailed, match="regenerate"):
+            Lockfile.load(filename)
@@ -0,0 +1,106 @@
+
+from unittest import mock
+
+def make_build(tasks, pull="never"):
+    from bert.build import BertBuild, BuildSettings
+
+    config = {"from": "base", "stages": {"main": {"tasks": tasks}}}
+    return BertBuild(None, config=config, settings=BuildSettings(pull=pull), display=mock.Mock())
+
+def test_static_values():
+    from bert.tasks.fetch import TaskFetch
+
+    values = TaskFetch({"url": "http://example.com/a", "params": {"q": ["x"]}}).static_values()
+    assert values["url"] == "http://example.com/a"
+    assert values["params"] == {"q": ["x"]}
+    assert values["method"] == "GET"
+
+    assert TaskFetch({"url": "http://example.com/{{ name }}"}).static_values() is None
+    assert TaskFetch({"url": "http://example.com/a", "params": {"q": ["{% if x %}y{% endif %}"]}}).static_values() is None
+    assert TaskFetch({"url": "http://example.com/a", "nonsense": 1}).static_values() is None
+
+def test_collect():
+    from bert.prefetch import Prefetcher, PrefetchImage
+    from bert.tasks.fetch import FetchPrefetch
+    from bert.tasks.git import GitPrefetch
+
+    build = make_build([
+        {"fetch": {"url": "http://example.com/a", "dest-var": "a"}},
+        # the same url again is fetched once
+        {"fetch": {"url": "http://example.com/a", "dest-var": "b"}},
+        {"fetch": {"url": "http://example.com/post", "method": "POST"}},
+        {"fetch": {"url": "http://example.com/{{ name }}"}},
+        {"fetch": {"url": "http://example.com/maybe"}, "when": "{{ flag }}"},
+        {"git": {"repo": "https://example.com/repo.git", "ref": "v1", "path": "/src"}},
+        {"run": "true"},
+    ])
+
+    items = Prefetcher(build).collect()
+    assert sorted(item.key for item in items) == [
+        ("fetch", "http://example.com/a", "null"),
+        ("git", "https://example.com/repo.git", "v1"),
+    ]
+    assert {type(item) for item in items} == {FetchPrefetch, GitPrefetch}
+
+    # base images are only prefetched when the pull policy may pull them
+    images = [item for item in Prefetcher(make_build([], pull="always")).collect()]
+    assert [type(item) for item in images] == [PrefetchImage]
+    assert images[0].image == "base"
+
+def test_prefetch_failures_are_not_fatal():
+    from bert.prefetch import Prefetcher, PrefetchItem
+
+    class Item(PrefetchItem):
+        def __init__(self, key, fail):
+            self.key = key
+            self.fail = fail
+            self.ran = False
+
+        def run(self, prefetcher):
+            self.ran = True
+            if self.fail:
+                raise OSError("unreachable")
+
+    build = make_build([])
+    items = [Item("a", True), Item("b", False)]
+    with mock.patch("bert.prefetch.Prefetcher.collect", return_value=items):
+        Prefetcher(build).run()
+    assert all(item.ran for item in items)
+    assert any("unreachable" in str(call) for call in build.display.echo.call_args_list)
+
+def test_cli_defaults_to_build():
+    from click.testing import CliRunner
+    from bert.main import cli
+
+    with mock.patch("bert.main._iter_builds", return_value=[]) as iter_builds:
+        result = CliRunner().invoke(cli, ["some/dir"])
+        assert result.exit_code == 0, result.output
+        assert iter_builds.call_args[0][0] == ("some/dir",)
+
+        result = CliRunner().invoke(cli, [])
+        assert result.exit_code == 0, result.output
+        assert iter_builds.call_args[0][0] == ()
+
+        result = CliRunner().invoke(cli, ["prefetch", "-j", "2", "other"])
+        assert result.exit_code == 0, result.output
+        assert iter_builds.call_args[0][0] == ("other",)
+
+    result = CliRunner().invoke(cli, ["--help"])
+    assert result.exit_code == 0
+    for command in ("build", "prefetch", "lock"):
+        assert command in result.output
+
+def test_prefetch_opt_in():
+    from click.testing import CliRunner
+    from bert.main import cli
+
+    build = mock.Mock()
+    with mock.patch("bert.main._iter_builds", return_value=[build]):
+        result = CliRunner().invoke(cli, ["build", "."])
+        assert result.exit_code == 0, result.output
+        assert not build.prefetch.called
+        assert build.build.called
+
+        result = CliRunner().invoke(cli, ["build", "--prefetch", "."])
+        assert result.exit_code == 0, result.output
+        assert build.prefetch.called
@@ -48,3 +48,45 @@ class TestList(unittest.TestCase):
             == {"/abc"}
         assert self.targlob_targets(["regex:/abc/def", "/bin/ghb"]) \
             == {"/abc", "/bin/ghb"}
+
+    def test_matches(self):
+        globs = self.TarGlobList(["/usr/lib", "/etc/", "glob:/opt/*/bin", "regex:/srv/(a)\\1"])
+        assert globs.matches("/usr/lib")
+        assert globs.matches("/usr/lib/x/y")
+        assert not globs.matches("/usr/libexec")
+        assert not globs.matches("/etc")
+        assert globs.matches("/etc/passwd")
+        assert globs.matches("/opt/foo/bin/tool")
+        assert not globs.matches("/opt/foo/lib")
+        assert globs.matches("/srv/aa/x")
+        assert not globs.matches("/srv/ab")
+        assert globs.matches("//usr/lib/") is False
+        assert not globs.matches("/")
+
+    def test_minimal_targets(self):
+        from bert.utils.targlob import _minimal_targets
+
+        assert _minimal_targets(["/a/b", "/a/b/c", "/a/b-x", "/d"]) == ["/a/b", "/a/b-x", "/d"]
+        assert _minimal_targets(["/a/b/c", "/a/b/d", "/a/e", "/f"], max_targets=2) == ["/a", "/f"]
+
+    def test_discover_root_targets(self):
+        import io
+        import posixpath
+        import tarfile
+        from unittest import mock
+
+        def get_archive(path):
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode="w") as tf:
+                tf.addfile(tarfile.TarInfo(posixpath.basename(path)), io.BytesIO(b""))
+            return [buf.getvalue()], {"name": path}
+
+        container = mock.Mock(attrs={"Image": "sha256:1234"})
+        container.client.containers.run.return_value = b"\0".join([
+            b"/", b"/usr", b"/usr/lib", b"/usr/lib/a.so", b"/usr/lib/b.txt", b"/lib", b"/lib/c.so"
+        ])
+        container.get_archive.side_effect = get_archive
+
+        files = list(self.TarGlobList([r"regex:.*\.so$"]).iter_container_files(container))
+        assert [c.args[0] for c in container.get_archive.call_args_list] == ["/lib/c.so", "/usr/lib/a.so"]
+        assert [ti.name for ti, _ in files] == ["/lib/c.so", "/usr/lib/a.so"]
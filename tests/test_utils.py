@@ -30,3 +30,373 @@ class TestExpectFileMode(unittest.TestCase):
         self.assertEqual(self.expect_file_mode("u=rwx,g=rx,o=rx"), 0o755)
         self.assertEqual(self.expect_file_mode("g=rx,u=rwx,o=rx"), 0o755)
         self.assertEqual(self.expect_file_mode("u=r,g=r,o=r"), 0o444)
+
+class TestFileHash(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from bert.utils import file_hash
+        self.file_hash = file_hash
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_tree(self):
+        import os
+        root = os.path.join(self.tempdir.name, "tree")
+        for i in range(20):
+            sub = os.path.join(root, "d%d" % (i % 3))
+            os.makedirs(sub, exist_ok=True)
+            with open(os.path.join(sub, "f%d" % i), "wb") as f:
+                f.write(b"x" * i * 1000)
+        os.symlink("d0/f0", os.path.join(root, "link"))
+        return root
+
+    def test_file(self):
+        import hashlib
+        import os
+        from bert.utils import hashing
+
+        fn = os.path.join(self.tempdir.name, "data")
+        data = os.urandom(100000)
+        with open(fn, "wb") as f:
+            f.write(data)
+
+        expected = hashlib.sha256(data).hexdigest()
+        self.assertEqual(self.file_hash('sha256', fn), expected)
+
+        orig = hashing.HASH_MMAP_THRESHOLD, hashing.HASH_CHUNK_SIZE
+        hashing.HASH_MMAP_THRESHOLD, hashing.HASH_CHUNK_SIZE = 1024, 4096
+        try:
+            h, sz = hashing._file_hash('sha256', fn, chunk_size=4096)
+        finally:
+            hashing.HASH_MMAP_THRESHOLD, hashing.HASH_CHUNK_SIZE = orig
+        self.assertEqual(h.hexdigest(), expected)
+        self.assertEqual(sz, len(data))
+
+    def test_tree_workers(self):
+        root = self.make_tree()
+        serial = self.file_hash('blake2b', root, workers=1)
+        self.assertEqual(self.file_hash('blake2b', root, workers=8), serial)
+        self.assertEqual(self.file_hash('blake2b', root), serial)
+
+    def test_tree_location_independent(self):
+        import os
+        import shutil
+
+        root = self.make_tree()
+        moved = os.path.join(self.tempdir.name, "elsewhere")
+        before = self.file_hash('sha256', root)
+        shutil.move(root, moved)
+        self.assertEqual(self.file_hash('sha256', moved), before)
+
+class TestOpenOutput(unittest.TestCase):
+    def test_concurrent_writers(self):
+        import os
+        import tempfile
+        from bert.utils import open_output
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, "sub", "index.json")
+            first, second = open_output(fn, "w"), open_output(fn, "w")
+            with first as f1:
+                with second as f2:
+                    f1.write("first")
+                    f2.write("second")
+                # the last writer to finish wins, with its whole output
+                with open(fn, "r") as f:
+                    self.assertEqual(f.read(), "second")
+            with open(fn, "r") as f:
+                self.assertEqual(f.read(), "first")
+            self.assertEqual(os.listdir(os.path.dirname(fn)), ["index.json"])
+
+            umask = os.umask(0o022)
+            os.umask(umask)
+            self.assertEqual(os.stat(fn).st_mode & 0o777, 0o666 & ~umask)
+
+            with self.assertRaises(ValueError):
+                with open_output(fn, "w") as f:
+                    f.write("partial")
+                    raise ValueError()
+            with open(fn, "r") as f:
+                self.assertEqual(f.read(), "first")
+            self.assertEqual(os.listdir(os.path.dirname(fn)), ["index.json"])
+
+class TestTarSource(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_tree(self, name, mtime):
+        import os
+        root = os.path.join(self.tempdir.name, name)
+        os.makedirs(os.path.join(root, "sub"))
+        for fn in ("a", "sub/b"):
+            path = os.path.join(root, fn)
+            with open(path, "w") as f:
+                f.write(fn)
+            os.utime(path, (mtime, mtime))
+        return root
+
+    def source(self, root, normalize, mtime=None):
+        from bert.utils import TarSource
+        source = TarSource()
+        source.add_path(root, "/dest")
+        if normalize:
+            source.normalize(mtime)
+        return source
+
+    def test_normalize(self):
+        import os
+
+        first = self.make_tree("first", 1000)
+        second = self.make_tree("second", 2000)
+
+        self.assertNotEqual(self.source(first, False).content_hash(),
+                            self.source(second, False).content_hash())
+        self.assertEqual(self.source(first, True).content_hash(),
+                         self.source(second, True).content_hash())
+
+        for entry in self.source(first, True, 42):
+            self.assertEqual(entry.info.mtime, 42)
+            self.assertEqual((entry.info.uid, entry.info.gid), (0, 0))
+
+        os.environ["SOURCE_DATE_EPOCH"] = "1234"
+        try:
+            for entry in self.source(first, True):
+                self.assertEqual(entry.info.mtime, 1234)
+        finally:
+            del os.environ["SOURCE_DATE_EPOCH"]
+
+    def test_iter_tar(self):
+        import io
+        import tarfile
+
+        source = self.source(self.make_tree("tree", 1000), True)
+        expected = io.BytesIO()
+        with tarfile.open(fileobj=expected, mode="w") as tf:
+            source.write_to(tf)
+
+        self.assertEqual(b"".join(source.iter_tar(chunk_size=100)), expected.getvalue())
+
+    def test_content_changes(self):
+        import os
+
+        root = self.make_tree("tree", 1000)
+        before = self.source(root, True).content_hash()
+        with open(os.path.join(root, "a"), "w") as f:
+            f.write("A")
+        self.assertNotEqual(self.source(root, True).content_hash(), before)
+
+class TestCompress(unittest.TestCase):
+    def test_roundtrip(self):
+        import gzip
+        import lzma
+        from bert.utils import iter_compressed, is_compressed
+
+        chunks = [b"abc" * 1000, b"", b"def" * 5000]
+        gz = b"".join(iter_compressed(iter(chunks), "gzip", 1))
+        self.assertTrue(is_compressed(gz))
+        self.assertEqual(gzip.decompress(gz), b"".join(chunks))
+
+        xz = b"".join(iter_compressed(iter(chunks), "xz"))
+        self.assertTrue(is_compressed(xz))
+        self.assertEqual(lzma.decompress(xz), b"".join(chunks))
+
+        self.assertFalse(is_compressed(b"".join(chunks)))
+
+    def test_parallel_writer(self):
+        import gzip
+        import io
+        import lzma
+        import os
+        from bert.utils import CompressWriter
+
+        data = os.urandom(5000) * 40 + b"tail"
+
+        def compress(compress_type, threads, block_size=10000):
+            out = io.BytesIO()
+            writer = CompressWriter(out, compress_type, 1, threads, block_size)
+            for i in range(0, len(data), 3333):
+                writer.write(data[i:i+3333])
+            writer.close()
+            return out.getvalue()
+
+        for compress_type, decompress in (("gzip", gzip.decompress), ("xz", lzma.decompress)):
+            for threads in (1, 3):
+                self.assertEqual(decompress(compress(compress_type, threads)), data)
+            self.assertEqual(compress(compress_type, 3), compress(compress_type, 3))
+            self.assertEqual(decompress(compress(compress_type, 3, block_size=2**20)), data)
+
+        # xz blocks make up a single stream
+        dec = lzma.LZMADecompressor()
+        self.assertEqual(dec.decompress(compress("xz", 3)), data)
+        self.assertTrue(dec.eof)
+        self.assertEqual(dec.unused_data, b"")
+
+        for compress_type, decompress in (("gzip", gzip.decompress), ("xz", lzma.decompress)):
+            out = io.BytesIO()
+            writer = CompressWriter(out, compress_type, threads=2)
+            writer.close()
+            self.assertEqual(decompress(out.getvalue()), b"")
+
+    def test_parallel_xz_tools(self):
+        import io
+        import os
+        import shutil
+        import subprocess
+        import tarfile
+        import tempfile
+        from bert.utils import CompressWriter
+
+        members = [("f%d" % i, os.urandom(3000)) for i in range(40)]
+        out = io.BytesIO()
+        writer = CompressWriter(out, "xz", threads=3, block_size=8192)
+        with tarfile.open(fileobj=writer, mode="w|") as tf:
+            for name, data in members:
+                ti = tarfile.TarInfo(name)
+                ti.size = len(data)
+                tf.addfile(ti, io.BytesIO(data))
+        writer.close()
+
+        for mode in ("r:xz", "r|xz"):
+            with tarfile.open(fileobj=io.BytesIO(out.getvalue()), mode=mode) as tf:
+                self.assertEqual([(ti.name, tf.extractfile(ti).read()) for ti in tf], members)
+
+        if shutil.which("xz"):
+            with tempfile.NamedTemporaryFile(suffix=".xz") as f:
+                f.write(out.getvalue())
+                f.flush()
+                subprocess.check_call(["xz", "-t", f.name])
+                listing = subprocess.check_output(["xz", "--robot", "--list", f.name]).decode("utf-8")
+            fields = [line.split("\t") for line in listing.splitlines() if line.startswith("file\t")][0]
+            streams, blocks = int(fields[1]), int(fields[2])
+            self.assertEqual(streams, 1)
+            self.assertGreater(blocks, 1)
+
+class TestIterArchives(unittest.TestCase):
+    def source(self, name, count, fail=False):
+        import io
+        import tarfile
+        import time
+
+        def iter_members():
+            for i in range(count):
+                # later sources finish first, order must not change
+                time.sleep(0.001 * (5 - len(name)))
+                data = ("%s-%d" % (name, i)).encode("utf-8")
+                ti = tarfile.TarInfo("%s/%d" % (name, i))
+                ti.size = len(data)
+                yield ti, io.BytesIO(data)
+            if fail:
+                raise OSError("broken %s" % name)
+        return iter_members
+
+    def test_order(self):
+        from bert.utils import iter_archives
+
+        sources = [self.source(name, 20) for name in ("a", "bb", "ccc", "dddd")]
+        result = [(ti.name, f.read()) for ti, f in iter_archives(sources, workers=3, queue_size=4)]
+        expected = [
+            ("%s/%d" % (name, i), ("%s-%d" % (name, i)).encode("utf-8"))
+            for name in ("a", "bb", "ccc", "dddd") for i in range(20)
+        ]
+        self.assertEqual(result, expected)
+
+    def test_error_and_early_exit(self):
+        from bert.utils import iter_archives
+
+        sources = [self.source("a", 2), self.source("bb", 2, fail=True), self.source("ccc", 50)]
+        with self.assertRaisesRegex(OSError, "broken bb"):
+            list(iter_archives(sources, queue_size=2))
+
+        items = iter_archives([self.source("a", 50), self.source("bb", 50)], queue_size=2)
+        next(items)
+        items.close()
+
+    def test_large_members_streamed(self):
+        import io
+        import tarfile
+        from unittest import mock
+        from bert.utils import archive, iter_archives
+
+        def source(name, sizes):
+            def iter_members():
+                for i, size in enumerate(sizes):
+                    ti = tarfile.TarInfo("%s/%d" % (name, i))
+                    ti.size = size
+                    yield ti, io.BytesIO(name.encode("utf-8") * size)
+            return iter_members
+
+        sources = [source("a", [5, 50, 5]), source("b", [50, 50]), source("c", [5, 5000])]
+        with mock.patch.object(archive, "ARCHIVE_SPOOL_SIZE", 10), \
+                mock.patch.object(archive, "COPY_CHUNK_SIZE", 7):
+            result = [(ti.name, f.read()) for ti, f in iter_archives(sources, workers=2)]
+            self.assertEqual(result, [
+                ("a/0", b"a" * 5), ("a/1", b"a" * 50), ("a/2", b"a" * 5),
+                ("b/0", b"b" * 50), ("b/1", b"b" * 50),
+                ("c/0", b"c" * 5), ("c/1", b"c" * 5000),
+            ])
+
+            # skipping or partly reading a streamed member
+            items = iter_archives(sources, workers=2)
+            names = []
+            for ti, f in items:
+                names.append(ti.name)
+                if ti.name == "b/0":
+                    self.assertEqual(f.read(3), b"bbb")
+            self.assertEqual(len(names), 7)
+
+            items = iter_archives(sources, workers=2)
+            next(items)
+            ti, f = next(items)
+            self.assertEqual(f.read(1), b"a")
+            items.close()
+
+    def test_queue_bytes(self):
+        import io
+        import tarfile
+        import threading
+        from bert.utils import iter_archives
+
+        produced = []
+        done = threading.Event()
+
+        def iter_members():
+            for i in range(20):
+                ti = tarfile.TarInfo(str(i))
+                ti.size = 100
+                produced.append(i)
+                yield ti, io.BytesIO(b"x" * 100)
+            done.set()
+
+        items = iter_archives([iter_members], queue_bytes=250)
+        next(items)
+        self.assertFalse(done.wait(0.3))
+        self.assertLessEqual(len(produced), 5)
+        self.assertEqual(len(list(items)), 19)
+
+class TestIOFromIterable(unittest.TestCase):
+    def test_large_chunks(self):
+        import io
+        from bert.utils import IOFromIterable, open_iterable, copy_fileobj
+
+        chunks = [b"a" * 100000, b"", b"b" * 10, b"c" * 300000]
+        raw = IOFromIterable(chunks)
+        buf = bytearray(4096)
+        data = bytearray()
+        while True:
+            sz = raw.readinto(memoryview(buf))
+            if not sz:
+                break
+            data += buf[:sz]
+        self.assertEqual(bytes(data), b"".join(chunks))
+
+        self.assertEqual(open_iterable(chunks, 1024).read(100020), b"a" * 100000 + b"b" * 10 + b"c" * 10)
+
+        out = io.BytesIO()
+        self.assertEqual(copy_fileobj(open_iterable(chunks), out, chunk_size=1000), 400010)
+        self.assertEqual(out.getvalue(), b"".join(chunks))